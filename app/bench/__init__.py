@@ -0,0 +1,4 @@
+"""
+进程内基准测试：通过 httpx 直接调用 ASGI 应用，不经过网络，数据库使用 SQLite 或本地 PostgreSQL。
+用法见 `python manage.py bench --help`。
+"""
@@ -0,0 +1,82 @@
+import asyncio
+import random
+import uuid
+from typing import Dict, Sequence
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+
+class FakeHydra:
+    """
+    进程内的 Hydra admin 替身，实现 HydraAdmin 用到的 login/consent 接口，每个请求注入 latency ± jitter 秒的延迟。
+    accept login 之后直接生成 consent challenge，redirect_to 指向 Eva 的 /hydra/consent，省去浏览器经过 Hydra 的跳转。
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, consent_url: str = "/hydra/consent"):
+        self.latency = latency
+        self.jitter = jitter
+        self.consent_url = consent_url
+        self.login_requests: Dict[str, dict] = {}
+        self.consent_requests: Dict[str, dict] = {}
+        self.calls = 0
+        self.app = Starlette()
+        self.app.add_route("/oauth2/auth/requests/login", self.get_login_request, methods=["GET"])
+        self.app.add_route("/oauth2/auth/requests/login/accept", self.accept_login_request, methods=["PUT"])
+        self.app.add_route("/oauth2/auth/requests/consent", self.get_consent_request, methods=["GET"])
+        self.app.add_route("/oauth2/auth/requests/consent/accept", self.accept_consent_request, methods=["PUT"])
+        self.app.add_route("/oauth2/auth/requests/consent/reject", self.reject_consent_request, methods=["PUT"])
+
+    def login_challenge(self, scope: Sequence[str] = ("openid", "offline")) -> str:
+        challenge = uuid.uuid4().hex
+        self.login_requests[challenge] = {
+            "challenge": challenge,
+            "skip": False,
+            "subject": "",
+            "client": {"client_id": "bench"},
+            "requested_scope": list(scope),
+            "requested_access_token_audience": [],
+        }
+        return challenge
+
+    async def delay(self):
+        self.calls += 1
+        latency = self.latency + random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def not_found(self):
+        return JSONResponse({"error": "Not Found"}, status_code=404)
+
+    async def get_login_request(self, request: Request):
+        await self.delay()
+        login = self.login_requests.get(request.query_params["login_challenge"])
+        return JSONResponse(login) if login else self.not_found()
+
+    async def accept_login_request(self, request: Request):
+        await self.delay()
+        login = self.login_requests.pop(request.query_params["login_challenge"], None)
+        if not login:
+            return self.not_found()
+        body = await request.json()
+        challenge = uuid.uuid4().hex
+        self.consent_requests[challenge] = {**login, "challenge": challenge, "subject": body["subject"]}
+        return JSONResponse({"redirect_to": f"{self.consent_url}?consent_challenge={challenge}"})
+
+    async def get_consent_request(self, request: Request):
+        await self.delay()
+        consent = self.consent_requests.get(request.query_params["consent_challenge"])
+        return JSONResponse(consent) if consent else self.not_found()
+
+    async def accept_consent_request(self, request: Request):
+        await self.delay()
+        if not self.consent_requests.pop(request.query_params["consent_challenge"], None):
+            return self.not_found()
+        return JSONResponse({"redirect_to": f"http://client.bench/callback?code={uuid.uuid4().hex}"})
+
+    async def reject_consent_request(self, request: Request):
+        await self.delay()
+        if not self.consent_requests.pop(request.query_params["consent_challenge"], None):
+            return self.not_found()
+        return JSONResponse({"redirect_to": "http://client.bench/callback?error=access_denied"})
@@ -0,0 +1,233 @@
+import asyncio
+import math
+import platform
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from urllib.parse import parse_qs, urlsplit
+
+from fastapi import Depends, FastAPI
+from httpx import AsyncClient
+from tortoise import Tortoise
+
+from app.bench.fake_hydra import FakeHydra
+from app.bench.scenarios import PASSWORD, SCENARIOS, BenchContext, Scenario, cleanup, seed
+from app.controllers.token import token_required
+from app.core import config
+from app.main import create_app
+from app.utils import queries
+from app.utils.hydra_cli import hydra_admin_latency
+from app.utils.invalidation import MemoryBackend, invalidation_bus
+from app.utils.keystore import MemoryKeyStore, key_manager
+
+# 登录加授权的完整流程，不属于 SCENARIOS 中的单请求场景
+HYDRA_FLOW = "hydra_login_consent"
+
+
+def percentile(sorted_values: Sequence[float], p: float) -> float:
+    """nearest-rank 百分位数"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def create_bench_app() -> FastAPI:
+    app = create_app()
+
+    async def protected(token: Dict = Depends(token_required)):
+        return {"sub": token["sub"]}
+
+    app.add_api_route("/bench/protected", protected, methods=["GET"])
+    return app
+
+
+async def measure(
+    send: Callable[[int], Awaitable[bool]], requests: int, concurrency: int, warmup: int
+) -> Dict[str, Any]:
+    """send(i) 发出第 i 个请求（或一组请求），返回是否成功；先预热 warmup 次，再以 concurrency 并发发送 requests 次"""
+    for i in range(warmup):
+        await send(i)
+
+    latencies: List[float] = []
+    errors = 0
+    indexes = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            start = time.perf_counter()
+            succeed = await send(i)
+            latencies.append(time.perf_counter() - start)
+            if not succeed:
+                errors += 1
+
+    queries_before = queries.total.count
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / requests * 1000, 3),
+        "queries_per_request": round((queries.total.count - queries_before) / requests, 2),
+    }
+
+
+async def run_scenario(  # pylint: disable=too-many-arguments
+    client: AsyncClient, scenario: Scenario, ctx: BenchContext, requests: int, concurrency: int, warmup: int
+) -> Dict[str, Any]:
+    async def send(i: int) -> bool:
+        resp = await client.request(scenario.method, scenario.path(ctx, i), **scenario.options(ctx, i))
+        return resp.status_code < 400
+
+    return await measure(send, requests, concurrency, warmup)
+
+
+async def login_consent_flow(client: AsyncClient, hydra: FakeHydra, identifier: str) -> bool:
+    """浏览器视角的完整流程：GET/POST /hydra/login，再 GET/POST /hydra/consent"""
+    challenge = hydra.login_challenge()
+    resp = await client.get("/hydra/login", params={"login_challenge": challenge})
+    if resp.status_code != 200:
+        return False
+    resp = await client.post(
+        "/hydra/login",
+        data={"identifier_type": "USERNAME", "identifier": identifier, "password": PASSWORD, "challenge": challenge},
+        allow_redirects=False,
+    )
+    if not resp.is_redirect:
+        return False
+    consent_url = resp.headers["location"]
+    resp = await client.get(consent_url)
+    if resp.status_code != 200:
+        return False
+    consent_challenge = parse_qs(urlsplit(consent_url).query)["consent_challenge"][0]
+    resp = await client.post(
+        "/hydra/consent",
+        data={"challenge": consent_challenge, "grant_scope": ["openid", "offline"], "submit": "Allow access"},
+        allow_redirects=False,
+    )
+    return resp.is_redirect and "code=" in resp.headers["location"]
+
+
+async def run_hydra_flow(  # pylint: disable=too-many-arguments
+    client: AsyncClient, hydra: FakeHydra, ctx: BenchContext, requests: int, concurrency: int, warmup: int
+) -> Dict[str, Any]:
+    """
+    每个"请求"是一次完整的登录加授权流程（4 个 HTTP 请求、5 次 Hydra admin 调用）。
+    hydra_ms 为每次流程花在 Hydra admin 调用上的平均时间，eva_ms 为其余部分。
+    """
+
+    def hydra_seconds() -> float:
+        return sum(value.sum for value in hydra_admin_latency.values.values())
+
+    async def send(i: int) -> bool:
+        return await login_consent_flow(client, hydra, ctx.identifiers[i % len(ctx.identifiers)])
+
+    for i in range(warmup):
+        await send(i)
+    hydra_before, calls_before = hydra_seconds(), hydra.calls
+    result = await measure(send, requests, concurrency, warmup=0)
+    hydra_ms = (hydra_seconds() - hydra_before) / requests * 1000
+    result.update(
+        hydra_calls_per_request=round((hydra.calls - calls_before) / requests, 2),
+        hydra_ms=round(hydra_ms, 3),
+        eva_ms=round(result["mean_ms"] - hydra_ms, 3),
+    )
+    return result
+
+
+async def run(  # pylint: disable=too-many-arguments,too-many-locals
+    db_url: str = "sqlite://:memory:",
+    scenarios: Optional[Sequence[str]] = None,
+    requests: int = 200,
+    concurrency: int = 10,
+    warmup: int = 10,
+    identities: int = 200,
+    hydra_latency: float = 0.002,
+) -> Dict[str, Any]:
+    """
+    初始化数据库和应用后依次运行各场景，结束时删除写入的压测数据，因此也可以指向已有的数据库。
+    登录限流会被关闭，缓存失效总线和签名密钥存储换成进程内实现，以免影响同一台机器上正在运行的 worker；
+    Hydra admin 替换为注入了 hydra_latency 秒延迟的 FakeHydra。
+    """
+    selected = [s for s in SCENARIOS if not scenarios or s.name in scenarios]
+    hydra = FakeHydra(latency=hydra_latency) if not scenarios or HYDRA_FLOW in scenarios else None
+    await Tortoise.init(db_url=db_url, modules={"models": ["app.models"]})
+    dialect = Tortoise.get_connection("default").capabilities.dialect
+    ctx: Optional[BenchContext] = None
+    try:
+        await Tortoise.generate_schemas(safe=True)
+        queries.install()
+        ctx = await seed(identities)
+
+        app = create_bench_app()
+        bus_backend, invalidation_bus.backend = invalidation_bus.backend, MemoryBackend(hub=set())
+        key_store, key_manager.store = key_manager.store, MemoryKeyStore()
+        await app.router.startup()
+        app.state.login_throttle = None
+        await app.state.hydra_client.aclose()
+        app.state.hydra_client = AsyncClient(app=hydra.app if hydra else FakeHydra().app, base_url="http://hydra")
+        try:
+            async with AsyncClient(app=app, base_url="http://eva") as client:
+                resp = await client.post(
+                    "/token/obtain",
+                    json={"identifier_type": "USERNAME", "identifier": ctx.identifiers[0], "password": PASSWORD},
+                )
+                resp.raise_for_status()
+                ctx.tokens.update(resp.json())
+                results = {
+                    scenario.name: await run_scenario(client, scenario, ctx, requests, concurrency, warmup)
+                    for scenario in selected
+                }
+                if hydra:
+                    results[HYDRA_FLOW] = await run_hydra_flow(client, hydra, ctx, requests, concurrency, warmup)
+        finally:
+            await app.router.shutdown()
+            invalidation_bus.backend = bus_backend
+            key_manager.store = key_store
+    finally:
+        try:
+            if ctx is not None:
+                await cleanup(ctx)
+        finally:
+            await Tortoise.close_connections()
+
+    settings = config.settings
+    return {
+        "meta": {
+            "db": dialect,
+            "requests": requests,
+            "concurrency": concurrency,
+            "warmup": warmup,
+            "identities": identities,
+            "hydra_latency_ms": hydra_latency * 1000,
+            "python": platform.python_version(),
+            "argon2": {"time_cost": settings.argon2_time_cost, "memory_cost": settings.argon2_memory_cost},
+        },
+        "results": results,
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+    """
+    与基线比较，返回退化项的描述：p95 延迟或吞吐量超出 tolerance 的比例，或每请求查询数增加。
+    只比较两边都有的场景。
+    """
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        current = report["results"].get(name)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms > baseline {base['p95_ms']}ms")
+        if current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['rps']} req/s < baseline {base['rps']} req/s")
+        if current["queries_per_request"] > base["queries_per_request"] + 0.01:
+            regressions.append(
+                f"{name}: {current['queries_per_request']} queries/request > baseline {base['queries_per_request']}"
+            )
+    return regressions
@@ -0,0 +1,107 @@
+import uuid
+from typing import Any, Callable, Dict, List, NamedTuple
+
+from tortoise.transactions import in_transaction
+
+from app import schemas
+from app.models import Identity, Permission, Role, meta
+from app.utils import encrypt, identity_io
+
+PASSWORD = uuid.uuid4().hex  # 压测身份的密码，每次运行随机生成
+
+
+class BenchContext(NamedTuple):
+    """压测数据：identifiers/uuids 一一对应，tokens 为第一个身份的 access/refresh token；prefix 为所有代码的前缀"""
+
+    prefix: str
+    identifiers: List[str]
+    uuids: List[str]
+    role_codes: List[str]
+    tokens: Dict[str, str]
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    path: Callable[[BenchContext, int], str]
+    options: Callable[[BenchContext, int], Dict[str, Any]] = lambda ctx, i: {}
+
+
+def bearer(token_type: str):
+    return lambda ctx, i: {"headers": {"Authorization": f"Bearer {ctx.tokens[token_type]}"}}
+
+
+SCENARIOS = [
+    Scenario(
+        "token_obtain",
+        "POST",
+        lambda ctx, i: "/token/obtain",
+        lambda ctx, i: {
+            "json": {
+                "identifier_type": "USERNAME",
+                "identifier": ctx.identifiers[i % len(ctx.identifiers)],
+                "password": PASSWORD,
+            }
+        },
+    ),
+    Scenario("token_refresh", "POST", lambda ctx, i: "/token/refresh", bearer("refresh_token")),
+    Scenario("token_required", "GET", lambda ctx, i: "/bench/protected", bearer("access_token")),
+    Scenario("jwks", "GET", lambda ctx, i: "/.well-known/jwks.json"),
+    Scenario("identity_list", "GET", lambda ctx, i: "/api/identity?limit=50"),
+    Scenario("identity_list_detail", "GET", lambda ctx, i: "/api/identity/detail?limit=50"),
+    Scenario("identity_list_1000", "GET", lambda ctx, i: "/api/identity?limit=1000"),
+    Scenario("identity_list_detail_1000", "GET", lambda ctx, i: "/api/identity/detail?limit=1000"),
+    Scenario("identity_detail", "GET", lambda ctx, i: f"/api/identity/{ctx.uuids[i % len(ctx.uuids)]}"),
+    Scenario(
+        "identity_patch",
+        "PATCH",
+        lambda ctx, i: f"/api/identity/{ctx.uuids[i % len(ctx.uuids)]}",
+        lambda ctx, i: {"json": {"is_active": True}},
+    ),
+    Scenario("role_list", "GET", lambda ctx, i: "/api/role?limit=50"),
+    Scenario("role_detail", "GET", lambda ctx, i: f"/api/role/{ctx.role_codes[i % len(ctx.role_codes)]}"),
+    Scenario(
+        "role_patch",
+        "PATCH",
+        lambda ctx, i: f"/api/role/{ctx.role_codes[i % len(ctx.role_codes)]}",
+        lambda ctx, i: {"json": {"description": f"bench {i}"}},
+    ),
+]
+
+
+async def seed(identities: int, roles: int = 10, permissions: int = 50) -> BenchContext:
+    """
+    写入压测数据，代码带随机前缀，不会与已有数据冲突。
+    所有身份共用同一个密码哈希，避免准备数据时做 identities 次 Argon2 运算。
+    """
+    prefix = f"bench-{uuid.uuid4().hex[:8]}"
+    permission_codes = [f"{prefix}-perm-{i}" for i in range(permissions)]
+    await Permission.bulk_create([Permission(code=code, name=code) for code in permission_codes])
+    role_codes = [f"{prefix}-role-{i}" for i in range(roles)]
+    await Role.bulk_create([Role(code=code, name=code) for code in role_codes])
+    for i, role in enumerate(await Role.filter(code__in=role_codes).order_by("id")):
+        await role.permissions.add(*await Permission.filter(code__in=permission_codes[i::roles]))
+    role_ids = dict(await Role.filter(code__in=role_codes).values_list("code", "id"))
+
+    shadow = encrypt.encrypt_password(PASSWORD)
+    identifiers = [f"{prefix}-{i}" for i in range(identities)]
+    items = [
+        schemas.IdentityImport(
+            role_codes=[role_codes[i % roles], role_codes[(i + 1) % roles]],
+            credentials=[{"identifier_type": "USERNAME", "identifier": identifier, "password_shadow": shadow}],
+        )
+        for i, identifier in enumerate(identifiers)
+    ]
+    async with in_transaction(meta(Identity).default_connection) as conn:
+        uuids = await identity_io.write_identities(items, role_ids, conn)
+    return BenchContext(
+        prefix=prefix, identifiers=identifiers, uuids=[str(u) for u in uuids], role_codes=role_codes, tokens={}
+    )
+
+
+async def cleanup(ctx: BenchContext, chunk_size: int = 500):
+    """删除 seed 写入的数据，凭证、密码及角色和权限的关联由外键级联删除"""
+    for i in range(0, len(ctx.uuids), chunk_size):
+        await Identity.filter(uuid__in=ctx.uuids[i : i + chunk_size]).delete()
+    await Role.filter(code__startswith=f"{ctx.prefix}-").delete()
+    await Permission.filter(code__startswith=f"{ctx.prefix}-").delete()
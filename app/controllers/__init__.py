@@ -1,4 +1,8 @@
+from typing import Dict, Optional
+
+
 class EvaException(Exception):
-    def __init__(self, message: str, status_code=400):
+    def __init__(self, message: str, status_code=400, headers: Optional[Dict[str, str]] = None):
         self.message = message
         self.status_code = status_code
+        self.headers = headers
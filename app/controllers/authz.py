@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+
+from app import schemas
+from app.models import load_permission_codes
+
+router = APIRouter()
+
+
+@router.post("/check", response_model=schemas.AuthzCheckResult)
+async def check_permissions(body: schemas.AuthzCheckRequest):
+    """
+    批量判断 (subject, permission) 是否成立，结果按请求顺序返回。
+    所有 subject 的权限一次性从缓存或一条查询中取出；不存在的 subject 视为没有任何权限。
+    """
+    codes = await load_permission_codes(check.subject for check in body.checks)
+    return schemas.AuthzCheckResult(results=[check.permission in codes[check.subject] for check in body.checks])
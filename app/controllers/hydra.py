@@ -1,12 +1,14 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, Form
+from fastapi import APIRouter, BackgroundTasks, Depends, Form
 from starlette.requests import Request
 from starlette.responses import RedirectResponse
 from starlette.templating import Jinja2Templates
 
+from app.controllers import EvaException
 from app.models import Credential
 from app.utils.hydra_cli import HydraAdmin, hydra_admin
+from app.utils.throttle import LoginThrottle, login_throttle
 
 templates = Jinja2Templates(directory="app/templates")
 
@@ -35,15 +37,28 @@ async def login(
 @router.post("/login")
 async def accept_login(
     request: Request,
+    background_tasks: BackgroundTasks,
     identifier_type: Credential.IdentifierType = Form(...),
     identifier: str = Form(...),
     password: str = Form(...),
     remember: bool = Form(False),
     challenge: str = Form(...),
     hydra_cli: HydraAdmin = Depends(hydra_admin),
+    throttle: Optional[LoginThrottle] = Depends(login_throttle),
 ):  # pylint: disable=too-many-arguments
-    credential = await Credential.filter(identifier_type=identifier_type, identifier=identifier).first()
-    if not credential:
+    if throttle:
+        try:
+            await throttle.check(identifier_type.value, identifier, throttle.client_ip(request))
+        except EvaException as exc:
+            return templates.TemplateResponse(
+                "login.html",
+                context={"request": request, "challenge": challenge, "error": exc.message},
+                status_code=exc.status_code,
+                headers=exc.headers,
+            )
+    credential = await Credential.lookup(identifier_type, identifier)
+    pwd = credential and await credential.match_password(password)
+    if not pwd or not credential.is_active:
         return templates.TemplateResponse(
             "login.html",
             context={
@@ -52,24 +67,11 @@ async def accept_login(
                 "error": "The identifier / password combination is not correct",
             },
         )
-    succeed = True
-    async for pwd in credential.passwords:
-        if pwd.validate_password(password):
-            succeed = True
-            break
-    if not succeed:
-        return templates.TemplateResponse(
-            "login.html",
-            context={
-                "challenge": challenge,
-                "error": "The email / password combination is not correct",
-                "request": request,
-            },
-        )
-    await credential.fetch_related("identity")
+    if pwd.needs_rehash:
+        background_tasks.add_task(pwd.rehash, password)
     resp = await hydra_cli.accept_login_request(
         challenge=challenge,
-        subject=str(credential.identity.uuid),
+        subject=str(credential.identity_uuid),
         remember=remember,
         remember_for=3600,
     )
@@ -1,14 +1,24 @@
+import tempfile
+from typing import Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import ORJSONResponse
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from app import schemas
 from app.controllers import EvaException
 from app.models import Credential, Identity, Password, Permission, Role
+from app.utils import bulk_rbac, identity_io
+from app.utils.invalidation import invalidation_bus
 from app.utils.paginator import Pagination, PaginationResult
 
 router = APIRouter()
 
+# 导入请求体在内存中缓冲的上限，超出后落盘
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
 
 @router.get("/identity", response_model=PaginationResult[schemas.IdentitySimple], tags=["Identity Management"])
 async def list_identities(p: Pagination = Depends(Pagination)):
@@ -16,45 +26,69 @@ async def list_identities(p: Pagination = Depends(Pagination)):
     return await p.apply(queryset, schemas.IdentitySimple)
 
 
+@router.get("/identity/detail", response_model=PaginationResult[schemas.IdentityDetail], tags=["Identity Management"])
+async def list_identity_details(p: Pagination = Depends(Pagination)):
+    """与 GET /identity 相同的分页参数，每项为含角色和凭证的 IdentityDetail"""
+    queryset = Identity.all()
+    return await p.apply(queryset, schemas.IdentityDetail, projection=schemas.project_identities)
+
+
 @router.post("/identity", response_model=schemas.IdentityDetail, tags=["Identity Management"])
 async def create_identity(body: schemas.IdentityCreate):
-    roles = await Role.filter(code__in=body.role_codes).all()
-    if not len(roles) == len(body.role_codes):
-        diff = set(body.role_codes) - {r.name for r in roles}
-        raise EvaException(message=f"specified roles {diff} not found")
-    new_identity = Identity(is_active=body.is_active)
-    await new_identity.save()
-    await new_identity.roles.add(*roles)
-    credentials = []
-    for identifier_pair in body.credentials:
-        c = Credential(
-            identifier=identifier_pair.identifier,
-            identifier_type=identifier_pair.identifier_type,
-            identity=new_identity,
-        )
-        await c.save()
-        pwd = Password.from_raw(c, identifier_pair.password)
-        await pwd.save()
-        credentials.append(c)
-    await new_identity.fetch_related("roles__permissions")
-    return await schemas.IdentityDetail.from_object(new_identity)
+    identity_uuid = await identity_io.create_identity(body)
+    identity = schemas.single(await schemas.project_identities(Identity.filter(uuid=identity_uuid)))
+    return ORJSONResponse(schemas.IdentityDetail.pick(identity))
+
+
+@router.post("/identity/import", tags=["Identity Management"])
+async def import_identities(request: Request, chunk_size: int = Query(default=500, ge=1, le=5000)):
+    """
+    批量导入身份：请求体为 NDJSON（每行一个 IdentityImport）或 CSV（Content-Type: text/csv），
+    按 chunk_size 分批在事务中写入，并以 NDJSON 流式返回每一行的结果（uuid 或 error）。
+    """
+    # StreamingResponse 会并发监听断开事件并抢占 receive()，因此先把请求体写入临时文件再开始响应
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+    lines = identity_io.iter_lines(identity_io.read_file(spool))
+    if "csv" in request.headers.get("content-type", ""):
+        records = identity_io.parse_csv(lines)
+    else:
+        records = identity_io.parse_ndjson(lines)
+    results = identity_io.import_identities(records, chunk_size=chunk_size)
+    return StreamingResponse(identity_io.ndjson(results), media_type="application/x-ndjson")
+
+
+@router.get("/identity/export", tags=["Identity Management"])
+async def export_identities(
+    batch_size: int = Query(default=1000, ge=1, le=10000), is_active: Optional[bool] = Query(default=None)
+):
+    """
+    以 NDJSON 流式导出全部身份（IdentityDetail 格式，含角色和凭证），按主键分批读取，内存占用与表大小无关。
+    """
+    return StreamingResponse(
+        identity_io.export_identities(batch_size=batch_size, is_active=is_active), media_type="application/x-ndjson"
+    )
 
 
 @router.get("/identity/{uuid}", response_model=schemas.IdentityDetail, tags=["Identity Management"])
 async def retrieve_identity(uuid: UUID):
-    identity = await Identity.get(uuid=uuid).prefetch_related("roles__permissions")
-    return await schemas.IdentityDetail.from_object(identity)
+    identity = schemas.single(await schemas.project_identities(Identity.filter(uuid=uuid)))
+    return ORJSONResponse(schemas.IdentityDetail.pick(identity))
 
 
 @router.delete("/identity/{uuid}", response_model=None, tags=["Identity Management"])
 async def delete_identity(uuid: UUID):
     identity = await Identity.get(uuid=uuid)
     await identity.delete()
+    invalidation_bus.publish("permissions", str(identity.uuid))
+    invalidation_bus.publish("identities", str(identity.uuid))
 
 
 @router.patch("/identity/{uuid}", response_model=schemas.IdentityDetail, tags=["Identity Management"])
 async def update_identity(uuid: UUID, body: schemas.IdentityUpdate):
-    identity = await Identity.get(uuid=uuid).prefetch_related("roles__permissions")
+    identity = await Identity.get(uuid=uuid)
     if body.is_active is not None:
         identity.is_active = body.is_active
     if body.credentials is not None:
@@ -69,27 +103,52 @@ async def update_identity(uuid: UUID, body: schemas.IdentityUpdate):
             if identifier_pair.password:
                 pwd = await c.passwords.all().first()
                 if not pwd:
-                    pwd = Password.from_raw(c, identifier_pair.password)
-                pwd.set_password(identifier_pair.password)
+                    pwd = await Password.from_raw(c, identifier_pair.password)
+                else:
+                    await pwd.set_password(identifier_pair.password)
                 await pwd.save()
             new_ids.add(c.id)
         await Credential.filter(id__in=(old_ids - new_ids)).delete()
     if body.roles is not None:
         old_roles = set(await identity.roles.all())
         new_roles = set(await Role.filter(code__in=[r.code for r in body.roles]).all())
-        await identity.roles.remove(*(old_roles - new_roles))
-        await identity.roles.add(*(new_roles - old_roles))
+        if old_roles - new_roles:
+            await identity.roles.remove(*(old_roles - new_roles))
+        if new_roles - old_roles:
+            await identity.roles.add(*(new_roles - old_roles))
+        invalidation_bus.publish("permissions", str(identity.uuid))
 
     await identity.save()
+    invalidation_bus.publish("identities", str(identity.uuid))
     return await schemas.IdentityDetail.from_object(identity)
 
 
+@router.post("/identity/roles/assign", response_model=schemas.BulkResult, tags=["Identity Management"])
+async def assign_roles(body: schemas.BulkRoleAssignment):
+    """给选中的全部身份添加角色，已有的跳过"""
+    return schemas.BulkResult(affected=await bulk_rbac.assign_roles(body.identities, body.role_codes))
+
+
+@router.post("/identity/roles/revoke", response_model=schemas.BulkResult, tags=["Identity Management"])
+async def revoke_roles(body: schemas.BulkRoleAssignment):
+    """从选中的全部身份移除角色"""
+    return schemas.BulkResult(affected=await bulk_rbac.revoke_roles(body.identities, body.role_codes))
+
+
 @router.get("/role", response_model=PaginationResult[schemas.RoleSimple], tags=["Role Management"])
 async def list_roles(p: Pagination = Depends(Pagination)):
     queryset = Role.all()
     return await p.apply(queryset, schemas.RoleSimple)
 
 
+# 需要在 /role/{role_code} 之前注册
+@router.get("/role/detail", response_model=PaginationResult[schemas.RoleDetail], tags=["Role Management"])
+async def list_role_details(p: Pagination = Depends(Pagination)):
+    """与 GET /role 相同的分页参数，每项为含权限代码的 RoleDetail"""
+    queryset = Role.all()
+    return await p.apply(queryset, schemas.RoleDetail, projection=schemas.project_roles)
+
+
 @router.post("/role", response_model=schemas.RoleDetail, tags=["Role Management"])
 async def create_role(body: schemas.RoleCreate):
     if await Role.filter(code=body.code).exists():
@@ -103,19 +162,23 @@ async def create_role(body: schemas.RoleCreate):
     if body.permission_codes:
         permissions = await Permission.filter(code__in=body.permission_codes)
         await role.permissions.add(*permissions)
+    invalidation_bus.publish("permission_index")
     return await schemas.RoleDetail.from_object(role)
 
 
 @router.get("/role/{role_code}", response_model=schemas.RoleDetail, tags=["Role Management"])
 async def delete_role(role_code: str):
-    role = await Role.get(code=role_code)
-    return await schemas.RoleDetail.from_object(role)
+    role = schemas.single(await schemas.project_roles(Role.filter(code=role_code)))
+    return ORJSONResponse(schemas.RoleDetail.pick(role))
 
 
 @router.delete("/role/{role_code}", response_model=None, tags=["Role Management"])
 async def retrieve_role(role_code: str):
     role = await Role.get(code=role_code)
     await role.delete()
+    invalidation_bus.publish("permissions")
+    invalidation_bus.publish("identities")  # 快照中的角色代码
+    invalidation_bus.publish("permission_index")
 
 
 @router.patch("/role/{role_code}", response_model=schemas.RoleDetail, tags=["Role Management"])
@@ -128,12 +191,28 @@ async def update_role(role_code: str, body: schemas.RoleUpdate):
     if body.permission_codes is not None:
         old_permissions = set(await role.permissions.all())
         new_permissions = set(await Permission.filter(code__in=body.permission_codes).all())
-        await role.permissions.remove(*(old_permissions - new_permissions))
-        await role.permissions.add(*(new_permissions - old_permissions))
+        if old_permissions - new_permissions:
+            await role.permissions.remove(*(old_permissions - new_permissions))
+        if new_permissions - old_permissions:
+            await role.permissions.add(*(new_permissions - old_permissions))
+        invalidation_bus.publish("permissions")
+        invalidation_bus.publish("permission_index")
     await role.save()
     return await schemas.RoleDetail.from_object(role)
 
 
+@router.post("/role/permissions/grant", response_model=schemas.BulkResult, tags=["Role Management"])
+async def grant_permissions(body: schemas.BulkPermissionGrant):
+    """给每个角色授予每个权限，已有的跳过"""
+    return schemas.BulkResult(affected=await bulk_rbac.grant_permissions(body.role_codes, body.permission_codes))
+
+
+@router.post("/role/permissions/revoke", response_model=schemas.BulkResult, tags=["Role Management"])
+async def revoke_permissions(body: schemas.BulkPermissionGrant):
+    """从每个角色撤销每个权限"""
+    return schemas.BulkResult(affected=await bulk_rbac.revoke_permissions(body.role_codes, body.permission_codes))
+
+
 @router.get("/permission", response_model=PaginationResult[schemas.PermissionSimple], tags=["Permission Management"])
 async def list_permissions(p: Pagination = Depends(Pagination)):
     return await p.apply(Permission.all(), schemas.PermissionSimple)
@@ -145,13 +224,14 @@ async def create_permission(body: schemas.PermissionCreate):
         raise EvaException(message="provided permission code already exists")
     permission = Permission(**body.dict())
     await permission.save()
+    invalidation_bus.publish("permission_index")
     return schemas.PermissionDetail.from_orm(permission)
 
 
 @router.get("/permission/{permission_code}", response_model=schemas.PermissionDetail, tags=["Permission Management"])
 async def retrieve_permission(permission_code: str):
-    permission = await Permission.get(code=permission_code)
-    return schemas.PermissionDetail.from_orm(permission)
+    permission = await Permission.filter(code=permission_code).values(*schemas.PermissionDetail.__fields__)
+    return ORJSONResponse(schemas.single(permission))
 
 
 @router.patch("/permission/{permission_code}", response_model=schemas.PermissionDetail, tags=["Permission Management"])
@@ -165,3 +245,5 @@ async def update_permission(permission_code: str, body: schemas.PermissionUpdate
 async def delete_permission(permission_code: str):
     permission = await Permission.get(code=permission_code)
     await permission.delete()
+    invalidation_bus.publish("permissions")
+    invalidation_bus.publish("permission_index")
@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from app.utils import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -1,10 +1,15 @@
-from typing import Dict
+from typing import Dict, Optional
+from uuid import UUID
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, BackgroundTasks, Depends
+from starlette.requests import Request
 
 from app import schemas
 from app.controllers import EvaException
-from app.models import Credential, Identity
+from app.core.config import settings
+from app.models import Credential, get_identity_snapshot
+from app.utils.permission_index import permission_index
+from app.utils.throttle import LoginThrottle, login_throttle
 from app.utils.token import TokenRequired, auth_jwt
 
 router = APIRouter()
@@ -14,25 +19,32 @@ refresh_token_required = TokenRequired(scheme_name="JWT", token_type="refresh")
 
 
 @router.post("/obtain", response_model=schemas.AccessToken)
-async def obtain_jwt_token(body: schemas.TokenObtain):
-    credential = await Credential.filter(identifier_type=body.identifier_type, identifier=body.identifier).first()
+async def obtain_jwt_token(
+    request: Request,
+    body: schemas.TokenObtain,
+    background_tasks: BackgroundTasks,
+    throttle: Optional[LoginThrottle] = Depends(login_throttle),
+):
+    if throttle:
+        await throttle.check(body.identifier_type.value, body.identifier, throttle.client_ip(request))
+    credential = await Credential.lookup(body.identifier_type, body.identifier)
     if not credential:
         raise EvaException(message="The credential is not correct")
-    succeed = False
-    async for pwd in credential.passwords:
-        if pwd.validate_password(body.password):
-            succeed = True
-            break
-    if not succeed:
+    pwd = await credential.match_password(body.password)
+    if not pwd:
         raise EvaException(message="The credential is not correct")
+    if pwd.needs_rehash:
+        background_tasks.add_task(pwd.rehash, body.password)
+    if not credential.is_active:
+        raise EvaException(message="invalid identity")
 
-    await credential.fetch_related("identity")
-    identity: Identity = credential.identity
     claims = {
-        "sub": str(identity.uuid),
-        "roles": await identity.roles.all().values_list("code", flat=True),
+        "sub": str(credential.identity_uuid),
+        "roles": credential.role_codes,
         "identifier_type": credential.identifier_type.name,
     }
+    if settings.jwt_permission_bitmask:
+        claims.update((await permission_index.get()).claims(credential.role_codes))
     return schemas.AccessToken(
         access_token=auth_jwt.create_access_token(custom_claims=claims),
         refresh_token=auth_jwt.create_refresh_token(custom_claims=claims),
@@ -42,14 +54,16 @@ async def obtain_jwt_token(body: schemas.TokenObtain):
 @router.post("/refresh", response_model=schemas.RefreshToken)
 async def refresh_jwt_token(token: Dict = Depends(refresh_token_required)):
     uuid = token["sub"]
-    identity = await Identity.get(uuid=uuid)
-    if not identity or not identity.is_active:
+    snapshot = await get_identity_snapshot(UUID(uuid))
+    if not snapshot or not snapshot.is_active:
         raise EvaException(message="invalid identity")
     claims = {
         "sub": uuid,
-        "roles": await identity.roles.all().values_list("code", flat=True),
+        "roles": list(snapshot.role_codes),
         "identifier_type": token["identifier_type"],
     }
+    if settings.jwt_permission_bitmask:
+        claims.update((await permission_index.get()).claims(claims["roles"]))
     return schemas.RefreshToken(
         access_token=auth_jwt.create_access_token(custom_claims=claims),
     )
@@ -1,14 +1,40 @@
-from authlib.jose import JsonWebKey, KeySet, RSAKey
-from fastapi import APIRouter
+from fastapi import APIRouter, Header
+from starlette.responses import Response
 
 from app import schemas
 from app.core.config import settings
+from app.utils.keyring import key_ring
+from app.utils.permission_index import permission_index
 
 router = APIRouter()
 
 
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
 @router.get("/jwks.json", response_model=schemas.JSONWenKeySet)
-async def json_web_key_set():
-    key: RSAKey = JsonWebKey.import_key(settings.jwt_private_key.get_secret_value())
-    key_set = KeySet(keys=[key])
-    return key_set.as_dict()
+async def json_web_key_set(if_none_match: str = Header(None), accept_encoding: str = Header("")):
+    jwks = key_ring.jwks
+    headers = {
+        "ETag": jwks.etag,
+        "Cache-Control": f"public, max-age={settings.jwks_max_age}",
+        "Vary": "Accept-Encoding",
+    }
+    if if_none_match and etag_matches(jwks.etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    if "gzip" in accept_encoding:
+        headers["Content-Encoding"] = "gzip"
+        return Response(jwks.gzip_body, media_type="application/json", headers=headers)
+    return Response(jwks.body, media_type="application/json", headers=headers)
+
+
+@router.get("/permission-index.json")
+async def permission_index_document(if_none_match: str = Header(None)):
+    """权限位索引：permissions[i] 对应掩码的第 i 位（已删除的权限为 null），roles 为各角色的权限掩码（base64url，小端）"""
+    index = await permission_index.get()
+    headers = {"ETag": index.etag, "Cache-Control": f"public, max-age={settings.permission_index_max_age}"}
+    if if_none_match and etag_matches(index.etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(index.body, media_type="application/json", headers=headers)
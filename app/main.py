@@ -2,27 +2,45 @@ import logging
 
 import sentry_sdk
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.errors import ServerErrorMiddleware
-from starlette.middleware.gzip import GZipMiddleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 from tortoise.contrib.fastapi import register_tortoise
 from tortoise.exceptions import DoesNotExist, IntegrityError
 
-from app.controllers import EvaException, hydra, identity, token, well_known
+from app.controllers import EvaException, authz, hydra, identity, metrics, token, well_known
 from app.core import config
+from app.utils import encrypt, hydra_cli, throttle
+from app.utils.invalidation import invalidation_bus
+from app.utils.keystore import key_manager
+from app.utils.metrics import worker_snapshots
+from app.utils.middleware import GZipMiddleware, MetricsMiddleware
 
 logging.root.setLevel("INFO")
 
 
+async def eva_exception_handler(_: Request, exc: EvaException):
+    return JSONResponse(status_code=exc.status_code, content={"message": exc.message}, headers=exc.headers)
+
+
+async def does_not_exist_exception_handler(_: Request, exc: DoesNotExist):
+    return JSONResponse(status_code=404, content={"message": str(exc)})
+
+
+async def integrity_error_exception_handler(_: Request, exc: IntegrityError):  # pragma: no cover
+    return JSONResponse(status_code=422, content={"detail": [{"loc": [], "msg": str(exc), "type": "IntegrityError"}]})
+
+
 def create_app():
     fast_app = FastAPI(
         debug=False,
         title="Eva API Document",
         servers=[{"url": "http://localhost:8000", "description": "Developing environment"}],
-        default_response_class=JSONResponse,
+        # 经过 response_model 的响应也用 orjson 编码；个别路由可以用 response_class=JSONResponse 改回标准库
+        default_response_class=ORJSONResponse,
     )
     # add middlewares
     fast_app.add_middleware(
@@ -30,31 +48,53 @@ def create_app():
     )
     fast_app.add_middleware(ServerErrorMiddleware, debug=(config.settings.env == "local"))
     fast_app.add_middleware(GZipMiddleware)
+    # 即使不暴露 /metrics 也记录指标，查询统计的调试响应头和 N+1 警告依赖它
+    fast_app.add_middleware(MetricsMiddleware)
+
+    fast_app.add_exception_handler(EvaException, eva_exception_handler)
+    fast_app.add_exception_handler(DoesNotExist, does_not_exist_exception_handler)
+    fast_app.add_exception_handler(IntegrityError, integrity_error_exception_handler)
 
     # add routers
     fast_app.include_router(well_known.router, prefix="/.well-known")
     fast_app.include_router(identity.router, prefix="/api")
+    fast_app.include_router(authz.router, prefix="/api/authz", tags=["Authorization"])
     fast_app.include_router(hydra.router, prefix="/hydra", tags=["Hydra"])
     fast_app.include_router(token.router, prefix="/token", tags=["JSON Web Token"])
-    return fast_app
+    if config.settings.metrics_enabled:
+        fast_app.include_router(metrics.router)
+        if worker_snapshots is not None:
+            fast_app.add_event_handler("startup", worker_snapshots.start)
+            fast_app.add_event_handler("shutdown", worker_snapshots.close)
 
+    async def open_hydra_client():
+        fast_app.state.hydra_client = hydra_cli.create_client()
 
-app = create_app()
+    async def close_hydra_client():
+        await fast_app.state.hydra_client.aclose()
 
+    fast_app.add_event_handler("startup", open_hydra_client)
+    fast_app.add_event_handler("shutdown", close_hydra_client)
 
-@app.exception_handler(EvaException)
-async def eva_exception_handler(_: Request, exc: EvaException):
-    return JSONResponse(status_code=exc.status_code, content={"message": exc.message})
+    async def open_login_throttle():
+        fast_app.state.login_throttle = throttle.create_login_throttle()
 
+    async def close_login_throttle():
+        if fast_app.state.login_throttle:
+            await fast_app.state.login_throttle.close()
 
-@app.exception_handler(DoesNotExist)
-async def does_not_exist_exception_handler(_: Request, exc: DoesNotExist):
-    return JSONResponse(status_code=404, content={"message": str(exc)})
+    fast_app.add_event_handler("startup", open_login_throttle)
+    fast_app.add_event_handler("shutdown", close_login_throttle)
 
+    fast_app.add_event_handler("startup", invalidation_bus.start)
+    fast_app.add_event_handler("startup", key_manager.start)
+    fast_app.add_event_handler("shutdown", key_manager.close)
+    fast_app.add_event_handler("shutdown", invalidation_bus.close)
+    fast_app.add_event_handler("shutdown", encrypt.hashing_pool.shutdown)
+    return fast_app
 
-@app.exception_handler(IntegrityError)
-async def integrity_error_exception_handler(_: Request, exc: IntegrityError):  # pragma: no cover
-    return JSONResponse(status_code=422, content={"detail": [{"loc": [], "msg": str(exc), "type": "IntegrityError"}]})
+
+app = create_app()
 
 
 if config.settings.env != "local":  # pragma: no cover
@@ -65,3 +105,5 @@ if config.settings.env != "local":  # pragma: no cover
 if config.settings.env != "test":  # pragma: no cover
     logging.info("connecting to database...")
     register_tortoise(app, config=config.db_config)
+    # 密钥可能保存在数据库中，让连接数据库的 startup 先于其他 startup 执行
+    app.router.on_startup.insert(0, app.router.on_startup.pop())
@@ -0,0 +1,4 @@
+-- upgrade --
+ALTER TABLE "eva_credential" ADD CONSTRAINT "uid_eva_credent_identif_2e5cf3" UNIQUE ("identifier_type", "identifier");
+-- downgrade --
+ALTER TABLE "eva_credential" DROP CONSTRAINT "uid_eva_credent_identif_2e5cf3";
@@ -0,0 +1,11 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "eva_signing_key" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "version" INT NOT NULL UNIQUE,
+    "kid" VARCHAR(64) NOT NULL UNIQUE,
+    "private_key" TEXT NOT NULL,
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP
+);
+COMMENT ON TABLE "eva_signing_key" IS 'JWT 签名密钥，version 最大的用于签发，见 app.utils.keystore.DatabaseKeyStore';
+-- downgrade --
+DROP TABLE IF EXISTS "eva_signing_key";
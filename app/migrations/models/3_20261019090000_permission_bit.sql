@@ -0,0 +1,9 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "eva_permission_bit" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "bit" INT NOT NULL UNIQUE,
+    "code" VARCHAR(128) NOT NULL UNIQUE
+);
+COMMENT ON TABLE "eva_permission_bit" IS '权限 code 在权限位索引中的位置，只追加不删除';
+-- downgrade --
+DROP TABLE IF EXISTS "eva_permission_bit";
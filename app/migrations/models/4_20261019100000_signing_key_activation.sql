@@ -0,0 +1,5 @@
+-- upgrade --
+ALTER TABLE "eva_signing_key" ADD "activates_at" DOUBLE PRECISION NOT NULL  DEFAULT 0;
+COMMENT ON COLUMN "eva_signing_key"."activates_at" IS '开始用于签发的 Unix 时间戳，之前只用于校验';
+-- downgrade --
+ALTER TABLE "eva_signing_key" DROP COLUMN "activates_at";
@@ -1,15 +1,89 @@
 import enum
 import uuid
 from datetime import datetime
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple, Type
 
+from pypika import Table
 from tortoise import fields, models
 from tortoise.fields import ForeignKeyNullableRelation as Fkn
 from tortoise.fields import ForeignKeyRelation as Fk
 from tortoise.fields import ManyToManyRelation as M2m
 from tortoise.fields import ReverseRelation as Rv
 
+from app.controllers import EvaException
 from app.core import config
 from app.utils import encrypt
+from app.utils.cache import TTLCache
+from app.utils.invalidation import invalidation_bus
+
+# 用户 uuid -> 该用户拥有的全部权限 code，角色或权限变更时通过 invalidation_bus 发布 "permissions" 使其失效
+permission_cache = TTLCache(
+    maxsize=config.settings.permission_cache_size,
+    ttl=config.settings.permission_cache_ttl.total_seconds(),
+    name="permissions",
+)
+invalidation_bus.subscribe(
+    "permissions", lambda key: permission_cache.clear() if key is None else permission_cache.pop(uuid.UUID(key))
+)
+
+
+# 用户 uuid -> IdentitySnapshot，供刷新 token 使用；身份变更时通过 invalidation_bus 发布 "identities" 使其失效，
+# 未能及时收到失效消息时，停用最迟在 ttl 之后生效
+identity_snapshot_cache = TTLCache(
+    maxsize=config.settings.identity_snapshot_cache_size,
+    ttl=config.settings.identity_snapshot_cache_ttl.total_seconds(),
+    name="identity_snapshots",
+)
+invalidation_bus.subscribe(
+    "identities",
+    lambda key: identity_snapshot_cache.clear() if key is None else identity_snapshot_cache.pop(uuid.UUID(key)),
+)
+
+
+def meta(model: Type[models.Model]) -> models.MetaInfo:
+    """模型的表名、字段和数据库连接，用于直接拼装 SQL 的地方"""
+    return model._meta  # pylint: disable=protected-access
+
+
+class IdentitySnapshot(NamedTuple):
+    is_active: bool
+    role_codes: Tuple[str, ...]
+
+
+async def get_identity_snapshot(identity_uuid: uuid.UUID) -> Optional[IdentitySnapshot]:
+    """读取身份的状态及角色代码，未命中缓存时用一条 LEFT JOIN 查询；身份不存在时返回 None"""
+    snapshot = identity_snapshot_cache.get(identity_uuid)
+    if snapshot is None:
+        rows = await Identity.filter(uuid=identity_uuid).values("is_active", "roles__code")
+        if not rows:
+            return None
+        snapshot = IdentitySnapshot(
+            is_active=bool(rows[0]["is_active"]),
+            role_codes=tuple(row["roles__code"] for row in rows if row["roles__code"] is not None),
+        )
+        identity_snapshot_cache.set(identity_uuid, snapshot)
+    return snapshot
+
+
+async def load_permission_codes(uuids: Iterable[uuid.UUID]) -> Dict[uuid.UUID, FrozenSet[str]]:
+    """批量取出一组用户的权限 code，优先读取 permission_cache，未命中的用户合并为一条查询"""
+    result, missing = {}, []
+    for identity_uuid in set(uuids):
+        codes = permission_cache.get(identity_uuid)
+        if codes is None:
+            missing.append(identity_uuid)
+        else:
+            result[identity_uuid] = codes
+    if missing:
+        fetched: Dict[uuid.UUID, Set[str]] = {identity_uuid: set() for identity_uuid in missing}
+        for row in await Permission.filter(roles__identities__uuid__in=missing).values(
+            "code", "roles__identities__uuid"
+        ):
+            fetched[row["roles__identities__uuid"]].add(row["code"])
+        for identity_uuid, codes in fetched.items():
+            result[identity_uuid] = frozenset(codes)
+            permission_cache.set(identity_uuid, result[identity_uuid])
+    return result
 
 
 class TimestampModelMixin:
@@ -30,13 +104,11 @@ class Identity(TimestampModelMixin, models.Model):
     class Meta:
         table = "eva_identity"
 
+    async def get_permission_codes(self) -> FrozenSet[str]:
+        return (await load_permission_codes([self.uuid]))[self.uuid]
+
     async def has_perm(self, code: str) -> bool:
-        await self.fetch_related("roles__permissions")
-        for role in self.roles:
-            for permission in role.permissions:
-                if permission.code == code:
-                    return True
-        return False
+        return code in await self.get_permission_codes()
 
 
 class IdP(TimestampModelMixin, models.Model):
@@ -104,7 +176,63 @@ class Credential(TimestampModelMixin, models.Model):
 
     class Meta:
         table = "eva_credential"
-        unique_together = ("identity", "identifier")
+        # 第二个索引用于登录时按 (identifier_type, identifier) 查找凭证
+        unique_together = (("identity", "identifier"), ("identifier_type", "identifier"))
+
+    @classmethod
+    async def lookup(cls, identifier_type: IdentifierType, identifier: str) -> Optional["LoginCredential"]:
+        """
+        登录专用：用一条 JOIN 查询取出凭证、全部密码、身份状态及角色代码。
+        ORM 的 values() 无法正确处理 credential -> identity -> roles 的多级关联，这里直接用 pypika 拼装。
+        """
+        field = meta(Identity).fields_map["roles"]
+        credential, password = Table(meta(cls).db_table), Table(meta(Password).db_table)
+        identity, through, role = Table(meta(Identity).db_table), Table(field.through), Table(meta(Role).db_table)
+        db = meta(cls).db
+        query = (
+            db.query_class.from_(credential)
+            .join(identity)
+            .on(identity.id == credential.identity_id)
+            .left_join(password)
+            .on(password.credential_id == credential.id)
+            .left_join(through)
+            .on(through[field.backward_key] == identity.id)
+            .left_join(role)
+            .on(role.id == through[field.forward_key])
+            .select(
+                credential.id,
+                identity.uuid,
+                identity.is_active,
+                password.id.as_("password_id"),
+                password.shadow,
+                password.expires_at,
+                role.code,
+            )
+            .where((credential.identifier_type == identifier_type.value) & (credential.identifier == identifier))
+            .orderby(password.id)
+        )
+        rows = await db.execute_query_dict(str(query))
+        if not rows:
+            return None
+        passwords, role_codes = {}, {}
+        for row in rows:
+            if row["password_id"] is not None and row["password_id"] not in passwords:
+                passwords[row["password_id"]] = Password(
+                    id=row["password_id"],
+                    credential_id=row["id"],
+                    shadow=row["shadow"],
+                    expires_at=meta(Password).fields_map["expires_at"].to_python_value(row["expires_at"]),
+                )
+            if row["code"] is not None:
+                role_codes.setdefault(row["code"])
+        return LoginCredential(
+            credential_id=rows[0]["id"],
+            identifier_type=identifier_type,
+            identity_uuid=meta(Identity).fields_map["uuid"].to_python_value(rows[0]["uuid"]),
+            is_active=bool(rows[0]["is_active"]),
+            passwords=list(passwords.values()),
+            role_codes=list(role_codes),
+        )
 
 
 class Password(TimestampModelMixin, models.Model):
@@ -121,11 +249,15 @@ class Password(TimestampModelMixin, models.Model):
         table = "eva_password"
 
     @classmethod
-    def from_raw(
+    async def from_raw(
         cls, credential: Credential, raw_password: str, permanent=config.settings.password_permanent
     ) -> "Password":
-        expires_at = None if permanent else datetime.utcnow() + config.settings.password_age
-        return Password(credential=credential, shadow=encrypt.encrypt_password(raw_password), expires_at=expires_at)
+        shadow = await encrypt.hashing_pool.encrypt_password(raw_password)
+        return Password(credential=credential, shadow=shadow, expires_at=cls.default_expires_at(permanent))
+
+    @staticmethod
+    def default_expires_at(permanent=config.settings.password_permanent) -> Optional[datetime]:
+        return None if permanent else datetime.utcnow() + config.settings.password_age
 
     @property
     def is_expired(self):
@@ -133,11 +265,41 @@ class Password(TimestampModelMixin, models.Model):
             return False
         return datetime.utcnow() > self.expires_at
 
-    def validate_password(self, raw_password) -> bool:
-        return encrypt.check_password(self.shadow, raw_password)
+    async def validate_password(self, raw_password) -> bool:
+        return await encrypt.hashing_pool.check_password(self.shadow, raw_password)
+
+    async def set_password(self, raw_password):
+        self.shadow = await encrypt.hashing_pool.encrypt_password(raw_password)
+
+    @property
+    def needs_rehash(self) -> bool:
+        return encrypt.needs_rehash(self.shadow)
 
-    def set_password(self, raw_password):
-        self.shadow = encrypt.encrypt_password(raw_password)
+    async def rehash(self, raw_password):
+        """使用当前的 Argon2 参数重新计算哈希；若期间密码已被修改则放弃"""
+        try:
+            shadow = await encrypt.hashing_pool.encrypt_password(raw_password)
+        except EvaException:
+            return  # 哈希线程池繁忙，下次登录时再升级
+        await Password.filter(id=self.id, shadow=self.shadow).update(shadow=shadow)
+        self.shadow = shadow
+
+
+class LoginCredential(NamedTuple):
+    """Credential.lookup 的结果"""
+
+    credential_id: int
+    identifier_type: Credential.IdentifierType
+    identity_uuid: uuid.UUID
+    is_active: bool
+    passwords: List[Password]
+    role_codes: List[str]
+
+    async def match_password(self, raw_password: str) -> Optional[Password]:
+        for pwd in self.passwords:
+            if await pwd.validate_password(raw_password):
+                return pwd
+        return None
 
 
 class SecurityCode(TimestampModelMixin, models.Model):
@@ -198,3 +360,31 @@ class Permission(TimestampModelMixin, models.Model):
 
     class Meta:
         table = "eva_permission"
+
+
+class PermissionBit(models.Model):
+    """
+    权限 code 在权限位索引中的位置，只追加不删除：权限删除后其位保留为空位，不会分配给其他权限，
+    已签发 token 中的掩码始终可以按最新的索引解码，见 app.utils.permission_index
+    """
+
+    id = fields.IntField(pk=True)
+    bit = fields.IntField(unique=True)
+    code = fields.CharField(max_length=128, unique=True)
+
+    class Meta:
+        table = "eva_permission_bit"
+
+
+class SigningKey(models.Model):
+    """JWT 签名密钥，已生效的密钥中 version 最大的用于签发，见 app.utils.keystore.DatabaseKeyStore"""
+
+    id = fields.IntField(pk=True)
+    version = fields.IntField(unique=True)
+    kid = fields.CharField(max_length=64, unique=True)
+    private_key = fields.TextField()
+    activates_at = fields.FloatField(default=0, description="开始用于签发的 Unix 时间戳，之前只用于校验")
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "eva_signing_key"
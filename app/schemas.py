@@ -1,10 +1,63 @@
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 from uuid import UUID
 
 import pydantic
 from pydantic import Field
-
-from app.models import Credential, Identity
+from tortoise.exceptions import DoesNotExist
+from tortoise.queryset import QuerySet
+
+from app.models import Credential, Identity, Role
+
+
+def single(items: list):
+    if not items:
+        raise DoesNotExist("Object does not exist")
+    return items[0]
+
+
+async def project_roles(queryset: QuerySet) -> List[Dict[str, Any]]:
+    """用一条 LEFT JOIN 查询取出 queryset 中的角色及其权限代码，返回 RoleDetail 形状（另带 id）的 dict，按 id 排序"""
+    roles: Dict[int, Dict[str, Any]] = {}
+    for row in await queryset.order_by("id").values("id", "code", "name", "description", "permissions__code"):
+        role = roles.setdefault(
+            row["id"],
+            {
+                "id": row["id"],
+                "code": row["code"],
+                "name": row["name"],
+                "description": row["description"],
+                "permission_codes": [],
+            },
+        )
+        if row["permissions__code"] is not None:
+            role["permission_codes"].append(row["permissions__code"])
+    return list(roles.values())
+
+
+async def project_identities(queryset: QuerySet) -> List[Dict[str, Any]]:
+    """
+    取出 queryset 中身份的 IdentityDetail 形状（另带 id）的 dict，按 id 排序：
+    一条 LEFT JOIN 查询取身份及其角色，一条查询取全部凭证，查询次数与身份数量无关。
+    queryset 不能带 limit/offset（JOIN 后行数会变化），分页时先取出本页 id 再传入 filter(id__in=...)。
+    """
+    identities: Dict[int, Dict[str, Any]] = {}
+    for row in await queryset.order_by("id").values("id", "uuid", "is_active", "roles__code", "roles__name"):
+        identity = identities.setdefault(
+            row["id"],
+            {"id": row["id"], "uuid": row["uuid"], "roles": [], "is_active": row["is_active"], "credentials": []},
+        )
+        if row["roles__code"] is not None:
+            identity["roles"].append({"code": row["roles__code"], "name": row["roles__name"]})
+    if identities:
+        for row in (
+            await Credential.filter(identity_id__in=list(identities))
+            .order_by("id")
+            .values("identity_id", "identifier", "identifier_type")
+        ):
+            identities[row["identity_id"]]["credentials"].append(
+                {"identifier": row["identifier"], "identifier_type": Credential.IdentifierType(row["identifier_type"])}
+            )
+    return list(identities.values())
 
 
 class Schema(pydantic.BaseModel):
@@ -12,6 +65,11 @@ class Schema(pydantic.BaseModel):
         orm_mode = True
         anystr_strip_whitespace = True
 
+    @classmethod
+    def pick(cls, item: Dict[str, Any]) -> Dict[str, Any]:
+        """从可信的 dict（如 values() 或 project_* 的结果）中按字段取值，不做校验，用于直接返回 ORJSONResponse"""
+        return {name: item[name] for name in cls.__fields__}
+
 
 class PermissionSimple(Schema):
     code: str = Field(max_length=128)
@@ -41,13 +99,16 @@ class RoleDetail(RoleSimple):
     permission_codes: List[str]
 
     @classmethod
-    async def from_object(cls, role):
-        return RoleDetail(
-            code=role.code,
-            name=role.name,
-            description=role.description,
-            permission_codes=await role.permissions.all().values_list("code", flat=True),
-        )
+    async def from_queryset(cls, queryset: QuerySet) -> List["RoleDetail"]:
+        return [cls(**item) for item in await project_roles(queryset)]
+
+    @classmethod
+    async def from_queryset_single(cls, queryset: QuerySet) -> "RoleDetail":
+        return single(await cls.from_queryset(queryset))
+
+    @classmethod
+    async def from_object(cls, role: Role):
+        return await cls.from_queryset_single(Role.filter(id=role.id))
 
 
 class RoleCreate(RoleSimple):
@@ -81,6 +142,16 @@ class IdentityCreate(Schema):
     credentials: List[CredentialCreate]
 
 
+class CredentialImport(CredentialCreate):
+    password_shadow: Optional[str] = Field(None, description="已有的 Argon2 哈希，如从旧系统迁移")
+
+
+class IdentityImport(Schema):
+    role_codes: Optional[List[str]]
+    is_active: bool = True
+    credentials: List[CredentialImport]
+
+
 class IdentityUpdate(Schema):
     roles: Optional[List[RoleSimple]]
     is_active: Optional[bool]
@@ -93,27 +164,58 @@ class IdentityDetail(Schema):
     is_active: bool = True
     credentials: List[CredentialSimple]
 
+    @classmethod
+    async def from_queryset(cls, queryset: QuerySet) -> List["IdentityDetail"]:
+        return [cls(**item) for item in await project_identities(queryset)]
+
+    @classmethod
+    async def from_queryset_single(cls, queryset: QuerySet) -> "IdentityDetail":
+        return single(await cls.from_queryset(queryset))
+
     @classmethod
     async def from_object(cls, identity: Identity):
-        await identity.fetch_related("roles", "credentials")
-        return IdentityDetail(
-            uuid=identity.uuid,
-            roles=[
-                RoleSimple(
-                    code=role.code,
-                    name=role.name,
-                )
-                for role in identity.roles
-            ],
-            is_active=identity.is_active,
-            credentials=[
-                CredentialSimple(
-                    identifier=credential.identifier,
-                    identifier_type=credential.identifier_type,
-                )
-                for credential in identity.credentials
-            ],
-        )
+        return await cls.from_queryset_single(Identity.filter(id=identity.id))
+
+
+class IdentitySelector(Schema):
+    """批量操作选择的身份，多个条件同时满足；至少指定一个条件"""
+
+    uuids: Optional[List[UUID]] = Field(None, max_items=100000)
+    is_active: Optional[bool]
+    role_code: Optional[str] = Field(None, description="拥有该角色的身份")
+
+    @pydantic.root_validator(skip_on_failure=True)
+    def check_not_empty(cls, values):
+        if all(values.get(name) is None for name in ("uuids", "is_active", "role_code")):
+            raise ValueError("at least one of uuids, is_active and role_code is required")
+        return values
+
+
+class BulkRoleAssignment(Schema):
+    identities: IdentitySelector
+    role_codes: List[str] = Field(..., min_items=1)
+
+
+class BulkPermissionGrant(Schema):
+    role_codes: List[str] = Field(..., min_items=1)
+    permission_codes: List[str] = Field(..., min_items=1)
+
+
+class BulkResult(Schema):
+    affected: int = Field(..., description="新增或删除的关联数")
+
+
+class AuthzCheck(Schema):
+    subject: UUID
+    permission: str
+
+
+class AuthzCheckRequest(Schema):
+    checks: List[AuthzCheck] = Field(..., max_items=1000)
+
+
+class AuthzCheckResult(Schema):
+    results: List[bool] = Field(..., description="与 checks 一一对应")
 
 
 class JSONWenKeySet(Schema):
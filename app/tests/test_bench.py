@@ -0,0 +1,58 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.bench import runner
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert runner.percentile(values, 50) == 50
+    assert runner.percentile(values, 99) == 99
+    assert runner.percentile([3.0], 95) == 3
+    assert runner.percentile([], 95) == 0
+
+
+def test_compare_with_baseline():
+    baseline = {"results": {"jwks": {"p95_ms": 1.0, "rps": 1000, "queries_per_request": 0}}}
+    same = {"results": {"jwks": {"p95_ms": 1.1, "rps": 900, "queries_per_request": 0}}}
+    assert runner.compare(same, baseline) == []
+    worse = {"results": {"jwks": {"p95_ms": 2.0, "rps": 500, "queries_per_request": 1}}}
+    assert len(runner.compare(worse, baseline)) == 3
+    assert runner.compare({"results": {}}, baseline) == []
+
+
+def test_bench_run(tmp_path):
+    db = tmp_path / "bench.sqlite3"
+    report = asyncio.get_event_loop().run_until_complete(
+        runner.run(
+            db_url=f"sqlite://{db}",
+            scenarios=["token_refresh", "identity_detail", "role_list"],
+            requests=5,
+            concurrency=2,
+            warmup=1,
+            identities=5,
+        )
+    )
+    assert report["meta"]["db"] == "sqlite"
+    assert set(report["results"]) == {"token_refresh", "identity_detail", "role_list"}
+    for result in report["results"].values():
+        assert result["errors"] == 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+    assert report["results"]["identity_detail"]["queries_per_request"] == 2
+    # 压测数据在结束时被删除
+    with sqlite3.connect(str(db)) as conn:
+        tables = ("eva_identity", "eva_credential", "eva_password", "eva_role", "eva_permission")
+        assert [conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables] == [0] * 5
+
+
+def test_bench_hydra_flow():
+    report = asyncio.get_event_loop().run_until_complete(
+        runner.run(scenarios=[runner.HYDRA_FLOW], requests=3, concurrency=2, warmup=0, identities=3, hydra_latency=0.01)
+    )
+    result = report["results"][runner.HYDRA_FLOW]
+    assert result["errors"] == 0
+    assert result["hydra_calls_per_request"] == 5
+    assert result["hydra_ms"] >= 50
+    assert result["hydra_ms"] + result["eva_ms"] == pytest.approx(result["mean_ms"], abs=0.01)
@@ -0,0 +1,39 @@
+import time
+
+from app.utils.cache import TTLCache, cache_entries, cache_requests
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1, ttl=0.01)
+    cache.set("b", 2)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+    cache.pop("b")
+    assert cache.get("b") is None
+
+
+def test_ttl_cache_metrics():
+    cache = TTLCache(maxsize=2, ttl=60, name="test")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.get("c")
+    cache.pop("b")
+    assert cache_requests.labels(cache="test", result="hit").value == 1
+    assert cache_requests.labels(cache="test", result="miss").value == 1
+    assert cache_entries.labels(cache="test").value == 1
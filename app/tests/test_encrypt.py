@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from argon2 import PasswordHasher, Type
+
+from app.controllers import EvaException
+from app.models import Credential, Identity, Password
+from app.utils.encrypt import HashingPool, calibrate
+
+
+def test_hashing_pool_workers_bounded_by_memory_budget():
+    pool = HashingPool(memory_budget=300, memory_cost=100, queue_depth=0, max_workers=8)
+    assert pool.max_workers == 3
+    pool = HashingPool(memory_budget=50, memory_cost=100, queue_depth=0, max_workers=8)
+    assert pool.max_workers == 1
+
+
+def test_hashing_pool(event_loop):
+    pool = HashingPool(memory_budget=1024 * 1024, memory_cost=1024, queue_depth=0, max_workers=1)
+
+    async def run():
+        shadow = await pool.encrypt_password("1234")
+        assert await pool.check_password(shadow, "1234")
+        assert not await pool.check_password(shadow, "12345")
+
+    event_loop.run_until_complete(run())
+    pool.shutdown()
+
+
+def test_hashing_pool_rejects_when_queue_full(event_loop):
+    pool = HashingPool(memory_budget=1024 * 1024, memory_cost=1024, queue_depth=0, max_workers=1)
+
+    async def run():
+        first = asyncio.ensure_future(pool.encrypt_password("1234"))
+        await asyncio.sleep(0)
+        with pytest.raises(EvaException) as exc_info:
+            await pool.encrypt_password("1234")
+        assert exc_info.value.status_code == 503
+        await first
+
+    event_loop.run_until_complete(run())
+    pool.shutdown()
+
+
+def test_hashing_pool_bounds_bulk_hashing(event_loop):
+    pool = HashingPool(memory_budget=1024 * 1024, memory_cost=1024, queue_depth=0, max_workers=4)
+    assert pool.bulk_workers == 2
+    in_flight = []
+
+    async def run():
+        shadow = await pool.encrypt_password("1234")
+        bulk = asyncio.ensure_future(pool.encrypt_passwords(["1234"] * 8))
+        await asyncio.sleep(0)
+        # 批量哈希运行期间交互请求仍能通过准入
+        assert await pool.check_password(shadow, "1234")
+        while not bulk.done():
+            in_flight.append(pool.pending)
+            await asyncio.sleep(0.001)
+        assert len(await bulk) == 8
+
+    event_loop.run_until_complete(run())
+    assert max(in_flight) == 2
+    pool.shutdown()
+
+
+def test_calibrate():
+    params = calibrate(target=5, max_memory_cost=64, parallelism=1, samples=2)
+    assert params["parallelism"] == 1
+    assert params["memory_cost"] == 64
+    assert params["time_cost"] >= 1
+    assert params["latency"] <= 5
+
+
+def test_rehash_on_login(client, event_loop):
+    stale_hasher = PasswordHasher(time_cost=1, memory_cost=64, parallelism=1, type=Type.ID)
+
+    async def create_stale_identity():
+        identity = await Identity.create()
+        credential = await Credential.create(
+            identity=identity, identifier_type=Credential.IdentifierType.USERNAME, identifier="stale"
+        )
+        return await Password.create(credential=credential, shadow=stale_hasher.hash("1234"))
+
+    pwd = event_loop.run_until_complete(create_stale_identity())
+    assert pwd.needs_rehash
+
+    resp = client.post("/token/obtain", json={"identifier_type": "USERNAME", "identifier": "stale", "password": "1234"})
+    assert resp.status_code == 200, resp.text
+
+    pwd = event_loop.run_until_complete(Password.get(id=pwd.id))
+    assert not pwd.needs_rehash
+    assert event_loop.run_until_complete(pwd.validate_password("1234"))
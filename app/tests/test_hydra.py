@@ -0,0 +1,43 @@
+from httpx import AsyncClient
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+
+from app.utils.hydra_cli import HydraAdmin, hydra_admin_latency
+
+
+def flaky_hydra(failures: int):
+    hydra = Starlette()
+    calls = []
+
+    async def get_login_request(request):
+        calls.append(request.query_params["login_challenge"])
+        if len(calls) <= failures:
+            return JSONResponse({"error": "unavailable"}, status_code=503)
+        return JSONResponse({"skip": False, "challenge": request.query_params["login_challenge"]})
+
+    hydra.add_route("/oauth2/auth/requests/login", get_login_request)
+    return hydra, calls
+
+
+def test_hydra_admin_retries_idempotent_get(event_loop):
+    hydra, calls = flaky_hydra(failures=2)
+    observed = hydra_admin_latency.labels(method="get_login_request").count
+
+    async def run():
+        async with AsyncClient(app=hydra, base_url="http://hydra") as client:
+            return await HydraAdmin(client, retries=2).get_login_request("challenge")
+
+    assert event_loop.run_until_complete(run()) == {"skip": False, "challenge": "challenge"}
+    assert calls == ["challenge"] * 3
+    assert hydra_admin_latency.labels(method="get_login_request").count == observed + 3
+
+
+def test_hydra_admin_gives_up_after_retries(event_loop):
+    hydra, calls = flaky_hydra(failures=5)
+
+    async def run():
+        async with AsyncClient(app=hydra, base_url="http://hydra") as client:
+            return await HydraAdmin(client, retries=1).get_login_request("challenge")
+
+    assert event_loop.run_until_complete(run()) == {"error": "unavailable"}
+    assert len(calls) == 2
@@ -0,0 +1,107 @@
+import json
+
+from argon2 import PasswordHasher
+
+from app import schemas
+from app.models import Credential, Identity, Password, Role
+
+
+def post_import(client, body: str, content_type="application/x-ndjson", **params):
+    resp = client.post(
+        "/api/identity/import", data=body.encode(), headers={"Content-Type": content_type}, params=params
+    )
+    assert resp.status_code == 200, resp.text
+    return [json.loads(line) for line in resp.text.splitlines()]
+
+
+def test_import_ndjson(client, event_loop):
+    event_loop.run_until_complete(Role.create(code="member", name="Member"))
+    shadow = PasswordHasher(time_cost=1, memory_cost=64, parallelism=1).hash("legacy")
+    rows = [
+        {
+            "role_codes": ["member"],
+            "credentials": [{"identifier_type": "USERNAME", "identifier": "a", "password": "1"}],
+        },
+        {"credentials": [{"identifier_type": "EMAIL", "identifier": "b@eva.io", "password_shadow": shadow}]},
+        "not json",
+        {"role_codes": ["missing"], "credentials": [{"identifier_type": "USERNAME", "identifier": "c"}]},
+        {"credentials": [{"identifier_type": "USERNAME", "identifier": "a", "password": "2"}]},
+        {"credentials": [{"identifier_type": "USERNAME", "identifier": "d", "password_shadow": "plain"}]},
+        {"is_active": False, "credentials": [{"identifier_type": "PHONE", "identifier": "123"}]},
+    ]
+    body = "\n".join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+    results = post_import(client, body, chunk_size=3)
+
+    assert [r["line"] for r in results] == [1, 2, 3, 4, 5, 6, 7]
+    assert [("uuid" in r) for r in results] == [True, True, False, False, False, False, True]
+    assert "roles ['missing'] not found" in results[3]["error"]
+    assert "already exists" in results[4]["error"]
+    assert "not a valid argon2 hash" in results[5]["error"]
+
+    async def check():
+        assert await Identity.all().count() == 3
+        assert await Credential.all().count() == 3
+        assert await Password.all().count() == 2
+        identity = await Identity.get(uuid=results[0]["uuid"]).prefetch_related("roles")
+        assert [r.code for r in identity.roles] == ["member"]
+        assert not (await Identity.get(uuid=results[6]["uuid"])).is_active
+
+    event_loop.run_until_complete(check())
+
+    for identifier_type, identifier, password in (("USERNAME", "a", "1"), ("EMAIL", "b@eva.io", "legacy")):
+        resp = client.post(
+            "/token/obtain",
+            json={"identifier_type": identifier_type, "identifier": identifier, "password": password},
+        )
+        assert resp.status_code == 200, resp.text
+
+
+def test_import_csv(client, event_loop):
+    event_loop.run_until_complete(Role.create(code="member", name="Member"))
+    body = "\n".join(
+        [
+            "identifier_type,identifier,password,role_codes,is_active",
+            "USERNAME,a,1,member,true",
+            "EMAIL,b@eva.io,,,false",
+            "UNKNOWN,c,,,",
+        ]
+    )
+    results = post_import(client, body, content_type="text/csv")
+    assert [("uuid" in r) for r in results] == [True, True, False]
+    assert results[2]["line"] == 4
+    assert "identifier_type" in results[2]["error"]
+    assert event_loop.run_until_complete(Identity.filter(is_active=True).count()) == 1
+
+
+def test_export(client, event_loop):
+    event_loop.run_until_complete(Role.create(code="member", name="Member"))
+    body = "\n".join(
+        json.dumps({"role_codes": roles, "is_active": active, "credentials": credentials})
+        for roles, active, credentials in (
+            (["member"], True, [{"identifier_type": "USERNAME", "identifier": "a"}]),
+            (None, False, [{"identifier_type": "EMAIL", "identifier": "b@eva.io"}]),
+            (
+                ["member"],
+                True,
+                [{"identifier_type": "USERNAME", "identifier": "c"}, {"identifier_type": "PHONE", "identifier": "1"}],
+            ),
+        )
+    )
+    imported = post_import(client, body)
+
+    resp = client.get("/api/identity/export", params={"batch_size": 2})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in resp.text.splitlines()]
+    assert [e["uuid"] for e in exported] == [r["uuid"] for r in imported]
+    assert exported[0]["roles"] == [{"code": "member", "name": "Member"}]
+    assert exported[1]["roles"] == [] and exported[1]["is_active"] is False
+    assert exported[2]["credentials"] == [
+        {"identifier": "c", "identifier_type": "USERNAME"},
+        {"identifier": "1", "identifier_type": "PHONE"},
+    ]
+    for item in exported:
+        schemas.IdentityDetail.parse_obj(item)
+
+    resp = client.get("/api/identity/export", params={"is_active": False})
+    assert [json.loads(line)["uuid"] for line in resp.text.splitlines()] == [imported[1]["uuid"]]
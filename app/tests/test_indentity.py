@@ -1,7 +1,19 @@
+import asyncio
+import os
 from datetime import datetime, timedelta
 from typing import List
+from uuid import UUID
 
-from app.models import Credential, Identity, Password, Permission, Role
+import pytest
+from tortoise import Tortoise
+
+from app import schemas
+from app.models import Credential, Identity, Password, Permission, Role, permission_cache
+from app.utils import bulk_rbac
+from app.utils.queries import max_queries
+
+# 指向一个尚不存在的 PostgreSQL 数据库，测试时创建并在结束后删除
+TEST_POSTGRES_DSN = os.environ.get("TEST_POSTGRES_DSN")
 
 
 async def create_permissions(codes: List[str]):
@@ -91,6 +103,14 @@ def test_roles(client, event_loop):
 
     resp = client.get("/api/role")
     assert len(resp.json()["results"]) == 2
+    assert "permission_codes" not in resp.json()["results"][0]
+
+    resp = client.get("/api/role/detail", params={"order_by": "id"})
+    assert resp.status_code == 200, resp.text
+    assert [(r["code"], r["permission_codes"]) for r in resp.json()["results"]] == [
+        ("fake_code", []),
+        ("fake_code2", ["code1", "code2"]),
+    ]
 
     resp = client.delete("/api/role/fake_code")
     assert resp.status_code == 200
@@ -177,6 +197,17 @@ def test_identity(client):
     assert len(resp.json()["results"]) == 1
 
     uid = resp.json()["results"][0]["uuid"]
+    resp = client.get("/api/identity/detail")
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["results"] == [
+        {
+            "uuid": uid,
+            "roles": [{"code": "fake_code", "name": "fake_name"}],
+            "is_active": True,
+            "credentials": [{"identifier": "test@123.com", "identifier_type": "EMAIL"}],
+        }
+    ]
+
     resp = client.get(f"/api/identity/{uid}")
     assert resp.status_code == 200, resp.text
     resp = resp.json()
@@ -210,6 +241,43 @@ def test_identity(client):
     assert resp.status_code == 404, resp.text
 
 
+def test_create_identity(client, event_loop):
+    client.post("/api/role", json={"code": "staff", "name": "staff"})
+    with max_queries(10):
+        resp = client.post(
+            "/api/identity",
+            json={
+                "role_codes": ["staff"],
+                "credentials": [
+                    {"identifier": "tester", "identifier_type": "USERNAME", "password": "1234"},
+                    {"identifier": "tester@eva.com", "identifier_type": "EMAIL", "password": "5678"},
+                    {"identifier": "13800000000", "identifier_type": "PHONE"},
+                ],
+            },
+        )
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["roles"] == [{"code": "staff", "name": "staff"}]
+    assert len(resp.json()["credentials"]) == 3
+    assert event_loop.run_until_complete(Password.all().count()) == 2
+    # 每个密码写到各自的凭证上
+    owners = event_loop.run_until_complete(Password.all().values_list("credential__identifier_type", flat=True))
+    assert sorted(Credential.IdentifierType(t).value for t in owners) == ["EMAIL", "USERNAME"]
+
+    resp = client.post(
+        "/api/identity",
+        json={
+            "credentials": [
+                {"identifier": "other", "identifier_type": "USERNAME", "password": "1234"},
+                {"identifier": "tester@eva.com", "identifier_type": "EMAIL", "password": "1234"},
+            ]
+        },
+    )
+    assert resp.status_code == 400
+    assert resp.json()["message"] == "credential EMAIL tester@eva.com already exists"
+    assert event_loop.run_until_complete(Identity.all().count()) == 1
+    assert event_loop.run_until_complete(Credential.all().count()) == 3
+
+
 def test_identity_permissions(event_loop):
     async def test_has_perm():
         perm = Permission(code="perm_code", name="perm_name")
@@ -226,13 +294,159 @@ def test_identity_permissions(event_loop):
     event_loop.run_until_complete(test_has_perm())
 
 
+def test_permission_cache_invalidation(client, event_loop):
+    async def setup():
+        await create_permissions(["code1", "code2"])
+        role = Role(code="role_code", name="role_name")
+        await role.save()
+        await role.permissions.add(*await Permission.filter(code="code1"))
+        identity = Identity()
+        await identity.save()
+        await identity.roles.add(role)
+        return identity
+
+    identity = event_loop.run_until_complete(setup())
+    assert event_loop.run_until_complete(identity.has_perm("code1"))
+    hits = permission_cache.hits
+    assert not event_loop.run_until_complete(identity.has_perm("code2"))
+    assert permission_cache.hits == hits + 1
+
+    resp = client.patch("/api/role/role_code", json={"permission_codes": ["code1", "code2"]})
+    assert resp.status_code == 200, resp.text
+    assert event_loop.run_until_complete(identity.has_perm("code2"))
+
+    resp = client.patch(f"/api/identity/{identity.uuid}", json={"roles": []})
+    assert resp.status_code == 200, resp.text
+    assert not event_loop.run_until_complete(identity.has_perm("code1"))
+
+
+def test_authz_check(client, event_loop):
+    async def setup():
+        await create_permissions(["code1", "code2"])
+        role = await Role.create(code="role_code", name="role_name")
+        await role.permissions.add(*await Permission.filter(code="code1"))
+        member, outsider = await Identity.create(), await Identity.create()
+        await member.roles.add(role)
+        return str(member.uuid), str(outsider.uuid)
+
+    member, outsider = event_loop.run_until_complete(setup())
+    unknown = "00000000-0000-0000-0000-000000000000"
+    checks = [
+        {"subject": member, "permission": "code1"},
+        {"subject": member, "permission": "code2"},
+        {"subject": outsider, "permission": "code1"},
+        {"subject": unknown, "permission": "code1"},
+        {"subject": member, "permission": "code1"},
+    ]
+    resp = client.post("/api/authz/check", json={"checks": checks})
+    assert resp.status_code == 200, resp.text
+    assert resp.json() == {"results": [True, False, False, False, True]}
+
+    hits = permission_cache.hits
+    resp = client.post("/api/authz/check", json={"checks": checks[:3]})
+    assert resp.json() == {"results": [True, False, False]}
+    assert permission_cache.hits == hits + 2
+
+
 def test_password(event_loop):
     async def test_pwd():
-        pwd = Password.from_raw(None, "1234", permanent=True)
+        pwd = await Password.from_raw(None, "1234", permanent=True)
         assert not pwd.is_expired
         pwd.expires_at = datetime.utcnow() - timedelta(days=1)
         assert pwd.is_expired
-        assert pwd.validate_password("1234")
-        assert not pwd.validate_password("12345")
+        assert await pwd.validate_password("1234")
+        assert not await pwd.validate_password("12345")
 
     event_loop.run_until_complete(test_pwd())
+
+
+def test_bulk_role_assignment(client):
+    for code in ("a", "b", "staff"):
+        client.post("/api/role", json={"code": code, "name": code})
+    uuids = []
+    for i in range(4):
+        resp = client.post(
+            "/api/identity",
+            json={
+                "role_codes": ["staff"] if i < 2 else [],
+                "is_active": i != 3,
+                "credentials": [{"identifier": f"u{i}", "identifier_type": "USERNAME", "password": "p"}],
+            },
+        )
+        uuids.append(resp.json()["uuid"])
+    permission_cache.set(UUID(uuids[0]), frozenset())
+
+    def roles_of(uuid):
+        return sorted(role["code"] for role in client.get(f"/api/identity/{uuid}").json()["roles"])
+
+    with max_queries(5):
+        resp = client.post(
+            "/api/identity/roles/assign", json={"identities": {"is_active": True}, "role_codes": ["a", "b"]}
+        )
+    assert resp.json() == {"affected": 6}
+    assert [roles_of(uuid) for uuid in uuids] == [["a", "b", "staff"], ["a", "b", "staff"], ["a", "b"], []]
+    assert permission_cache.get(UUID(uuids[0])) is None
+
+    resp = client.post(
+        "/api/identity/roles/assign", json={"identities": {"uuids": uuids[2:]}, "role_codes": ["a", "b"]}
+    )
+    assert resp.json() == {"affected": 2}
+
+    resp = client.post("/api/identity/roles/revoke", json={"identities": {"role_code": "staff"}, "role_codes": ["b"]})
+    assert resp.json() == {"affected": 2}
+    assert [roles_of(uuid) for uuid in uuids] == [["a", "staff"], ["a", "staff"], ["a", "b"], ["a", "b"]]
+
+    resp = client.post("/api/identity/roles/assign", json={"identities": {"is_active": True}, "role_codes": ["x"]})
+    assert resp.status_code == 400
+    assert resp.json()["message"] == "specified roles ['x'] not found"
+    resp = client.post("/api/identity/roles/assign", json={"identities": {}, "role_codes": ["a"]})
+    assert resp.status_code == 422
+
+
+@pytest.mark.skipif(not TEST_POSTGRES_DSN, reason="TEST_POSTGRES_DSN is not set")
+def test_bulk_rbac_counts_on_postgres():
+    """PostgreSQL 下 INSERT ... SELECT 的行数由 CTE 计数得到，只能在真实的数据库上验证"""
+
+    async def run():
+        await Tortoise.init(db_url=TEST_POSTGRES_DSN, modules={"models": ["app.models"]}, _create_db=True)
+        try:
+            await Tortoise.generate_schemas()
+            await Role.bulk_create([Role(code=code, name=code) for code in ("a", "b")])
+            await Permission.bulk_create([Permission(code=code, name=code) for code in ("p1", "p2")])
+            for i in range(3):
+                await Identity.create(is_active=i != 2)
+            selector = schemas.IdentitySelector(is_active=True)
+            return [
+                await bulk_rbac.assign_roles(selector, ["a", "b"]),
+                await bulk_rbac.assign_roles(selector, ["a"]),
+                await bulk_rbac.revoke_roles(selector, ["b"]),
+                await bulk_rbac.grant_permissions(["a", "b"], ["p1", "p2"]),
+                await bulk_rbac.grant_permissions(["a"], ["p1"]),
+                await bulk_rbac.revoke_permissions(["a"], ["p1", "p2"]),
+            ]
+        finally:
+            await Tortoise._drop_databases()  # pylint: disable=protected-access
+
+    assert asyncio.new_event_loop().run_until_complete(run()) == [4, 0, 2, 4, 0, 2]
+
+
+def test_bulk_permission_grant(client, event_loop):
+    event_loop.run_until_complete(create_permissions(["p1", "p2", "p3"]))
+    for code in ("r1", "r2"):
+        client.post("/api/role", json={"code": code, "name": code, "permission_codes": ["p1"]})
+
+    def permissions_of(code):
+        return sorted(client.get(f"/api/role/{code}").json()["permission_codes"])
+
+    with max_queries(5):
+        resp = client.post(
+            "/api/role/permissions/grant", json={"role_codes": ["r1", "r2"], "permission_codes": ["p1", "p2", "p3"]}
+        )
+    assert resp.json() == {"affected": 4}
+    assert permissions_of("r1") == permissions_of("r2") == ["p1", "p2", "p3"]
+
+    resp = client.post(
+        "/api/role/permissions/revoke", json={"role_codes": ["r1", "r2"], "permission_codes": ["p1", "p3"]}
+    )
+    assert resp.json() == {"affected": 4}
+    assert permissions_of("r1") == permissions_of("r2") == ["p2"]
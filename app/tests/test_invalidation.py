@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+from app.models import Identity, Permission, Role
+from app.utils.invalidation import Backend, InvalidationBus, MemoryBackend, UnixSocketBackend
+
+
+class RecordingBackend(Backend):
+    def __init__(self, max_payload=None):
+        self.max_payload = max_payload
+        self.sent = []
+
+    async def start(self, on_message):
+        pass
+
+    async def send(self, payload: bytes):
+        self.sent.append(json.loads(payload)["events"])
+
+
+def workers(backends):
+    buses, received = [], []
+    for backend in backends:
+        bus = InvalidationBus(backend, flush_delay=0.01)
+        events = []
+        bus.subscribe("permissions", events.append)
+        buses.append(bus)
+        received.append(events)
+    return buses, received
+
+
+def test_memory_backend_broadcasts_to_other_workers(event_loop):
+    hub = set()
+    (writer, reader), (written, read) = workers([MemoryBackend(hub), MemoryBackend(hub)])
+
+    async def run():
+        await writer.start()
+        await reader.start()
+        writer.publish("permissions", "a")
+        assert written == ["a"] and read == []  # 本进程立即生效，其他进程等待合并后广播
+        await asyncio.sleep(0.05)
+        await writer.close()
+        await reader.close()
+
+    event_loop.run_until_complete(run())
+    assert read == ["a"]
+    assert not hub
+
+
+def test_events_are_coalesced(event_loop):
+    backend = RecordingBackend()
+    bus = InvalidationBus(backend, flush_delay=0.01, max_keys=3)
+
+    async def run():
+        await bus.start()
+        for key in ("a", "b", "a"):
+            bus.publish("permissions", key)
+        bus.publish("permission_index")
+        bus.publish("permission_index")
+        await asyncio.sleep(0.05)
+        for key in ("a", "b", "c", "d"):
+            bus.publish("permissions", key)
+        await asyncio.sleep(0.05)
+        bus.publish("permissions", "a")
+        bus.publish("permissions")
+        bus.publish("permissions", "b")
+        await bus.close()
+
+    event_loop.run_until_complete(run())
+    assert backend.sent == [
+        {"permissions": ["a", "b"], "permission_index": None},
+        {"permissions": None},
+        {"permissions": None},
+    ]
+
+
+def test_oversized_payload_degrades_to_full_invalidation(event_loop):
+    backend = RecordingBackend(max_payload=200)
+    bus = InvalidationBus(backend, flush_delay=0.01)
+
+    async def run():
+        await bus.start()
+        for i in range(20):
+            bus.publish("permissions", f"{i:032d}")
+        await bus.close()
+
+    event_loop.run_until_complete(run())
+    assert backend.sent == [{"permissions": None}]
+
+
+def test_unix_socket_backend(event_loop, tmp_path):
+    (first, second), (_, received) = workers([UnixSocketBackend(str(tmp_path)), UnixSocketBackend(str(tmp_path))])
+    (tmp_path / "0-dead.sock").touch()  # 已退出的 worker 留下的 socket 文件
+
+    async def run():
+        await first.start()
+        await second.start()
+        first.publish("permissions", "a")
+        first.publish("permissions")
+        await asyncio.sleep(0.05)
+        await first.close()
+        await second.close()
+
+    event_loop.run_until_complete(run())
+    assert received == [None]
+    assert not list(tmp_path.iterdir())
+
+
+def test_unix_socket_backend_large_batch(event_loop, tmp_path):
+    (first, second), (_, received) = workers([UnixSocketBackend(str(tmp_path)), UnixSocketBackend(str(tmp_path))])
+
+    async def run():
+        await first.start()
+        await second.start()
+        # 约 75KB 的 payload，超过接收缓冲区
+        for i in range(900):
+            first.publish("permissions", f"{i:080d}")
+        await asyncio.sleep(0.05)
+        await first.close()
+        await second.close()
+
+    event_loop.run_until_complete(run())
+    assert received == [None]
+
+
+def test_admin_writes_publish_invalidation(client, event_loop):
+    async def setup():
+        await Permission.create(code="code1", name="code1")
+        role = await Role.create(code="role_code", name="role_name")
+        identity = await Identity.create()
+        await identity.roles.add(role)
+        return identity
+
+    identity = event_loop.run_until_complete(setup())
+    assert not event_loop.run_until_complete(identity.has_perm("code1"))
+
+    remote = InvalidationBus(MemoryBackend(), flush_delay=0.01)  # 模拟另一个 worker
+    received = []
+    remote.subscribe("permissions", received.append)
+    event_loop.run_until_complete(remote.start())
+
+    resp = client.patch("/api/role/role_code", json={"permission_codes": ["code1"]})
+    assert resp.status_code == 200, resp.text
+    assert event_loop.run_until_complete(identity.has_perm("code1"))
+
+    event_loop.run_until_complete(asyncio.sleep(0.1))
+    event_loop.run_until_complete(remote.close())
+    assert received == [None]
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from tortoise.contrib.test import finalizer, initializer
+
+from app.core.config import settings
+from app.main import create_app
+from app.utils.metrics import Counter, Gauge, Histogram, WorkerSnapshots, registry, render
+from app.utils.middleware import http_request_duration, http_request_queries
+
+
+@pytest.fixture
+def metrics_client(monkeypatch):
+    monkeypatch.setattr(settings, "metrics_enabled", True)
+    initializer(["app.models"])
+    with TestClient(create_app()) as test_client:
+        yield test_client
+    finalizer()
+
+
+def test_render_prometheus_text():
+    counter = Counter("test_render_total", "Counter", labelnames=["kind"])
+    gauge = Gauge("test_render_in_progress", "Gauge")
+    histogram = Histogram("test_render_seconds", "Histogram", buckets=(0.1, 1))
+    try:
+        counter.labels(kind='a"b').inc(2)
+        gauge.labels().inc()
+        histogram.labels().observe(0.05)
+        histogram.labels().observe(0.5)
+        histogram.labels().observe(5)
+        text = render()
+    finally:
+        for metric in (counter, gauge, histogram):
+            registry.remove(metric)
+
+    assert '# TYPE test_render_total counter\ntest_render_total{kind="a\\"b"} 2\n' in text
+    assert "# TYPE test_render_in_progress gauge\ntest_render_in_progress 1\n" in text
+    assert 'test_render_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'test_render_seconds_bucket{le="1"} 2\n' in text
+    assert 'test_render_seconds_bucket{le="+Inf"} 3\n' in text
+    assert "test_render_seconds_sum 5.55\ntest_render_seconds_count 3\n" in text
+
+
+def test_worker_snapshots_are_merged(tmp_path):
+    counter = Counter("test_merge_total", "Counter")
+    gauge = Gauge("test_merge_in_progress", "Gauge")
+    histogram = Histogram("test_merge_seconds", "Histogram", buckets=(0.1, 1))
+    snapshots = WorkerSnapshots(str(tmp_path))
+    try:
+        counter.labels().inc(2)
+        gauge.labels().set(1)
+        histogram.labels().observe(0.05)
+        # 已退出的 worker：计数器和直方图计入总数，瞬时值不计入
+        exited = {
+            "test_merge_total": [[[], {"value": 3}]],
+            "test_merge_in_progress": [[[], {"value": 5}]],
+            "test_merge_seconds": [[[], {"bucket_counts": [0, 1], "count": 2, "sum": 5.5}]],
+        }
+        (tmp_path / "4194305.json").write_text(json.dumps(exited))
+        collected = {metric.name: values[()] for metric, values in snapshots.collect() if metric.name in exited}
+    finally:
+        for metric in (counter, gauge, histogram):
+            registry.remove(metric)
+
+    assert collected["test_merge_total"].value == 5
+    assert collected["test_merge_in_progress"].value == 1
+    assert (collected["test_merge_seconds"].bucket_counts, collected["test_merge_seconds"].count) == ([1, 1], 3)
+    assert counter.labels().value == 2
+
+
+def test_metrics_endpoint_disabled_by_default(client):
+    assert client.get("/metrics").status_code == 404
+
+
+def test_metrics_endpoint_uses_route_templates(metrics_client):
+    client = metrics_client
+    route = "/api/identity/{uuid}"
+    observed = http_request_duration.labels(method="GET", route=route, status=404).count
+    queries = http_request_queries.labels(route=route).sum
+    for _ in range(2):
+        client.get("/api/identity/00000000-0000-0000-0000-000000000000")
+    client.get("/no/such/path")
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert http_request_duration.labels(method="GET", route=route, status=404).count == observed + 2
+    assert http_request_queries.labels(route=route).sum == queries + 2
+    assert 'eva_http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}' in resp.text
+    assert "eva_http_requests_in_progress 1" in resp.text
+    assert "/api/identity/0000" not in resp.text
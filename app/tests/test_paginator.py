@@ -0,0 +1,81 @@
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+
+from app.models import Identity, Permission
+from app.schemas import IdentityDetail, IdentitySimple, project_identities
+from app.utils.paginator import Pagination
+
+
+def create_permissions(event_loop, count: int):
+    permissions = [Permission(code=f"code{i}", name=f"name{i}") for i in range(count)]
+    event_loop.run_until_complete(Permission.bulk_create(permissions))
+
+
+def walk(client, params):
+    codes, url_params = [], dict(params)
+    while True:
+        resp = client.get("/api/permission", params=url_params)
+        assert resp.status_code == 200, resp.text
+        body = resp.json()
+        codes.extend(p["code"] for p in body["results"])
+        if not body["next"]:
+            return codes, body
+        url_params["cursor"] = body["next"]
+
+
+def test_cursor_pagination(client, event_loop):
+    create_permissions(event_loop, 5)
+    expected = [f"code{i}" for i in range(5)]
+
+    codes, last = walk(client, {"limit": 2})
+    assert codes == expected
+    assert last["count"] == 5
+
+    codes, last = walk(client, {"limit": 2, "order_by": "created_at", "count": "none"})
+    assert codes == expected
+    assert last["count"] is None
+
+    resp = client.get("/api/permission", params={"limit": 5, "count": "estimate"})
+    assert resp.json()["count"] == 5
+
+
+def test_offset_pagination(client, event_loop):
+    create_permissions(event_loop, 5)
+    resp = client.get("/api/permission", params={"limit": 2, "offset": 4})
+    assert resp.status_code == 200, resp.text
+    assert [p["code"] for p in resp.json()["results"]] == ["code4"]
+    assert resp.json()["next"] is None
+
+
+def test_invalid_cursor(client, event_loop):
+    create_permissions(event_loop, 2)
+    resp = client.get("/api/permission", params={"limit": 1})
+    cursor = resp.json()["next"]
+    resp = client.get("/api/permission", params={"limit": 1, "cursor": cursor, "order_by": "created_at"})
+    assert resp.status_code == 400, resp.text
+    resp = client.get("/api/permission", params={"cursor": "not-a-cursor"})
+    assert resp.status_code == 400, resp.text
+
+
+def test_fast_path_matches_validated_path(client, event_loop):
+    client.post("/api/role", json={"code": "r", "name": "r"})
+    for i in range(3):
+        client.post(
+            "/api/identity",
+            json={
+                "role_codes": ["r"],
+                "credentials": [{"identifier": f"u{i}", "identifier_type": "EMAIL", "password": "p"}],
+            },
+        )
+
+    async def apply(schema, projection, fast):
+        p = Pagination(limit=2, offset=0, cursor=None, order_by="created_at", count="exact")
+        return await p.apply(Identity.all(), schema, projection=projection, fast=fast)
+
+    for schema, projection in [(IdentitySimple, None), (IdentityDetail, project_identities)]:
+        fast = event_loop.run_until_complete(apply(schema, projection, True))
+        validated = event_loop.run_until_complete(apply(schema, projection, False))
+        assert isinstance(fast, ORJSONResponse)
+        assert orjson.loads(fast.body) == jsonable_encoder(validated)
+        assert orjson.loads(fast.body)["next"] == validated.next is not None
@@ -0,0 +1,72 @@
+import logging
+
+import pytest
+
+from app.core.config import settings
+from app.utils.middleware import repeated_queries
+from app.utils.queries import QueryStats, TooManyQueries, count_queries, max_queries, normalize
+
+
+def create_identities(client, count: int):
+    client.post("/api/role", json={"code": "r", "name": "r"})
+    for i in range(count):
+        resp = client.post(
+            "/api/identity",
+            json={
+                "role_codes": ["r"],
+                "credentials": [{"identifier": f"user{i}", "identifier_type": "USERNAME", "password": "p"}],
+            },
+        )
+        assert resp.status_code == 200, resp.text
+    return resp.json()["uuid"]
+
+
+def test_query_stats():
+    assert normalize("SELECT * FROM t WHERE id=12 AND name='it''s' AND x=$1") == (
+        "SELECT * FROM t WHERE id=? AND name=? AND x=?"
+    )
+    outer = QueryStats()
+    inner = QueryStats(track=True, parent=outer)
+    for i in range(3):
+        inner.add(0.001 * i, f"SELECT * FROM t WHERE id={i}")
+    inner.add(0.0, "SELECT 1")
+    assert (outer.count, inner.count) == (4, 4)
+    assert inner.slowest == "SELECT * FROM t WHERE id=2"
+    assert inner.repeated(3) == [("SELECT * FROM t WHERE id=?", 3)]
+
+
+def test_endpoint_query_budgets(client):
+    """查询数不随结果条数增长"""
+    uid = create_identities(client, 5)
+    budgets = {
+        "/api/identity": 2,
+        "/api/identity/detail": 4,
+        f"/api/identity/{uid}": 2,
+        "/api/role/detail": 3,
+        "/api/permission": 2,
+    }
+    for path, limit in budgets.items():
+        with max_queries(limit):
+            assert client.get(path).status_code == 200
+    with max_queries(1):
+        client.post("/token/obtain", json={"identifier_type": "USERNAME", "identifier": "user1", "password": "p"})
+
+    with pytest.raises(TooManyQueries, match="expected at most 3 queries, got 4"):
+        with max_queries(3):
+            client.get("/api/identity/detail")
+
+
+def test_query_debug_headers_and_repeat_warning(client, monkeypatch, caplog):
+    create_identities(client, 1)
+    assert "X-DB-Query-Count" not in client.get("/api/identity").headers
+
+    monkeypatch.setattr(settings, "query_debug_headers", True)
+    monkeypatch.setattr(settings, "query_repeat_threshold", 1)
+    repeated = repeated_queries.labels(route="/api/identity").value
+    with count_queries() as stats, caplog.at_level(logging.WARNING, logger="app.utils.middleware"):
+        resp = client.get("/api/identity")
+    assert resp.headers["X-DB-Query-Count"] == str(stats.count) == "2"
+    assert float(resp.headers["X-DB-Query-Time"]) > 0
+    assert resp.headers["X-DB-Slowest-Query"].startswith("SELECT")
+    assert repeated_queries.labels(route="/api/identity").value == repeated + 1
+    assert "GET /api/identity executed 1 similar queries, possible N+1" in caplog.text
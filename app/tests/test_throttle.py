@@ -0,0 +1,120 @@
+import sqlite3
+
+import pytest
+from starlette.requests import Request
+
+from app.controllers import EvaException
+from app.utils.throttle import (
+    MAX_RETRY_AFTER,
+    Limit,
+    LoginThrottle,
+    MemoryBackend,
+    SQLiteBackend,
+    login_throttle_rejected,
+)
+
+
+def test_token_bucket():
+    limit = Limit(burst=2, per_minute=60)
+    assert limit.take(2, 0, 0) == (True, 1, 0)
+    assert limit.take(0.5, 0, 0) == (False, 0.5, 0.5)
+    assert limit.take(0, 0, 1.5)[:2] == (True, 0.5)
+    assert limit.take(0, 0, 100)[:2] == (True, 1)  # 最多积攒 burst 个令牌
+
+
+def test_sqlite_backend_is_shared(event_loop, tmp_path):
+    path = str(tmp_path / "throttle.sqlite3")
+    workers = [SQLiteBackend(path), SQLiteBackend(path)]
+    limit = Limit(burst=3, per_minute=0.001)
+
+    async def run():
+        results = [(await workers[i % 2].take("key", limit))[0] for i in range(4)]
+        other = await workers[1].take("other", limit)
+        for worker in workers:
+            await worker.close()
+        return results, other
+
+    results, other = event_loop.run_until_complete(run())
+    assert results == [True, True, True, False]
+    assert other[0]
+
+
+def test_sqlite_backend_lock_timeout(event_loop, tmp_path):
+    path = str(tmp_path / "throttle.sqlite3")
+    backend = SQLiteBackend(path, lock_timeout=0.05)
+    limit = Limit(burst=3, per_minute=1)
+
+    async def run():
+        await backend.take("key", limit)
+        holder = sqlite3.connect(path, isolation_level=None)
+        holder.execute("BEGIN IMMEDIATE")  # 另一个 worker 持有写锁
+        try:
+            with pytest.raises(EvaException) as exc_info:
+                await backend.take("key", limit)
+        finally:
+            holder.execute("ROLLBACK")
+            holder.close()
+        assert (await backend.take("key", limit))[0]
+        await backend.close()
+        return exc_info.value
+
+    err = event_loop.run_until_complete(run())
+    assert (err.status_code, err.headers) == (503, {"Retry-After": "1"})
+
+
+def test_login_throttle_rejects_before_lookup(client):
+    client.app.state.login_throttle = LoginThrottle(
+        MemoryBackend(), identifier_limit=Limit(burst=2, per_minute=1), ip_limit=Limit(burst=3, per_minute=1)
+    )
+    rejected = login_throttle_rejected.labels(scope="identifier").value
+
+    def obtain(identifier):
+        return client.post(
+            "/token/obtain", json={"identifier_type": "USERNAME", "identifier": identifier, "password": "x"}
+        )
+
+    assert [obtain("nobody").status_code for _ in range(3)] == [400, 400, 429]
+    resp = obtain("NOBODY")
+    assert resp.status_code == 429
+    assert 0 < int(resp.headers["Retry-After"]) <= 60
+    assert login_throttle_rejected.labels(scope="identifier").value == rejected + 2
+
+    rejected = login_throttle_rejected.labels(scope="ip").value
+    assert obtain("someone").status_code == 400
+    assert obtain("someone-else").status_code == 429
+    assert login_throttle_rejected.labels(scope="ip").value == rejected + 1
+
+    resp = client.post(
+        "/hydra/login",
+        data={"identifier_type": "USERNAME", "identifier": "another", "password": "x", "challenge": "c"},
+    )
+    assert resp.status_code == 429
+    assert "too many login attempts" in resp.text
+
+
+def test_client_ip_behind_trusted_proxies():
+    throttle = LoginThrottle(
+        MemoryBackend(), Limit(burst=1, per_minute=1), Limit(burst=1, per_minute=1), ["10.0.0.0/8", "127.0.0.1"]
+    )
+
+    def client_ip(host, forwarded=None):
+        headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+        return throttle.client_ip(Request({"type": "http", "client": (host, 1234), "headers": headers}))
+
+    assert client_ip("1.2.3.4", "5.6.7.8") == "1.2.3.4"  # 不可信的来源伪造的头被忽略
+    assert client_ip("10.0.0.1", "5.6.7.8, 9.9.9.9, 10.0.0.2") == "9.9.9.9"
+    assert client_ip("127.0.0.1", "10.0.0.3") == "10.0.0.3"
+    assert client_ip("10.0.0.1") == "10.0.0.1"
+
+
+def test_retry_after_without_refill(event_loop):
+    throttle = LoginThrottle(MemoryBackend(), identifier_limit=Limit(burst=1, per_minute=0), ip_limit=None)
+
+    async def run():
+        await throttle.check("USERNAME", "tester", "1.2.3.4")
+        with pytest.raises(EvaException) as exc_info:
+            await throttle.check("USERNAME", "tester", "1.2.3.4")
+        return exc_info.value
+
+    exc = event_loop.run_until_complete(run())
+    assert exc.headers["Retry-After"] == str(MAX_RETRY_AFTER)
@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+
+import pytest
+from authlib.jose import RSAKey
+
+from app.controllers import EvaException
+from app.core.config import settings
+from app.models import Credential, Identity, Password, Permission, Role, identity_snapshot_cache
+from app.utils import encrypt
+from app.utils.cache import cache_requests
+from app.utils.keyring import KeyRing, key_ring
+from app.utils.keystore import DatabaseKeyStore, FileKeyStore, KeyManager, KeyRecord, MemoryKeyStore, key_manager
+from app.utils.permission_index import PermissionIndex, decode_mask, encode_mask
+from app.utils.token import AuthJWT, auth_jwt
+
+
+def generate_pem():
+    return RSAKey.generate_key(is_private=True).as_pem(is_private=True)
+
+
+def create_identity(identifier: str, password: str):
+    async def create():
+        identity = await Identity.create()
+        credential = await Credential.create(
+            identity=identity, identifier_type=Credential.IdentifierType.USERNAME, identifier=identifier
+        )
+        pwd = await Password.from_raw(credential, password)
+        await pwd.save()
+        return identity
+
+    return create()
+
+
+def test_key_ring_rotation():
+    ring = KeyRing(generate_pem())
+    auth = AuthJWT(keys=ring)
+    claims = {"sub": "someone", "identifier_type": "USERNAME"}
+    old_token = auth.create_access_token(custom_claims=claims)
+    old_kid = ring.kid
+
+    ring.rotate(generate_pem())
+    new_token = auth.create_access_token(custom_claims=claims)
+    assert ring.kid != old_kid
+    assert auth.verify_token(old_token)["sub"] == "someone"
+    assert auth.verify_token(new_token)["sub"] == "someone"
+    assert set(ring.verify_keys) == {old_kid, ring.kid}
+    assert all(key.key_type == "public" for key in ring.verify_keys.values())
+
+    ring.retire(old_kid)
+    with pytest.raises(EvaException) as exc_info:
+        auth.verify_token(old_token)
+    assert exc_info.value.status_code == 403
+    with pytest.raises(ValueError):
+        ring.retire(ring.kid)
+
+
+def test_verified_token_cache():
+    auth = AuthJWT(keys=KeyRing(generate_pem()))
+    claims = {"sub": "someone", "identifier_type": "USERNAME"}
+    token = auth.create_access_token(custom_claims=claims)
+    hits = cache_requests.labels(cache="jwt_verify", result="hit")
+    before = hits.value
+    assert auth.verify_token(token)["sub"] == "someone"
+    assert auth.cache.stats()["misses"] == 1
+    assert auth.verify_token(token)["type"] == "access"
+    assert auth.cache.stats()["hits"] == 1
+    assert hits.value == before + 1
+
+    expired = auth.create_access_token(expires_time=timedelta(seconds=-1), custom_claims=claims)
+    with pytest.raises(EvaException) as exc_info:
+        auth.verify_token(expired)
+    assert exc_info.value.message == "expired_token"
+    assert len(auth.cache) == 1
+
+
+def test_key_ring_rejects_foreign_tokens():
+    ours = AuthJWT(keys=KeyRing(generate_pem()))
+    theirs = AuthJWT(keys=KeyRing(generate_pem()))
+    token = theirs.create_access_token(custom_claims={"sub": "someone", "identifier_type": "USERNAME"})
+    with pytest.raises(EvaException):
+        ours.verify_token(token)
+
+
+def test_obtain_and_refresh_token(client, event_loop):
+    event_loop.run_until_complete(create_identity("tester", "1234"))
+
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "4321"}
+    )
+    assert resp.status_code == 400, resp.text
+
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "1234"}
+    )
+    assert resp.status_code == 200, resp.text
+    tokens = resp.json()
+
+    resp = client.post("/token/refresh", headers={"Authorization": f"Bearer {tokens['access_token']}"})
+    assert resp.status_code == 403, resp.text
+
+    resp = client.post("/token/refresh", headers={"Authorization": f"Bearer {tokens['refresh_token']}"})
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["access_token"]
+
+    resp = client.get("/.well-known/jwks.json")
+    assert resp.status_code == 200, resp.text
+    assert "d" not in resp.json()["keys"][0]
+
+
+def test_json_web_key_set(client):
+    resp = client.get("/.well-known/jwks.json", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.headers["Cache-Control"].startswith("public, max-age=")
+    etag = resp.headers["ETag"]
+    assert resp.json() == key_ring.key_set().as_dict()
+
+    resp = client.get("/.well-known/jwks.json", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.headers["ETag"] == etag
+    assert resp.json() == key_ring.key_set().as_dict()
+
+    resp = client.get("/.well-known/jwks.json", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.content == b""
+
+
+def test_credential_lookup(client, event_loop):
+    async def setup():
+        identity = await create_identity("tester", "1234")
+        await identity.roles.add(await Role.create(code="a", name="A"), await Role.create(code="b", name="B"))
+        credential = await Credential.get(identifier="tester")
+        await Password.create(credential=credential, shadow=await encrypt.hashing_pool.encrypt_password("5678"))
+        return identity
+
+    identity = event_loop.run_until_complete(setup())
+    credential = event_loop.run_until_complete(Credential.lookup(Credential.IdentifierType.USERNAME, "tester"))
+    assert credential.identity_uuid == identity.uuid
+    assert credential.is_active
+    assert sorted(credential.role_codes) == ["a", "b"]
+    assert len(credential.passwords) == 2
+    assert event_loop.run_until_complete(credential.match_password("5678")) is credential.passwords[1]
+    assert event_loop.run_until_complete(credential.match_password("0000")) is None
+    assert event_loop.run_until_complete(Credential.lookup(Credential.IdentifierType.EMAIL, "tester")) is None
+
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "5678"}
+    )
+    assert resp.status_code == 200, resp.text
+    assert sorted(auth_jwt.verify_token(resp.json()["access_token"])["roles"]) == ["a", "b"]
+
+    event_loop.run_until_complete(Identity.filter(id=identity.id).update(is_active=False))
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "1234"}
+    )
+    assert resp.status_code == 400, resp.text
+
+
+def test_hydra_login_rejects_wrong_password(client, event_loop):
+    event_loop.run_until_complete(create_identity("tester", "1234"))
+    resp = client.post(
+        "/hydra/login",
+        data={"identifier_type": "USERNAME", "identifier": "tester", "password": "4321", "challenge": "c"},
+        allow_redirects=False,
+    )
+    assert resp.status_code == 200, resp.text
+    assert "not correct" in resp.text
+
+
+def test_permission_index_encoding():
+    index = PermissionIndex.build(["a", "b", "c"] + [f"p{i}" for i in range(10)], {"r1": ["a", "p9"], "r2": []})
+    assert index.role_masks == {"r1": 1 | 1 << 12, "r2": 0}
+    assert decode_mask(encode_mask(index.role_masks["r1"])) == index.role_masks["r1"]
+    assert encode_mask(0) == ""
+    assert index.version == 13
+    assert index.etag == PermissionIndex.build(index.codes, {"r2": [], "r1": ["p9", "a"]}).etag
+    changed = PermissionIndex.build(index.codes, {"r1": ["a"], "r2": []})
+    assert (changed.version, changed.etag != index.etag) == (13, True)
+    removed = PermissionIndex.build([None, "b", "c"], {"r1": ["c"]})
+    assert removed.role_masks == {"r1": 1 << 2}
+
+
+def test_permission_bits_follow_permission_id(event_loop):
+    async def run():
+        await Permission.bulk_create([Permission(code=code, name=code) for code in ("z", "a")])
+        first = await PermissionIndex.compile()
+        await Permission.create(code="m", name="m")
+        return first.codes, (await PermissionIndex.compile()).codes
+
+    assert event_loop.run_until_complete(run()) == (["z", "a"], ["z", "a", "m"])
+
+
+def test_permission_bitmask_claims(client, event_loop, monkeypatch):
+    monkeypatch.setattr(settings, "jwt_permission_bitmask", True)
+    for code in ("p1", "p2", "p3"):
+        client.post("/api/permission", json={"code": code, "name": code})
+    client.post("/api/role", json={"code": "r", "name": "r", "permission_codes": ["p1", "p3"]})
+
+    async def setup():
+        identity = await create_identity("tester", "1234")
+        await identity.roles.add(await Role.get(code="r"))
+
+    event_loop.run_until_complete(setup())
+
+    resp = client.get("/.well-known/permission-index.json")
+    assert resp.status_code == 200, resp.text
+    document = resp.json()
+    assert document["permissions"] == ["p1", "p2", "p3"]
+    assert decode_mask(document["roles"]["r"]) == 0b101
+    assert (
+        client.get("/.well-known/permission-index.json", headers={"If-None-Match": resp.headers["ETag"]}).status_code
+        == 304
+    )
+
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "1234"}
+    )
+    claims = auth_jwt.verify_token(resp.json()["access_token"])
+    assert claims["perms_v"] == document["version"]
+    mask = decode_mask(claims["perms"])
+    assert [code for bit, code in enumerate(document["permissions"]) if mask >> bit & 1] == ["p1", "p3"]
+
+    # 角色权限变更和删除权限都不改变已分配的位，旧 token 中的掩码仍按新的索引解码
+    client.patch("/api/role/r", json={"permission_codes": ["p2"]})
+    client.delete("/api/permission/p1")
+    client.post("/api/permission", json={"code": "p4", "name": "p4"})
+    resp = client.post("/token/refresh", headers={"Authorization": f"Bearer {resp.json()['refresh_token']}"})
+    claims = auth_jwt.verify_token(resp.json()["access_token"])
+    assert decode_mask(claims["perms"]) == 0b010
+    document = client.get("/.well-known/permission-index.json").json()
+    assert document["permissions"] == [None, "p2", "p3", "p4"]
+    assert (claims["perms_v"], document["version"]) == (4, 4)
+
+
+def test_refresh_uses_identity_snapshot(client, event_loop):
+    event_loop.run_until_complete(create_identity("tester", "1234"))
+    client.post("/api/role", json={"code": "r", "name": "r"})
+    resp = client.post(
+        "/token/obtain", json={"identifier_type": "USERNAME", "identifier": "tester", "password": "1234"}
+    )
+    tokens = resp.json()
+    uuid = auth_jwt.verify_token(tokens["access_token"])["sub"]
+
+    def refresh():
+        return client.post("/token/refresh", headers={"Authorization": f"Bearer {tokens['refresh_token']}"})
+
+    assert refresh().status_code == 200
+    hits = identity_snapshot_cache.hits
+    assert refresh().status_code == 200
+    assert identity_snapshot_cache.hits == hits + 1
+
+    client.patch(f"/api/identity/{uuid}", json={"roles": [{"code": "r", "name": "r"}]})
+    assert auth_jwt.verify_token(refresh().json()["access_token"])["roles"] == ["r"]
+
+    client.delete("/api/role/r")
+    assert auth_jwt.verify_token(refresh().json()["access_token"])["roles"] == []
+
+    client.patch(f"/api/identity/{uuid}", json={"is_active": False})
+    assert refresh().status_code == 400
+
+    client.delete(f"/api/identity/{uuid}")
+    assert refresh().status_code == 400
+
+
+def test_file_key_store_shared_by_workers(event_loop, tmp_path):
+    path = str(tmp_path / "keys" / "jwt.json")
+    rings = [KeyRing(), KeyRing()]
+    workers = [KeyManager(ring, FileKeyStore(path)) for ring in rings]
+
+    async def run():
+        await asyncio.gather(*(worker.load() for worker in workers))
+        first = rings[0].kid
+        assert rings[1].kid == first
+        kid = (await workers[0].rotate(delay=0)).kid
+        await workers[1].load()
+        return first, kid
+
+    first, kid = event_loop.run_until_complete(run())
+    assert rings[1].kid == kid != first
+    assert set(rings[1].verify_keys) == {first, kid}
+    assert oct(os.stat(path).st_mode & 0o777) == "0o600"
+
+    event_loop.run_until_complete(workers[1].retire(first))
+    event_loop.run_until_complete(workers[0].load())
+    assert set(rings[0].verify_keys) == {kid}
+    with pytest.raises(ValueError):
+        event_loop.run_until_complete(workers[0].retire(kid))
+
+
+def test_database_key_store_rotation(event_loop):
+    ring = KeyRing()
+    manager = KeyManager(ring, DatabaseKeyStore())
+    event_loop.run_until_complete(manager.load())
+    kid = ring.kid
+    # 版本号冲突时写入失败，首次启动的并发生成只有一个生效
+    assert not event_loop.run_until_complete(manager.store.add(KeyRecord.generate(version=1)))
+    event_loop.run_until_complete(manager.load())
+    assert ring.kid == kid
+    assert event_loop.run_until_complete(manager.rotate(delay=0)).kid == ring.kid != kid
+    assert [r.version for r in event_loop.run_until_complete(manager.store.load())] == [1, 2]
+
+
+def test_rotated_key_is_published_before_signing(event_loop):
+    ring = KeyRing()
+    manager = KeyManager(ring, MemoryKeyStore(), reload_interval=60)
+
+    async def run():
+        await manager.load()
+        first = ring.kid
+        record = await manager.rotate()
+        # 新密钥先只出现在 JWKS 中，两个 reload_interval 之后才开始签发
+        assert record.activates_at - time.time() > 119
+        assert ring.kid == first and set(ring.verify_keys) == {first, record.kid}
+        with pytest.raises(ValueError):
+            await manager.retire(first)
+
+        await manager.start()
+        record = await manager.rotate(delay=0.05)
+        await asyncio.sleep(0.1)  # 到期时自动重新加载
+        assert ring.kid == record.kid
+        await manager.close()
+
+    event_loop.run_until_complete(run())
+
+
+def test_failed_reload_is_logged(event_loop, caplog):
+    class BrokenStore(MemoryKeyStore):
+        async def load(self):
+            raise OSError("store unavailable")
+
+    manager = KeyManager(KeyRing(), BrokenStore())
+
+    async def run():
+        with pytest.raises(OSError):
+            await manager.start()  # 启动时的首次加载失败直接抛出，之后的重新加载只记录日志
+        manager.reload()
+        await asyncio.sleep(0.01)
+        await manager.close()
+
+    with caplog.at_level(logging.ERROR, logger="app.utils.keystore"):
+        event_loop.run_until_complete(run())
+    assert "failed to reload jwt signing keys" in caplog.text
+
+
+def test_signing_key_loaded_at_startup(client):
+    assert settings.jwt_private_key is None
+    assert key_manager.loaded and key_ring.kid == key_manager.loaded[-1]
+    resp = client.get("/.well-known/jwks.json")
+    assert [key["kid"] for key in resp.json()["keys"]] == [key_ring.kid]
@@ -0,0 +1,154 @@
+from typing import Dict, List, Sequence, Type
+
+from pypika import Table
+from pypika.terms import Criterion, ValueWrapper
+from tortoise import models
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from app import schemas
+from app.controllers import EvaException
+from app.models import Identity, Permission, Role, meta
+from app.utils.invalidation import invalidation_bus
+
+# 按 uuid 选择身份时，每条语句的 IN 列表最多包含的 uuid 数
+UUID_CHUNK_SIZE = 5000
+
+
+async def execute_count(conn: BaseDBAsyncClient, query) -> int:
+    """执行 INSERT/DELETE 并返回影响的行数；asyncpg 客户端不返回 INSERT 的行数，因此包一层 CTE 计数"""
+    sql = str(query)
+    if conn.capabilities.dialect == "postgres" and sql.startswith("INSERT"):
+        _, rows = await conn.execute_query(f"WITH affected AS ({sql} RETURNING 1) SELECT COUNT(*) FROM affected")
+        return rows[0][0]
+    affected, _ = await conn.execute_query(sql)
+    return affected
+
+
+async def ids_of(conn: BaseDBAsyncClient, model: Type[models.Model], codes: Sequence[str]) -> Dict[str, int]:
+    rows = await model.filter(code__in=codes).using_db(conn).values_list("code", "id")
+    ids = dict(rows)
+    missing = set(codes) - set(ids)
+    if missing:
+        raise EvaException(message=f"specified {model.__name__.lower()}s {sorted(missing)} not found")
+    return ids
+
+
+async def identity_conditions(conn: BaseDBAsyncClient, selector: schemas.IdentitySelector) -> List[Criterion]:
+    """把选择条件转换为 eva_identity 上的 WHERE 条件；按 uuid 选择时每个 uuid 分片一个条件，每个分片各执行一条语句"""
+    field = meta(Identity).fields_map["roles"]
+    identity, through = Table(meta(Identity).db_table), Table(field.through)
+    criterion = Criterion.all()
+    if selector.is_active is not None:
+        criterion &= identity.is_active == selector.is_active
+    if selector.role_code is not None:
+        role_id = (await ids_of(conn, Role, [selector.role_code]))[selector.role_code]
+        members = conn.query_class.from_(through).select(through[field.backward_key])
+        criterion &= identity.id.isin(members.where(through[field.forward_key] == role_id))
+    if selector.uuids is None:
+        return [criterion]
+    uuids = [str(uuid) for uuid in dict.fromkeys(selector.uuids)]
+    return [
+        criterion & identity.uuid.isin(uuids[i : i + UUID_CHUNK_SIZE]) for i in range(0, len(uuids), UUID_CHUNK_SIZE)
+    ]
+
+
+async def assign_roles(selector: schemas.IdentitySelector, role_codes: Sequence[str]) -> int:
+    """给选中的身份添加角色，已有的关联跳过，返回新增的关联数；每个角色（及 uuid 分片）一条 INSERT ... SELECT"""
+    field = meta(Identity).fields_map["roles"]
+    identity, through = Table(meta(Identity).db_table), Table(field.through)
+    affected = 0
+    async with in_transaction(meta(Identity).default_connection) as conn:
+        role_ids = await ids_of(conn, Role, role_codes)
+        conditions = await identity_conditions(conn, selector)
+        for role_id in role_ids.values():
+            existing = conn.query_class.from_(through).select(through[field.backward_key])
+            existing = existing.where(through[field.forward_key] == role_id)
+            for criterion in conditions:
+                query = (
+                    conn.query_class.into(through)
+                    .columns(field.backward_key, field.forward_key)
+                    .from_(identity)
+                    .select(identity.id, ValueWrapper(role_id))
+                    .where(criterion & identity.id.notin(existing))
+                )
+                affected += await execute_count(conn, query)
+    publish_identity_changes(selector, affected)
+    return affected
+
+
+async def revoke_roles(selector: schemas.IdentitySelector, role_codes: Sequence[str]) -> int:
+    """从选中的身份移除角色，返回删除的关联数"""
+    field = meta(Identity).fields_map["roles"]
+    identity, through = Table(meta(Identity).db_table), Table(field.through)
+    affected = 0
+    async with in_transaction(meta(Identity).default_connection) as conn:
+        role_ids = list((await ids_of(conn, Role, role_codes)).values())
+        for criterion in await identity_conditions(conn, selector):
+            selected = conn.query_class.from_(identity).select(identity.id).where(criterion)
+            query = (
+                conn.query_class.from_(through)
+                .delete()
+                .where(through[field.forward_key].isin(role_ids) & through[field.backward_key].isin(selected))
+            )
+            affected += await execute_count(conn, query)
+    publish_identity_changes(selector, affected)
+    return affected
+
+
+def publish_identity_changes(selector: schemas.IdentitySelector, affected: int):
+    if not affected:
+        return
+    if selector.uuids is not None:
+        for uuid in selector.uuids:
+            invalidation_bus.publish("permissions", str(uuid))
+            invalidation_bus.publish("identities", str(uuid))
+    else:
+        invalidation_bus.publish("permissions")
+        invalidation_bus.publish("identities")
+
+
+async def grant_permissions(role_codes: Sequence[str], permission_codes: Sequence[str]) -> int:
+    """给多个角色授予多个权限，已有的关联跳过，返回新增的关联数；每个角色一条 INSERT ... SELECT"""
+    field = meta(Role).fields_map["permissions"]
+    permission, through = Table(meta(Permission).db_table), Table(field.through)
+    affected = 0
+    async with in_transaction(meta(Role).default_connection) as conn:
+        role_ids = await ids_of(conn, Role, role_codes)
+        permission_ids = list((await ids_of(conn, Permission, permission_codes)).values())
+        for role_id in role_ids.values():
+            existing = conn.query_class.from_(through).select(through[field.forward_key])
+            existing = existing.where(through[field.backward_key] == role_id)
+            query = (
+                conn.query_class.into(through)
+                .columns(field.backward_key, field.forward_key)
+                .from_(permission)
+                .select(ValueWrapper(role_id), permission.id)
+                .where(permission.id.isin(permission_ids) & permission.id.notin(existing))
+            )
+            affected += await execute_count(conn, query)
+    publish_permission_changes(affected)
+    return affected
+
+
+async def revoke_permissions(role_codes: Sequence[str], permission_codes: Sequence[str]) -> int:
+    """从多个角色撤销多个权限，返回删除的关联数；一条 DELETE"""
+    field = meta(Role).fields_map["permissions"]
+    through = Table(field.through)
+    async with in_transaction(meta(Role).default_connection) as conn:
+        role_ids = list((await ids_of(conn, Role, role_codes)).values())
+        permission_ids = list((await ids_of(conn, Permission, permission_codes)).values())
+        query = (
+            conn.query_class.from_(through)
+            .delete()
+            .where(through[field.backward_key].isin(role_ids) & through[field.forward_key].isin(permission_ids))
+        )
+        affected = await execute_count(conn, query)
+    publish_permission_changes(affected)
+    return affected
+
+
+def publish_permission_changes(affected: int):
+    if affected:
+        invalidation_bus.publish("permissions")
+        invalidation_bus.publish("permission_index")
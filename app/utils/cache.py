@@ -0,0 +1,67 @@
+import time
+import typing
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from app.utils.metrics import Counter, Gauge
+
+cache_requests = Counter("eva_cache_requests_total", "In-process cache lookups", labelnames=["cache", "result"])
+cache_entries = Gauge("eva_cache_entries", "Entries held by in-process caches", labelnames=["cache"])
+
+
+class TTLCache:
+    """进程内的 LRU 缓存，每个条目带有过期时间；给出 name 时命中、未命中次数和条目数同时导出到 /metrics"""
+
+    def __init__(self, maxsize: int, ttl: float, name: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data: typing.OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        if name is not None:
+            self._hit_counter = cache_requests.labels(cache=name, result="hit")
+            self._miss_counter = cache_requests.labels(cache=name, result="miss")
+            self._entries = cache_entries.labels(cache=name)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _resized(self):
+        if self.name is not None:
+            self._entries.set(len(self._data))
+
+    def get(self, key: Hashable, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                if self.name is not None:
+                    self._hit_counter.inc()
+                return value
+            del self._data[key]
+            self._resized()
+        self.misses += 1
+        if self.name is not None:
+            self._miss_counter.inc()
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        self._resized()
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+        self._resized()
+
+    def clear(self):
+        self._data.clear()
+        self._resized()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
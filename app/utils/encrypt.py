@@ -1,34 +1,187 @@
+import asyncio
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Union
+
 from argon2 import PasswordHasher, Type
 from argon2.exceptions import VerifyMismatchError
 
+from app.controllers import EvaException
 from app.core.config import settings
+from app.utils.metrics import Histogram
+
+argon2_duration = Histogram(
+    "eva_argon2_duration_seconds", "Duration of Argon2 hash and verify operations", labelnames=["operation"]
+)
+argon2_queue_wait = Histogram(
+    "eva_argon2_queue_wait_seconds", "Time Argon2 operations wait for a hashing thread", labelnames=["operation"]
+)
+
+password_hasher = PasswordHasher(
+    time_cost=settings.argon2_time_cost,
+    memory_cost=settings.argon2_memory_cost,
+    parallelism=settings.argon2_parallelism,
+    hash_len=settings.argon2_hash_len,
+    salt_len=settings.argon2_salt_len,
+    encoding="utf-8",
+    type=Type.ID,
+)
 
 
 def encrypt_password(raw_password):
-    ph = PasswordHasher(
-        time_cost=settings.argon2_time_cost,
-        memory_cost=settings.argon2_memory_cost,
-        parallelism=settings.argon2_parallelism,
-        hash_len=settings.argon2_hash_len,
-        salt_len=settings.argon2_salt_len,
-        encoding="utf-8",
-        type=Type.ID,
-    )
-    return ph.hash(raw_password)
+    return password_hasher.hash(raw_password)
 
 
 def check_password(hashed_password, raw_password) -> bool:
+    try:
+        password_hasher.verify(hashed_password, raw_password)
+        return True
+    except VerifyMismatchError:
+        return False
+
+
+def needs_rehash(hashed_password) -> bool:
+    """哈希所用参数与当前配置不一致时返回 True"""
+    return password_hasher.check_needs_rehash(hashed_password)
+
+
+def measure_verify(
+    time_cost: int, memory_cost: int, parallelism: int, samples: int = 10, percentile: float = 95
+) -> float:
+    """使用给定参数多次校验密码，返回对应分位的耗时（毫秒）"""
     ph = PasswordHasher(
-        time_cost=settings.argon2_time_cost,
-        memory_cost=settings.argon2_memory_cost,
-        parallelism=settings.argon2_parallelism,
+        time_cost=time_cost,
+        memory_cost=memory_cost,
+        parallelism=parallelism,
         hash_len=settings.argon2_hash_len,
         salt_len=settings.argon2_salt_len,
         encoding="utf-8",
         type=Type.ID,
     )
-    try:
-        ph.verify(hashed_password, raw_password)
-        return True
-    except VerifyMismatchError:
-        return False
+    hashed = ph.hash("calibration")
+    durations = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        ph.verify(hashed, "calibration")
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return durations[min(len(durations) - 1, math.ceil(len(durations) * percentile / 100) - 1)]
+
+
+def calibrate(
+    target: float, max_memory_cost: int, parallelism: int, samples: int = 10, percentile: float = 95
+) -> Dict[str, Union[int, float]]:
+    """
+    在本机上寻找校验耗时（percentile 分位）不超过 target 毫秒的最高强度参数：
+    先在 max_memory_cost 以内减半内存直到满足目标，再按耗时与 time_cost 近似线性的关系估算 time_cost 并回退校正。
+    """
+    time_cost, memory_cost = 1, max_memory_cost
+    min_memory_cost = 8 * parallelism
+    latency = measure_verify(time_cost, memory_cost, parallelism, samples, percentile)
+    while latency > target and memory_cost // 2 >= min_memory_cost:
+        memory_cost //= 2
+        latency = measure_verify(time_cost, memory_cost, parallelism, samples, percentile)
+    estimated = int(target // latency) if latency else 1
+    while estimated > time_cost:
+        estimated_latency = measure_verify(estimated, memory_cost, parallelism, samples, percentile)
+        if estimated_latency <= target:
+            time_cost, latency = estimated, estimated_latency
+            break
+        estimated = max(time_cost, int(estimated * target / estimated_latency))
+    return {
+        "time_cost": time_cost,
+        "memory_cost": memory_cost,
+        "parallelism": parallelism,
+        "latency": round(latency, 2),
+    }
+
+
+class HashingPool:
+    """
+    在线程池中执行 Argon2 运算，避免阻塞事件循环（argon2-cffi 在运算期间会释放 GIL）。
+    每个线程同一时刻只运行一个哈希，因此线程数由内存预算决定；
+    排队的请求超过 queue_depth 时直接返回 503，而不是无限堆积。
+    """
+
+    def __init__(self, memory_budget: int, memory_cost: int, queue_depth: int, max_workers: Optional[int] = None):
+        slots = max(1, memory_budget // memory_cost)
+        self.max_workers = min(slots, max_workers or os.cpu_count() or 1)
+        # 批量哈希最多占用一半的线程，其余留给登录等交互请求
+        self.bulk_workers = max(1, self.max_workers // 2)
+        self.queue_depth = queue_depth
+        self.pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._bulk_slots: Optional[asyncio.Semaphore] = None
+        self._bulk_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="argon2")
+        return self._executor
+
+    async def _execute(self, operation: str, fn, *args):
+        """在线程池中执行 fn，记录排队等待和运算的耗时；计时在线程中取，指标在事件循环中更新"""
+
+        def timed():
+            started = time.perf_counter()
+            return fn(*args), started, time.perf_counter()
+
+        submitted = time.perf_counter()
+        result, started, finished = await asyncio.get_event_loop().run_in_executor(self.executor, timed)
+        argon2_queue_wait.labels(operation=operation).observe(started - submitted)
+        argon2_duration.labels(operation=operation).observe(finished - started)
+        return result
+
+    async def run(self, operation: str, fn, *args):
+        if self.pending >= self.max_workers + self.queue_depth:
+            raise EvaException(status_code=503, message="password hashing service is busy, please retry later")
+        self.pending += 1
+        try:
+            return await self._execute(operation, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def encrypt_password(self, raw_password) -> str:
+        return await self.run("hash", encrypt_password, raw_password)
+
+    async def check_password(self, hashed_password, raw_password) -> bool:
+        return await self.run("verify", check_password, hashed_password, raw_password)
+
+    @property
+    def bulk_slots(self) -> asyncio.Semaphore:
+        # Semaphore 绑定创建时的事件循环，按当前循环懒加载
+        loop = asyncio.get_event_loop()
+        if self._bulk_slots is None or self._bulk_loop is not loop:
+            self._bulk_slots, self._bulk_loop = asyncio.Semaphore(self.bulk_workers), loop
+        return self._bulk_slots
+
+    async def _bulk_hash(self, raw_password) -> str:
+        async with self.bulk_slots:
+            self.pending += 1
+            try:
+                return await self._execute("hash", encrypt_password, raw_password)
+            finally:
+                self.pending -= 1
+
+    async def encrypt_passwords(self, raw_passwords: Sequence[str]) -> List[str]:
+        """
+        批量哈希（如导入身份）。同时提交到线程池的不超过 bulk_workers 个，其余在事件循环中等待，
+        不会在线程池队列里堆积，max_workers > 1 时登录等交互请求总有空闲线程；运行中的批量哈希计入排队上限。
+        """
+        return list(await asyncio.gather(*(self._bulk_hash(raw) for raw in raw_passwords)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+hashing_pool = HashingPool(
+    memory_budget=settings.argon2_memory_budget,
+    memory_cost=settings.argon2_memory_cost,
+    queue_depth=settings.argon2_queue_depth,
+    max_workers=settings.argon2_workers,
+)
@@ -1,21 +1,66 @@
+import asyncio
 from typing import List, Optional
 
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Response, Timeout, TransportError
+from starlette.requests import Request
 
 from app.core import config
+from app.utils.metrics import Histogram
 
+hydra_admin_latency = Histogram(
+    "eva_hydra_admin_request_duration_seconds", "Latency of Hydra admin API calls", labelnames=["method"]
+)
 
-async def hydra_admin() -> AsyncClient:
-    async with AsyncClient(base_url=config.settings.hydra_admin_host) as client:
-        yield HydraAdmin(client)
+# 对幂等的 GET 请求，遇到这些状态码时重试
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+def create_client() -> AsyncClient:
+    """创建应用级共享的 Hydra admin 客户端，在 startup 时创建、shutdown 时关闭，以复用连接"""
+    settings = config.settings
+    return AsyncClient(
+        base_url=settings.hydra_admin_host,
+        limits=Limits(
+            max_connections=settings.hydra_admin_max_connections,
+            max_keepalive_connections=settings.hydra_admin_max_keepalive_connections,
+        ),
+        timeout=Timeout(
+            settings.hydra_admin_timeout,
+            connect=settings.hydra_admin_connect_timeout,
+            read=settings.hydra_admin_read_timeout,
+        ),
+        http2=settings.hydra_admin_http2,
+    )
+
+
+async def hydra_admin(request: Request) -> "HydraAdmin":
+    return HydraAdmin(request.app.state.hydra_client)
 
 
 class HydraAdmin:
-    def __init__(self, client: AsyncClient):
+    def __init__(self, client: AsyncClient, retries: int = config.settings.hydra_admin_retries):
         self.client = client
+        self.retries = retries
+
+    async def _get(self, name: str, url: str, params) -> Response:
+        for attempt in range(self.retries + 1):
+            try:
+                with hydra_admin_latency.labels(method=name).time():
+                    resp = await self.client.get(url, params=params)
+                if resp.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    return resp
+            except TransportError:
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(0.05 * 2 ** attempt)
+        raise AssertionError("unreachable")  # pragma: no cover
+
+    async def _put(self, name: str, url: str, params, body) -> Response:
+        with hydra_admin_latency.labels(method=name).time():
+            return await self.client.put(url, params=params, json=body)
 
     async def get_login_request(self, challenge: str):
-        resp = await self.client.get("/oauth2/auth/requests/login", params={"login_challenge": challenge})
+        resp = await self._get("get_login_request", "/oauth2/auth/requests/login", {"login_challenge": challenge})
         return resp.json()
 
     async def accept_login_request(
@@ -25,22 +70,23 @@ class HydraAdmin:
         if remember is not None:
             body["remember"] = remember
             body["remember_for"] = remember_for
-        resp = await self.client.put(
-            "/oauth2/auth/requests/login/accept", params={"login_challenge": challenge}, json=body
+        resp = await self._put(
+            "accept_login_request", "/oauth2/auth/requests/login/accept", {"login_challenge": challenge}, body
         )
         return resp.json()
 
     async def get_consent_request(self, challenge: str):
-        resp = await self.client.get("/oauth2/auth/requests/consent", params={"consent_challenge": challenge})
+        resp = await self._get("get_consent_request", "/oauth2/auth/requests/consent", {"consent_challenge": challenge})
         return resp.json()
 
     async def accept_consent_request(
         self, challenge: str, grant_scope: List[str], remember: bool = None, grant_access_token_audience=None
     ):
-        resp = await self.client.put(
+        resp = await self._put(
+            "accept_consent_request",
             "/oauth2/auth/requests/consent/accept",
-            params={"consent_challenge": challenge},
-            json={
+            {"consent_challenge": challenge},
+            {
                 "grant_scope": grant_scope,
                 "remember": remember,
                 "remember_for": 3600,
@@ -50,9 +96,10 @@ class HydraAdmin:
         return resp.json()
 
     async def reject_consent_request(self, challenge: str, error: str, error_description: str):
-        resp = await self.client.put(
+        resp = await self._put(
+            "reject_consent_request",
             "/oauth2/auth/requests/consent/reject",
-            params={"consent_challenge": challenge},
-            json={"error": error, "error_description": error_description},
+            {"consent_challenge": challenge},
+            {"error": error, "error_description": error_description},
         )
         return resp.json()
@@ -0,0 +1,301 @@
+import asyncio
+import csv
+import json
+import uuid
+from typing import IO, Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from argon2 import extract_parameters
+from argon2.exceptions import InvalidHash
+from pydantic import ValidationError
+from pypika import Table
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from app import schemas
+from app.controllers import EvaException
+from app.models import Credential, Identity, Password, Role, meta
+from app.utils import encrypt
+
+# CSV 每行对应一个身份及其唯一的凭证，多个角色用 | 分隔
+CSV_COLUMNS = ("identifier_type", "identifier", "password", "password_shadow", "role_codes", "is_active")
+
+Record = Tuple[int, Any]  # (行号, 解析后的 dict 或错误信息)
+
+
+async def read_file(f: IO[bytes], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    with f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8").rstrip("\r")
+
+
+async def parse_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[Record]:
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as err:
+            yield line_no, f"invalid json: {err}"
+
+
+async def parse_csv(lines: AsyncIterator[str]) -> AsyncIterator[Record]:
+    header: Optional[List[str]] = None
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]), [])
+        if header is None:
+            header = values
+            unknown = set(header) - set(CSV_COLUMNS)
+            if unknown:
+                yield line_no, f"unknown columns: {', '.join(sorted(unknown))}"
+                return
+            continue
+        row = {k: v for k, v in zip(header, values) if v != ""}
+        yield line_no, {
+            "role_codes": row["role_codes"].split("|") if row.get("role_codes") else None,
+            "is_active": row.get("is_active", "true").lower() in ("1", "true", "yes"),
+            "credentials": [
+                {
+                    "identifier_type": row.get("identifier_type"),
+                    "identifier": row.get("identifier"),
+                    "password": row.get("password"),
+                    "password_shadow": row.get("password_shadow"),
+                }
+            ],
+        }
+
+
+def format_validation_error(err: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in err.errors())
+
+
+def credential_key(identifier_type, identifier: str) -> Tuple[str, str]:
+    return Credential.IdentifierType(identifier_type).value, identifier
+
+
+async def write_identities(
+    items: List[schemas.IdentityImport], role_ids: Dict[str, int], conn: BaseDBAsyncClient
+) -> List[uuid.UUID]:
+    """
+    使用 bulk_create 批量写入 Identity/Credential/Password 及角色关联，调用方负责开启事务。
+    items 中的凭证如需密码，必须已经填好 password_shadow。
+    """
+    identities = [Identity(uuid=uuid.uuid4(), is_active=item.is_active) for item in items]
+    await Identity.bulk_create(identities, using_db=conn)
+    # bulk_create 不会回填自增主键，按 uuid 取回
+    identity_ids = {
+        str(u): pk
+        for u, pk in await Identity.filter(uuid__in=[i.uuid for i in identities])
+        .using_db(conn)
+        .values_list("uuid", "id")
+    }
+
+    credentials, role_pairs = [], set()
+    for identity, item in zip(identities, items):
+        identity_id = identity_ids[str(identity.uuid)]
+        role_pairs.update((identity_id, role_ids[code]) for code in item.role_codes or ())
+        credentials.extend(
+            Credential(identity_id=identity_id, identifier_type=c.identifier_type, identifier=c.identifier)
+            for c in item.credentials
+        )
+    await Credential.bulk_create(credentials, using_db=conn)
+    # 按 (identity_id, identifier_type, identifier) 对应，与 Credential 的唯一约束无关
+    credential_ids = {
+        (identity_id, *credential_key(identifier_type, identifier)): pk
+        for pk, identity_id, identifier_type, identifier in await Credential.filter(
+            identity_id__in=list(identity_ids.values())
+        )
+        .using_db(conn)
+        .values_list("id", "identity_id", "identifier_type", "identifier")
+    }
+
+    expires_at = Password.default_expires_at()
+    passwords = [
+        Password(
+            credential_id=credential_ids[
+                (identity_ids[str(identity.uuid)], *credential_key(c.identifier_type, c.identifier))
+            ],
+            shadow=c.password_shadow,
+            expires_at=expires_at,
+        )
+        for identity, item in zip(identities, items)
+        for c in item.credentials
+        if c.password_shadow
+    ]
+    if passwords:
+        await Password.bulk_create(passwords, using_db=conn)
+
+    if role_pairs:
+        field = meta(Identity).fields_map["roles"]
+        query = (
+            conn.query_class.into(Table(field.through))
+            .columns(field.backward_key, field.forward_key)
+            .insert(*sorted(role_pairs))
+        )
+        await conn.execute_query(str(query))
+    return [identity.uuid for identity in identities]
+
+
+async def create_identity(body: schemas.IdentityCreate) -> uuid.UUID:
+    """
+    创建单个身份，POST /api/identity 与 manage.py create_identity 共用。
+    先用两条查询校验角色和凭证，各凭证的密码在线程池中并行哈希，再在一个事务中由 write_identities 批量写入；
+    任何一步失败都不会留下部分数据。
+    """
+    item = schemas.IdentityImport.parse_obj(body.dict())
+    role_codes = set(item.role_codes or ())
+    role_ids = dict(await Role.filter(code__in=role_codes).values_list("code", "id")) if role_codes else {}
+    taken: Set[Tuple[str, str]] = {
+        credential_key(t, i)
+        for t, i in await Credential.filter(identifier__in=[c.identifier for c in item.credentials]).values_list(
+            "identifier_type", "identifier"
+        )
+    }
+    error = check_item(item, role_ids, taken)
+    if error:
+        raise EvaException(message=error)
+
+    raw = [c for c in item.credentials if c.password]
+    shadows = await asyncio.gather(*(encrypt.hashing_pool.encrypt_password(c.password) for c in raw))
+    for credential, shadow in zip(raw, shadows):
+        credential.password_shadow = shadow
+
+    async with in_transaction(meta(Identity).default_connection) as conn:
+        (identity_uuid,) = await write_identities([item], role_ids, conn)
+    return identity_uuid
+
+
+async def validate_chunk(
+    records: Iterable[Record], results: Dict[int, Dict[str, Any]]
+) -> Tuple[List[Tuple[int, schemas.IdentityImport]], Dict[str, int]]:
+    """校验一批记录，出错的行写入 results，返回通过校验的 (行号, item) 以及用到的角色 id"""
+    candidates: List[Tuple[int, schemas.IdentityImport]] = []
+    for line, data in records:
+        if isinstance(data, str):
+            results[line] = {"line": line, "error": data}
+            continue
+        try:
+            candidates.append((line, schemas.IdentityImport.parse_obj(data)))
+        except ValidationError as err:
+            results[line] = {"line": line, "error": format_validation_error(err)}
+
+    role_codes = {code for _, item in candidates for code in item.role_codes or ()}
+    role_ids = dict(await Role.filter(code__in=role_codes).values_list("code", "id")) if role_codes else {}
+    identifiers = [c.identifier for _, item in candidates for c in item.credentials]
+    taken: Set[Tuple[str, str]] = {
+        credential_key(t, i)
+        for t, i in await Credential.filter(identifier__in=identifiers).values_list("identifier_type", "identifier")
+    }
+
+    accepted: List[Tuple[int, schemas.IdentityImport]] = []
+    for line, item in candidates:
+        error = check_item(item, role_ids, taken)
+        if error:
+            results[line] = {"line": line, "error": error}
+            continue
+        taken.update(credential_key(c.identifier_type, c.identifier) for c in item.credentials)
+        accepted.append((line, item))
+    return accepted, role_ids
+
+
+async def import_chunk(records: Iterable[Record]) -> List[Dict[str, Any]]:
+    """校验一批记录，哈希其中的明文密码并在一个事务中写入，返回每一行的结果"""
+    results: Dict[int, Dict[str, Any]] = {}
+    accepted, role_ids = await validate_chunk(records, results)
+
+    raw = [c for _, item in accepted for c in item.credentials if c.password and not c.password_shadow]
+    for credential, shadow in zip(raw, await encrypt.hashing_pool.encrypt_passwords([c.password for c in raw])):
+        credential.password_shadow = shadow
+
+    if accepted:
+        try:
+            async with in_transaction(meta(Identity).default_connection) as conn:
+                uuids = await write_identities([item for _, item in accepted], role_ids, conn)
+            for (line, _), identity_uuid in zip(accepted, uuids):
+                results[line] = {"line": line, "uuid": str(identity_uuid)}
+        except Exception as err:  # pylint: disable=broad-except
+            for line, _ in accepted:
+                results[line] = {"line": line, "error": f"chunk failed: {err}"}
+    return [results[line] for line in sorted(results)]
+
+
+def check_item(item: schemas.IdentityImport, role_ids: Dict[str, int], taken: Set[Tuple[str, str]]) -> Optional[str]:
+    missing = set(item.role_codes or ()) - set(role_ids)
+    if missing:
+        return f"roles {sorted(missing)} not found"
+    if not item.credentials:
+        return "at least one credential is required"
+    identifiers = [c.identifier for c in item.credentials]
+    if len(set(identifiers)) != len(identifiers):
+        return "duplicated identifiers"
+    for c in item.credentials:
+        if credential_key(c.identifier_type, c.identifier) in taken:
+            return f"credential {c.identifier_type.value} {c.identifier} already exists"
+        if c.password_shadow:
+            try:
+                extract_parameters(c.password_shadow)
+            except InvalidHash:
+                return f"password_shadow of {c.identifier} is not a valid argon2 hash"
+    return None
+
+
+async def import_identities(records: AsyncIterator[Record], chunk_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+    chunk: List[Record] = []
+    async for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            for result in await import_chunk(chunk):
+                yield result
+            chunk = []
+    if chunk:
+        for result in await import_chunk(chunk):
+            yield result
+
+
+async def ndjson(results: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for result in results:
+        yield json.dumps(result, separators=(",", ":")).encode() + b"\n"
+
+
+async def export_batches(
+    batch_size: int = 1000, is_active: Optional[bool] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    按主键做 keyset 分批遍历身份表，每批的角色和凭证由 schemas.project_identities 用固定次数的查询取出，
+    产出可直接序列化为 JSON 的 IdentityDetail 形状的 dict 列表；内存占用只与 batch_size 有关。
+    """
+    qs = Identity.all() if is_active is None else Identity.filter(is_active=is_active)
+    last_id = 0
+    while True:
+        ids = await qs.filter(id__gt=last_id).order_by("id").limit(batch_size).values_list("id", flat=True)
+        if not ids:
+            return
+        batch = await schemas.project_identities(Identity.filter(id__in=ids))
+        for item in batch:
+            del item["id"]
+            item["uuid"] = str(item["uuid"])
+            for credential in item["credentials"]:
+                credential["identifier_type"] = credential["identifier_type"].value
+        yield batch
+        last_id = ids[-1]
+
+
+async def export_identities(batch_size: int = 1000, is_active: Optional[bool] = None) -> AsyncIterator[bytes]:
+    async for batch in export_batches(batch_size, is_active):
+        yield b"".join(json.dumps(item, separators=(",", ":"), ensure_ascii=False).encode() + b"\n" for item in batch)
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+import asyncpg
+
+from app.core import config
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Optional[str]], None]
+# topic -> 需要失效的 key 集合；None 表示该 topic 下的全部缓存
+Events = Dict[str, Optional[Set[str]]]
+
+
+class Backend:
+    """把一批失效事件广播给其他 worker；收到其他 worker 的消息时调用 on_message"""
+
+    max_payload: Optional[int] = None
+
+    async def start(self, on_message: Callable[[bytes], None]):
+        raise NotImplementedError
+
+    async def send(self, payload: bytes):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(Backend):
+    """进程内广播，用于测试及单进程部署；共享同一个 hub 的 bus 之间互相可见"""
+
+    def __init__(self, hub: Optional[Set["MemoryBackend"]] = None):
+        self.hub = memory_hub if hub is None else hub
+        self.on_message: Optional[Callable[[bytes], None]] = None
+
+    async def start(self, on_message: Callable[[bytes], None]):
+        self.on_message = on_message
+        self.hub.add(self)
+
+    async def send(self, payload: bytes):
+        loop = asyncio.get_event_loop()
+        for peer in list(self.hub):
+            if peer is not self:
+                loop.call_soon(peer.on_message, payload)
+
+    async def close(self):
+        self.hub.discard(self)
+
+
+memory_hub: Set[MemoryBackend] = set()
+
+
+class UnixSocketBackend(Backend):
+    """
+    单机多 worker：每个 worker 在 directory 下绑定一个 Unix datagram socket，
+    发送时逐个投递给目录下其他 worker 的 socket，已退出的 worker 留下的 socket 文件会被清理。
+    """
+
+    recv_size = 65536
+    max_payload = 65000  # 超过接收缓冲区的数据报会被截断，更大的消息退化为整体失效
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.path = self.directory / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock"
+        self.sock: Optional[socket.socket] = None
+
+    async def start(self, on_message: Callable[[bytes], None]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(str(self.path))
+
+        def read():
+            while True:
+                try:
+                    on_message(self.sock.recv(self.recv_size))
+                except BlockingIOError:
+                    return
+
+        asyncio.get_event_loop().add_reader(self.sock.fileno(), read)
+
+    async def send(self, payload: bytes):
+        for peer in self.directory.glob("*.sock"):
+            if peer == self.path:
+                continue
+            try:
+                self.sock.sendto(payload, str(peer))
+            except (ConnectionRefusedError, FileNotFoundError):
+                peer.unlink(missing_ok=True)
+            except BlockingIOError:
+                logger.warning("invalidation socket %s is full, message dropped", peer)
+
+    async def close(self):
+        if self.sock is not None:
+            asyncio.get_event_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            self.path.unlink(missing_ok=True)
+
+
+class PostgresBackend(Backend):
+    """多节点：通过 PostgreSQL LISTEN/NOTIFY 广播，使用一个独立的连接"""
+
+    max_payload = 7900  # NOTIFY 的 payload 上限为 8000 字节
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.conn = None
+
+    async def start(self, on_message: Callable[[bytes], None]):
+        credentials = config.db_config["connections"]["default"]["credentials"]
+        self.conn = await asyncpg.connect(
+            host=credentials["host"],
+            port=credentials["port"],
+            user=credentials["user"],
+            password=credentials["password"],
+            database=credentials["database"],
+            ssl=credentials.get("ssl"),
+        )
+        await self.conn.add_listener(self.channel, lambda _conn, _pid, _channel, payload: on_message(payload.encode()))
+
+    async def send(self, payload: bytes):
+        await self.conn.execute("SELECT pg_notify($1, $2)", self.channel, payload.decode())
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+
+class InvalidationBus:
+    """
+    跨 worker 的缓存失效总线。
+    publish 时本进程的订阅者立即生效；发给其他 worker 的事件先在 flush_delay 内合并：
+    同一 topic 的重复 key 只发一次，出现全量失效或 key 数超过 max_keys 时只发一条全量失效。
+    """
+
+    def __init__(self, backend: Backend, flush_delay: float = 0.05, max_keys: int = 1000):
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.max_keys = max_keys
+        self.sender = uuid.uuid4().hex
+        self.handlers: Dict[str, List[Handler]] = {}
+        self.pending: Events = {}
+        self.started = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def subscribe(self, topic: str, handler: Handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def apply(self, topic: str, key: Optional[str] = None):
+        for handler in self.handlers.get(topic, ()):
+            handler(key)
+
+    def publish(self, topic: str, key: Optional[str] = None):
+        self.apply(topic, key)
+        if not self.started:
+            return
+        if topic in self.pending and self.pending[topic] is None:
+            pass
+        elif key is None:
+            self.pending[topic] = None
+        else:
+            keys = self.pending.setdefault(topic, set())
+            keys.add(key)
+            if len(keys) > self.max_keys:
+                self.pending[topic] = None
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_delay, self._schedule_flush)
+
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def encode(self, events: Events) -> bytes:
+        payload = {
+            "sender": self.sender,
+            "events": {topic: None if keys is None else sorted(keys) for topic, keys in events.items()},
+        }
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+    async def flush(self):
+        self._flush_handle = None
+        events, self.pending = self.pending, {}
+        if not events:
+            return
+        payload = self.encode(events)
+        if self.backend.max_payload and len(payload) > self.backend.max_payload:
+            payload = self.encode({topic: None for topic in events})
+        try:
+            await self.backend.send(payload)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to broadcast cache invalidation")
+
+    def receive(self, payload: bytes):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning("invalid invalidation message: %r", payload[:100])
+            return
+        if message.get("sender") == self.sender:
+            return
+        for topic, keys in message.get("events", {}).items():
+            for key in [None] if keys is None else keys:
+                self.apply(topic, key)
+
+    async def start(self):
+        await self.backend.start(self.receive)
+        self.started = True
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        self.started = False
+        await self.backend.close()
+
+
+def create_backend(name: Optional[str] = None) -> Backend:
+    name = name or config.settings.invalidation_backend or ("memory" if config.settings.env == "test" else "unix")
+    if name == "memory":
+        return MemoryBackend()
+    if name == "unix":
+        return UnixSocketBackend(config.settings.invalidation_socket_dir)
+    if name == "postgres":
+        return PostgresBackend(config.settings.invalidation_channel)
+    raise ValueError(f"unknown invalidation backend {name}")
+
+
+invalidation_bus = InvalidationBus(
+    create_backend(),
+    flush_delay=config.settings.invalidation_flush_delay,
+    max_keys=config.settings.invalidation_max_keys,
+)
@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import json
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence
+
+from authlib.jose import KeySet, RSAKey
+from authlib.jose.errors import DecodeError
+
+from app.core.config import settings
+
+
+def public_key_of(key: RSAKey) -> RSAKey:
+    return RSAKey.import_key(key.get_public_key())
+
+
+class JWKSDocument(NamedTuple):
+    """预先序列化好的 JWKS 响应体，附带 gzip 版本和强 ETag"""
+
+    body: bytes
+    gzip_body: bytes
+    etag: str
+
+    @classmethod
+    def from_key_set(cls, key_set: KeySet) -> "JWKSDocument":
+        body = json.dumps(key_set.as_dict(), separators=(",", ":"), sort_keys=True).encode()
+        return cls(body=body, gzip_body=gzip.compress(body, mtime=0), etag=f'"{hashlib.sha256(body).hexdigest()}"')
+
+
+class KeyRing:
+    """
+    JWT 密钥环：密钥只在加载时解析一次，并按 kid（RFC7638 thumbprint）建立索引。
+    signing_key 用于签发；verify_keys 只保存公钥，包括轮换下来、仍需校验存量 token 的旧密钥。
+    """
+
+    def __init__(self, private_key: Optional[str] = None, public_keys: Iterable[str] = ()):
+        self.signing_key: Optional[RSAKey] = None
+        self.kid: Optional[str] = None
+        self.verify_keys: Dict[str, RSAKey] = {}
+        self.jwks = JWKSDocument.from_key_set(self.key_set())
+        for pem in public_keys:
+            self.add_verify_key(pem)
+        if private_key:
+            self.rotate(private_key)
+
+    def load(self, private_keys: Sequence[str], public_keys: Iterable[str] = ()):
+        """整体替换密钥环：最后一个私钥用于签发，其余私钥和 public_keys 只用于校验"""
+        verify_keys = {}
+        for pem in public_keys:
+            key = public_key_of(RSAKey.import_key(pem))
+            verify_keys[key.thumbprint()] = key
+        signing_key = kid = None
+        for pem in private_keys:
+            signing_key = RSAKey.import_key(pem)
+            kid = signing_key.thumbprint()
+            verify_keys[kid] = public_key_of(signing_key)
+        self.signing_key, self.kid, self.verify_keys = signing_key, kid, verify_keys
+        self.jwks = JWKSDocument.from_key_set(self.key_set())
+
+    def add_verify_key(self, pem) -> str:
+        key = public_key_of(RSAKey.import_key(pem))
+        kid = key.thumbprint()
+        self.verify_keys[kid] = key
+        self.jwks = JWKSDocument.from_key_set(self.key_set())
+        return kid
+
+    def rotate(self, private_key) -> str:
+        """切换签发密钥，之前的签发密钥保留在 verify_keys 中，直到被 retire"""
+        key = RSAKey.import_key(private_key)
+        self.signing_key, self.kid = key, key.thumbprint()
+        self.verify_keys[self.kid] = public_key_of(key)
+        self.jwks = JWKSDocument.from_key_set(self.key_set())
+        return self.kid
+
+    def retire(self, kid: str):
+        if kid == self.kid:
+            raise ValueError("can not retire the current signing key")
+        self.verify_keys.pop(kid, None)
+        self.jwks = JWKSDocument.from_key_set(self.key_set())
+
+    def find_verify_key(self, header, _payload) -> RSAKey:
+        """供 jwt.decode 使用的 key loader，根据 header 中的 kid 选择公钥"""
+        try:
+            return self.verify_keys[header.get("kid")]
+        except KeyError:
+            raise DecodeError("unknown key id")
+
+    def key_set(self) -> KeySet:
+        return KeySet(keys=list(self.verify_keys.values()))
+
+
+# 未配置 jwt_private_key 时密钥由 app.utils.keystore.key_manager 在 startup 时加载
+key_ring = KeyRing(
+    settings.jwt_private_key.get_secret_value() if settings.jwt_private_key else None, settings.jwt_public_keys
+)
@@ -0,0 +1,255 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from authlib.jose import RSAKey
+from tortoise.exceptions import IntegrityError
+
+from app.core import config
+from app.models import SigningKey
+from app.utils.invalidation import invalidation_bus
+from app.utils.keyring import KeyRing, key_ring
+
+logger = logging.getLogger(__name__)
+
+
+class KeyRecord(NamedTuple):
+    """
+    保存的签名密钥。已到 activates_at（Unix 时间戳）的密钥中 version 最大的用于签发，
+    其余只用于校验：之前的密钥校验存量 token，尚未生效的密钥先发布到 JWKS，等各 worker 都加载后再开始签发。
+    """
+
+    version: int
+    kid: str
+    private_key: str
+    activates_at: float = 0
+
+    @classmethod
+    def generate(cls, version: int) -> "KeyRecord":
+        key = RSAKey.generate_key(is_private=True)
+        return cls(version=version, kid=key.thumbprint(), private_key=key.as_pem(is_private=True).decode())
+
+
+def signer_of(records: List[KeyRecord], now: float) -> KeyRecord:
+    """records 按 version 排序；全部尚未生效时（不会发生在正常轮换中）使用最早的密钥"""
+    active = [r for r in records if r.activates_at <= now]
+    return active[-1] if active else records[0]
+
+
+class MemoryKeyStore:
+    """进程内的密钥存储，用于测试和 bench"""
+
+    def __init__(self):
+        self.records: List[KeyRecord] = []
+
+    async def load(self) -> List[KeyRecord]:
+        return sorted(self.records)
+
+    async def add(self, record: KeyRecord) -> bool:
+        if any(r.version == record.version for r in self.records):
+            return False
+        self.records.append(record)
+        return True
+
+    async def remove(self, kid: str):
+        self.records = [r for r in self.records if r.kid != kid]
+
+
+class FileKeyStore:
+    """
+    密钥保存在一个 JSON 文件中（权限 0600），同一台机器上的 worker 共享。
+    写入时持有 flock 并通过 rename 原子替换，读取的一方不会看到写了一半的文件。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self) -> List[KeyRecord]:
+        try:
+            with open(self.path) as f:
+                return sorted(KeyRecord(**item) for item in json.load(f)["keys"])
+        except FileNotFoundError:
+            return []
+
+    def _write(self, records: List[KeyRecord]):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"keys": [r._asdict() for r in sorted(records)]}, f)
+        os.replace(tmp, self.path)
+
+    def _add(self, record: KeyRecord) -> bool:
+        with self._lock():
+            records = self._read()
+            if any(r.version == record.version for r in records):
+                return False
+            self._write(records + [record])
+            return True
+
+    def _remove(self, kid: str):
+        with self._lock():
+            self._write([r for r in self._read() if r.kid != kid])
+
+    async def load(self) -> List[KeyRecord]:
+        return await asyncio.get_event_loop().run_in_executor(None, self._read)
+
+    async def add(self, record: KeyRecord) -> bool:
+        return await asyncio.get_event_loop().run_in_executor(None, self._add, record)
+
+    async def remove(self, kid: str):
+        await asyncio.get_event_loop().run_in_executor(None, self._remove, kid)
+
+
+class DatabaseKeyStore:
+    """密钥保存在 eva_signing_key 表中，多台机器共享；version 唯一，并发生成或轮换时只有一个能写入成功"""
+
+    async def load(self) -> List[KeyRecord]:
+        rows = await SigningKey.all().order_by("version").values_list("version", "kid", "private_key", "activates_at")
+        return [KeyRecord(*row) for row in rows]
+
+    async def add(self, record: KeyRecord) -> bool:
+        try:
+            await SigningKey.create(**record._asdict())
+        except IntegrityError:
+            return False
+        return True
+
+    async def remove(self, kid: str):
+        await SigningKey.filter(kid=kid).delete()
+
+
+def create_key_store(name: Optional[str] = None):
+    name = name or config.settings.jwt_key_store or ("memory" if config.settings.env == "test" else "database")
+    if name == "memory":
+        return MemoryKeyStore()
+    if name == "file":
+        return FileKeyStore(config.settings.jwt_key_file)
+    if name == "database":
+        return DatabaseKeyStore()
+    raise ValueError(f"unknown jwt key store {name}")
+
+
+class KeyManager:
+    """
+    从 store 加载签名密钥到 KeyRing。存储为空时生成一个并写入，多个 worker 同时首次启动时只有一个写入成功，
+    其余重新读取后使用同一个密钥。轮换和 retire 写入 store 后通过 invalidation_bus 的 "keys" 通知各 worker 重新加载，
+    另外每 reload_interval 秒重新加载一次，以防错过通知。
+    轮换出的新密钥先只用于校验，经过 promote_delay 秒（默认两个 reload_interval）后才开始签发，
+    此时所有 worker 都已加载它，不会出现某个 worker 还不认识新 token 的 kid 的情况。
+    """
+
+    def __init__(self, ring: KeyRing, store, reload_interval: float = 60):
+        self.ring = ring
+        self.store = store
+        self.reload_interval = reload_interval
+        self.loaded: Tuple[Tuple[str, ...], str] = ((), "")
+        self._task: Optional[asyncio.Task] = None
+        self._promotion: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def promote_delay(self) -> float:
+        return 2 * self.reload_interval
+
+    @staticmethod
+    async def generate(version: int, activates_at: float = 0) -> KeyRecord:
+        record = await asyncio.get_event_loop().run_in_executor(None, KeyRecord.generate, version)
+        return record._replace(activates_at=activates_at)
+
+    async def load(self):
+        records = await self.store.load()
+        if not records:
+            if await self.store.add(await self.generate(version=1)):
+                logger.info("generated the first jwt signing key")
+            records = await self.store.load()
+        now = time.time()
+        signer = signer_of(records, now)
+        loaded = (tuple(r.kid for r in records), signer.kid)
+        if loaded != self.loaded:
+            # KeyRing.load 使用最后一个私钥签发
+            private_keys = [r.private_key for r in records if r is not signer] + [signer.private_key]
+            self.ring.load(private_keys, config.settings.jwt_public_keys)
+            self.loaded = loaded
+        self._schedule_promotion([r.activates_at - now for r in records if r.activates_at > now])
+
+    def _schedule_promotion(self, delays: List[float]):
+        """在下一个待生效的密钥生效时重新加载，不必等到定期重新加载"""
+        if self._promotion is not None:
+            self._promotion.cancel()
+            self._promotion = None
+        if delays and self._task is not None:
+            self._promotion = asyncio.get_event_loop().call_later(min(delays), self.reload)
+
+    async def rotate(self, delay: Optional[float] = None) -> KeyRecord:
+        """生成新密钥，delay 秒后（默认 promote_delay）开始签发；旧密钥保留用于校验，直到被 retire"""
+        activates_at = time.time() + (self.promote_delay if delay is None else delay)
+        while True:
+            records = await self.store.load()
+            record = await self.generate(records[-1].version + 1 if records else 1, activates_at)
+            if await self.store.add(record):
+                break
+        await self.load()
+        invalidation_bus.publish("keys")
+        return record
+
+    async def retire(self, kid: str):
+        records = await self.store.load()
+        if records and signer_of(records, time.time()).kid == kid:
+            raise ValueError("can not retire the current signing key")
+        await self.store.remove(kid)
+        await self.load()
+        invalidation_bus.publish("keys")
+
+    async def _reload(self):
+        try:
+            await self.load()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to reload jwt signing keys")
+
+    def reload(self, _key: Optional[str] = None):
+        """invalidation_bus 的订阅者，在后台重新加载"""
+        if self._task is not None:
+            asyncio.ensure_future(self._reload())
+
+    async def _reload_periodically(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await self._reload()
+
+    async def start(self):
+        if self.store is None:
+            return
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._reload_periodically())
+        await self.load()
+
+    async def close(self):
+        if self._promotion is not None:
+            self._promotion.cancel()
+            self._promotion = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# 配置了 jwt_private_key 时 key_ring 在导入时直接使用它，不读写 store
+key_manager = KeyManager(
+    key_ring,
+    store=None if config.settings.jwt_private_key else create_key_store(),
+    reload_interval=config.settings.jwt_key_reload_interval,
+)
+invalidation_bus.subscribe("keys", key_manager.reload)
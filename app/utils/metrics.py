@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+from app.core import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"bucket_counts": list(self.bucket_counts), "count": self.count, "sum": self.sum}
+
+    def merge(self, snapshot: Dict[str, Any]):
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, snapshot["bucket_counts"])]
+        self.count += snapshot["count"]
+        self.sum += snapshot["sum"]
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"value": self.value}
+
+    def merge(self, snapshot: Dict[str, Any]):
+        self.value += snapshot["value"]
+
+
+class GaugeValue(CounterValue):
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+V = TypeVar("V", CounterValue, GaugeValue, HistogramValue)
+
+
+class Metric(Generic[V]):
+    """进程内的指标，按标签分别统计，接口与 prometheus_client 保持一致；子类给出类型名和每组标签的值"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], V] = {}
+        registry.append(self)
+
+    def new_value(self) -> V:
+        raise NotImplementedError
+
+    def labels(self, **labels) -> V:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = self.new_value()
+        return value
+
+
+class Counter(Metric[CounterValue]):
+    """只增不减的计数，如请求数"""
+
+    kind = "counter"
+
+    def new_value(self) -> CounterValue:
+        return CounterValue()
+
+
+class Gauge(Metric[GaugeValue]):
+    """瞬时值，如正在处理的请求数"""
+
+    kind = "gauge"
+
+    def new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+
+class Histogram(Metric[HistogramValue]):
+    """观测值的分布，如请求耗时"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+
+registry: List[Metric] = []
+
+
+def snapshot() -> Dict[str, List[Tuple[List[str], Dict[str, Any]]]]:
+    return {
+        metric.name: [(list(key), value.snapshot()) for key, value in list(metric.values.items())]
+        for metric in registry
+    }
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WorkerSnapshots:
+    """
+    多 worker 部署时，每个 worker 每隔 interval 秒把自己的指标写入 directory/<pid>.json，
+    响应 /metrics 的 worker 合并全部文件后输出，Prometheus 抓取到的始终是整个实例的总数。
+    计数器和直方图包括已退出的 worker，避免总数回退；瞬时值只计入仍在运行的 worker。
+    directory 应在启动 worker 之前清空，见 scripts/start-production.sh。
+    """
+
+    def __init__(self, directory: str, interval: float = 5):
+        self.directory = directory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    def dump(self, data: Optional[Dict[str, Any]] = None):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data if data is not None else snapshot(), f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def collect(self) -> List[Tuple[Metric, Dict[Tuple[str, ...], Any]]]:
+        self.dump()
+        merged: Dict[str, Dict[Tuple[str, ...], Any]] = {metric.name: {} for metric in registry}
+        metrics = {metric.name: metric for metric in registry}
+        for name in os.listdir(self.directory):
+            pid, suffix = os.path.splitext(name)
+            if suffix != ".json" or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = pid_alive(int(pid))
+            for metric_name, values in data.items():
+                metric = metrics.get(metric_name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for key, value in values:
+                    target = merged[metric_name].get(tuple(key))
+                    if target is None:
+                        target = merged[metric_name][tuple(key)] = metric.new_value()
+                    target.merge(value)
+        return [(metric, merged[metric.name]) for metric in registry]
+
+    async def _dump_periodically(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # 在事件循环中取快照，在线程中写文件
+                await loop.run_in_executor(None, self.dump, snapshot())
+            except OSError:
+                logger.exception("failed to write metrics snapshot")
+
+    async def start(self):
+        if self._task is None:
+            self.dump()
+            self._task = asyncio.ensure_future(self._dump_periodically())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self.dump()
+
+
+def create_worker_snapshots() -> Optional[WorkerSnapshots]:
+    settings = config.settings
+    directory = settings.metrics_dir or (None if settings.env == "test" else "/tmp/eva-metrics")
+    return WorkerSnapshots(directory, settings.metrics_flush_interval) if directory else None
+
+
+worker_snapshots = create_worker_snapshots()
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render() -> str:
+    """按 Prometheus 文本格式输出 registry 中的全部指标，配置了 worker_snapshots 时合并各 worker 的值"""
+    if worker_snapshots is not None:
+        collected = worker_snapshots.collect()
+    else:
+        collected = [(metric, dict(metric.values)) for metric in registry]
+    lines = []
+    for metric, values in collected:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in values.items():
+            if isinstance(value, HistogramValue):
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.bucket_counts):
+                    cumulative += count
+                    le = _labels(metric.labelnames, key, f'le="{_number(bound)}"')
+                    lines.append(f"{metric.name}_bucket{le} {cumulative}")
+                le = _labels(metric.labelnames, key, 'le="+Inf"')
+                lines.append(f"{metric.name}_bucket{le} {value.count}")
+                lines.append(f"{metric.name}_sum{_labels(metric.labelnames, key)} {_number(value.sum)}")
+                lines.append(f"{metric.name}_count{_labels(metric.labelnames, key)} {value.count}")
+            else:
+                lines.append(f"{metric.name}{_labels(metric.labelnames, key)} {_number(value.value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware import gzip
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import config
+from app.utils import queries
+from app.utils.metrics import Counter, CounterValue, Gauge, Histogram, HistogramValue
+
+logger = logging.getLogger(__name__)
+
+http_request_duration = Histogram(
+    "eva_http_request_duration_seconds", "Latency of HTTP requests", labelnames=["method", "route", "status"]
+)
+http_requests_in_progress = Gauge("eva_http_requests_in_progress", "HTTP requests being processed")
+http_request_queries = Histogram(
+    "eva_http_request_queries",
+    "Number of ORM queries executed per HTTP request",
+    labelnames=["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+http_request_db_time = Histogram(
+    "eva_http_request_db_seconds", "Total time spent in ORM queries per HTTP request", labelnames=["route"]
+)
+repeated_queries = Counter(
+    "eva_http_repeated_queries_total",
+    "HTTP requests that executed the same statement at least query_repeat_threshold times (possible N+1)",
+    labelnames=["route"],
+)
+in_progress = http_requests_in_progress.labels()
+
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """与 starlette 的 GZipMiddleware 相同，但不会再次压缩已经带有 Content-Encoding 的响应（如预压缩的 JWKS）"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = GZipResponder(self.app, self.minimum_size)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class GZipResponder(gzip.GZipResponder):
+    passthrough = False
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start" and "content-encoding" in Headers(raw=message["headers"]):
+            self.passthrough = True
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
+
+
+class RouteMetrics(NamedTuple):
+    route: str
+    duration: HistogramValue
+    queries: HistogramValue
+    db_time: HistogramValue
+    repeated: CounterValue
+
+
+class MetricsMiddleware:
+    """
+    记录每个请求的耗时、进行中的请求数，以及执行的 ORM 查询数、数据库耗时和最慢的语句。
+    route 标签取路由模板（如 /api/identity/{uuid}），未匹配到路由的请求统一记为 unmatched，避免标签基数膨胀。
+    同类语句在一个请求中执行 query_repeat_threshold 次以上时记一条警告日志（多半是 N+1 查询）；
+    开启 query_debug_headers 时在响应头中返回查询统计，仅用于调试。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.routes: Dict[Callable, str] = {}
+        self.queries_installed = False
+        # (endpoint, method, status) -> 对应的指标值，省去每个请求构造标签
+        self.metrics: Dict[Tuple[Optional[Callable], str, int], RouteMetrics] = {}
+
+    def route_of(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self.routes.get(endpoint)
+        if route is None:
+            self.routes = {r.endpoint: r.path for r in scope["app"].routes if hasattr(r, "endpoint")}
+            route = self.routes.setdefault(endpoint, getattr(endpoint, "__name__", "unknown"))
+        return route
+
+    def metrics_of(self, scope: Scope, status: int) -> RouteMetrics:
+        key = (scope.get("endpoint"), scope["method"], status)
+        metrics = self.metrics.get(key)
+        if metrics is None:
+            route = self.route_of(scope)
+            metrics = self.metrics[key] = RouteMetrics(
+                route=route,
+                duration=http_request_duration.labels(method=scope["method"], route=route, status=status),
+                queries=http_request_queries.labels(route=route),
+                db_time=http_request_db_time.labels(route=route),
+                repeated=repeated_queries.labels(route=route),
+            )
+        return metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        debug_headers = config.settings.query_debug_headers
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if debug_headers:
+                    headers = MutableHeaders(raw=message["headers"])
+                    headers["X-DB-Query-Count"] = str(stats.count)
+                    headers["X-DB-Query-Time"] = f"{stats.duration * 1000:.3f}"
+                    if stats.slowest:
+                        slowest = " ".join(stats.slowest.split())[:500]
+                        headers["X-DB-Slowest-Query"] = slowest.encode("latin-1", "replace").decode("latin-1")
+            await send(message)
+
+        if not self.queries_installed:
+            # Tortoise.init 在 startup 时才导入数据库后端，所以在第一个请求时再安装查询计数
+            queries.install()
+            self.queries_installed = True
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            with queries.count_queries(track=True) as stats:
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            in_progress.dec()
+            metrics = self.metrics_of(scope, status)
+            metrics.duration.observe(duration)
+            metrics.queries.observe(stats.count)
+            metrics.db_time.observe(stats.duration)
+            repeated = stats.repeated(config.settings.query_repeat_threshold)
+            if repeated:
+                metrics.repeated.inc()
+            self.log(scope, metrics.route, status, duration, stats, repeated)
+
+    @staticmethod
+    def log(  # pylint: disable=too-many-arguments
+        scope: Scope,
+        route: str,
+        status: int,
+        duration: float,
+        stats: queries.QueryStats,
+        repeated: List[Tuple[str, int]],
+    ):
+        if stats.count and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s %s %d %.1fms: %d queries in %.1fms, slowest %.1fms: %s",
+                scope["method"],
+                route,
+                status,
+                duration * 1000,
+                stats.count,
+                stats.duration * 1000,
+                stats.slowest_duration * 1000,
+                stats.slowest,
+            )
+        for sql, count in repeated:
+            logger.warning("%s %s executed %d similar queries, possible N+1: %s", scope["method"], route, count, sql)
@@ -1,10 +1,16 @@
 import asyncio
-from typing import Generic, List, Type, TypeVar
+import base64
+import json
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Generic, List, Optional, Type, TypeVar
 
 from fastapi import Query
+from fastapi.responses import ORJSONResponse
 from pydantic.generics import GenericModel
+from tortoise.query_utils import Q
 from tortoise.queryset import QuerySet
 
+from app.controllers import EvaException
 from app.schemas import Schema
 
 default_offset = 0
@@ -14,22 +20,117 @@ default_limit = 10
 max_limit = 1000
 
 DataT = TypeVar("DataT")
+Projection = Callable[[QuerySet], Awaitable[List[Dict[str, Any]]]]
 
 
 class PaginationResult(GenericModel, Generic[DataT]):
-    count: int
+    count: Optional[int]
+    next: Optional[str]
     results: List[DataT]
 
 
+def encode_cursor(order_by: str, value, pk: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([order_by, value, pk], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order_by: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_order_by, value, pk = json.loads(raw)
+        if cursor_order_by != order_by:
+            raise ValueError
+        if order_by == "created_at":
+            value = datetime.fromisoformat(value)
+        return value, int(pk)
+    except (ValueError, TypeError):
+        raise EvaException(message="invalid cursor")
+
+
+async def estimate_count(qs: QuerySet) -> int:
+    """PostgreSQL 下使用查询计划估算的行数代替 count(*)，其他数据库仍然精确计数"""
+    if qs.model._meta.db.capabilities.dialect != "postgres":  # pylint: disable=protected-access
+        return await qs.count()
+    plan = (await qs.explain())[0]["QUERY PLAN"]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 class Pagination:
+    """
+    两种分页方式：
+    - offset：LIMIT/OFFSET 分页，兼容旧的客户端；
+    - cursor：传入上一页返回的 next，按 order_by 做 keyset 分页，翻页深度不影响查询代价。
+    count 可选 exact（精确计数）、estimate（估算）或 none（不计数）。
+    """
+
     def __init__(
         self,
         limit: int = Query(default=default_limit, ge=1, le=max_limit),
         offset: int = Query(default=default_offset, ge=0, le=max_offset),
-    ):
+        cursor: Optional[str] = Query(default=None, description="上一页响应中的 next，传入后忽略 offset"),
+        order_by: str = Query(default="id", regex="^(id|created_at)$"),
+        count: str = Query(default="exact", regex="^(exact|estimate|none)$"),
+    ):  # pylint: disable=too-many-arguments
         self.limit = limit
         self.offset = offset
+        self.cursor = cursor
+        self.order_by = order_by
+        self.count = count
+
+    async def _count(self, qs: QuerySet) -> Optional[int]:
+        if self.count == "exact":
+            return await qs.count()
+        if self.count == "estimate":
+            return await estimate_count(qs)
+        return None
+
+    def _page(self, qs: QuerySet) -> QuerySet:
+        page = qs.order_by(self.order_by, "id") if self.order_by != "id" else qs.order_by("id")
+        if not self.cursor:
+            return page.offset(self.offset).limit(self.limit)
+        value, pk = decode_cursor(self.cursor, self.order_by)
+        if self.order_by == "id":
+            return page.filter(id__gt=pk).limit(self.limit)
+        return page.filter(Q(**{f"{self.order_by}__gt": value}) | Q(**{self.order_by: value, "id__gt": pk})).limit(
+            self.limit
+        )
+
+    def _next(self, rows: List[Dict[str, Any]]) -> Optional[str]:
+        if len(rows) < self.limit:
+            return None
+        last = rows[-1]
+        return encode_cursor(self.order_by, last[self.order_by], last["id"])
+
+    async def apply(
+        self, qs: QuerySet, schema: Type[Schema], projection: Optional[Projection] = None, fast: bool = True
+    ):
+        """
+        projection 为 schemas.project_* 这类函数时，按本页的 id 批量取出详情，
+        无论每页多少条，额外的查询次数都是固定的。
 
-    async def apply(self, qs: QuerySet, schema: Type[Schema]):
-        count, results = await asyncio.gather(qs.count(), qs.limit(self.limit).offset(self.offset))
-        return PaginationResult(count=count, results=[schema.from_orm(obj) for obj in results])
+        fast 时直接用 values() 取出的行按 schema 的字段组装响应，并用 orjson 编码返回，
+        跳过逐行构造 schema 以及 response_model 的二次校验；数据来自数据库、类型已与 schema 一致时才适用。
+        需要 schema 做校验或转换的路由传 fast=False，返回的 PaginationResult 照常经过 response_model。
+        """
+        columns = ["id", self.order_by] if projection else ["id", self.order_by, *schema.__fields__]
+        # 先构造分页查询，游标无效时直接报错，不会留下未 await 的计数协程
+        page = self._page(qs).values(*dict.fromkeys(columns))
+        count, rows = await asyncio.gather(self._count(qs), page)
+        if projection is None:
+            items = rows
+        else:
+            projected = {item["id"]: item for item in await projection(qs.model.filter(id__in=[r["id"] for r in rows]))}
+            items = [projected[row["id"]] for row in rows]
+        if not fast:
+            return PaginationResult(count=count, next=self._next(rows), results=[schema(**item) for item in items])
+        return ORJSONResponse(
+            {
+                "count": count,
+                "next": self._next(rows),
+                "results": [schema.pick(item) for item in items],
+            }
+        )
@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import json
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+
+from app.models import Permission, PermissionBit, Role, meta
+from app.utils.invalidation import invalidation_bus
+
+
+def encode_mask(mask: int) -> str:
+    """第 i 位对应第 i // 8 个字节的第 i % 8 位（小端），编码为不带填充的 base64url"""
+    raw = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_mask(encoded: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)), "little")
+
+
+async def allocate_bits(codes: Sequence[str]) -> List[Optional[str]]:
+    """
+    codes 按 Permission id 排列，为其中尚未分配位的权限按此顺序追加分配，返回按位排列的全部 code（包括已删除的权限）。
+    多个 worker 同时分配时只有一个写入成功，其余重新读取。
+    """
+    while True:
+        allocated = dict(await PermissionBit.all().values_list("code", "bit"))
+        missing = [code for code in codes if code not in allocated]
+        if not missing:
+            break
+        start = max(allocated.values(), default=-1) + 1
+        try:
+            async with in_transaction(meta(PermissionBit).default_connection) as conn:
+                await PermissionBit.bulk_create(
+                    [PermissionBit(bit=start + i, code=code) for i, code in enumerate(missing)], using_db=conn
+                )
+        except IntegrityError:
+            continue
+    bits: List[Optional[str]] = [None] * (max(allocated.values(), default=-1) + 1)
+    for code, bit in allocated.items():
+        bits[bit] = code
+    return bits
+
+
+class PermissionIndex(NamedTuple):
+    """
+    RBAC 矩阵编译结果：每个权限 code 占一个位（见 PermissionBit，只追加，删除的权限留下空位），每个角色对应其权限的位掩码。
+    version 是已分配的位数，只在新增权限时增加；位的含义不会改变，token 中的 perms_v 不大于当前 version 时
+    都可以按当前索引解码。etag 是内容的哈希，角色权限变更时也会改变。
+    """
+
+    version: int
+    codes: List[Optional[str]]
+    role_masks: Dict[str, int]
+    etag: str
+    body: bytes
+
+    @classmethod
+    def build(cls, codes: List[Optional[str]], role_permissions: Dict[str, Iterable[str]]) -> "PermissionIndex":
+        """codes[i] 为第 i 位对应的权限 code，已删除的权限为 None"""
+        positions = {code: bit for bit, code in enumerate(codes) if code is not None}
+        role_masks = {
+            role: sum(1 << positions[code] for code in set(permission_codes))
+            for role, permission_codes in role_permissions.items()
+        }
+        content = {
+            "version": len(codes),
+            "permissions": codes,
+            "roles": {role: encode_mask(mask) for role, mask in role_masks.items()},
+        }
+        body = json.dumps(content, separators=(",", ":"), sort_keys=True).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        return cls(version=len(codes), codes=codes, role_masks=role_masks, etag=etag, body=body)
+
+    @classmethod
+    async def compile(cls) -> "PermissionIndex":
+        live = await Permission.all().order_by("id").values_list("code", flat=True)
+        alive = set(live)
+        codes = [code if code in alive else None for code in await allocate_bits(live)]
+        role_permissions: Dict[str, List[str]] = {}
+        for row in await Role.all().values("code", "permissions__code"):
+            permissions = role_permissions.setdefault(row["code"], [])
+            if row["permissions__code"] is not None:
+                permissions.append(row["permissions__code"])
+        return cls.build(codes, role_permissions)
+
+    def mask_of_roles(self, role_codes: Iterable[str]) -> int:
+        mask = 0
+        for code in role_codes:
+            mask |= self.role_masks.get(code, 0)
+        return mask
+
+    def claims(self, role_codes: Iterable[str]) -> Dict[str, str]:
+        return {"perms": encode_mask(self.mask_of_roles(role_codes)), "perms_v": self.version}
+
+
+class PermissionIndexHolder:
+    """进程内缓存编译好的索引，RBAC 变更时调用 invalidate，下次使用时重新编译"""
+
+    def __init__(self):
+        self._index: Optional[PermissionIndex] = None
+        self._generation = 0
+
+    async def get(self) -> PermissionIndex:
+        if self._index is not None:
+            return self._index
+        generation = self._generation
+        index = await PermissionIndex.compile()
+        if generation == self._generation:  # 编译期间发生变更则不缓存这次的结果
+            self._index = index
+        return index
+
+    def invalidate(self):
+        self._index = None
+        self._generation += 1
+
+
+permission_index = PermissionIndexHolder()
+invalidation_bus.subscribe("permission_index", lambda _: permission_index.invalidate())
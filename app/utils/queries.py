@@ -0,0 +1,117 @@
+import collections
+import functools
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+QUERY_METHODS = ("execute_insert", "execute_many", "execute_query", "execute_query_dict", "execute_script")
+
+
+# 把字面量替换为 ?，使只有参数不同的语句归为一类
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\$\d+")
+
+
+def normalize(sql: str) -> str:
+    return LITERALS.sub("?", sql)
+
+
+class QueryStats:
+    """
+    查询次数和总耗时；track=True 时还记录最慢的语句和每类语句（见 normalize）的执行次数，用于发现 N+1 查询。
+    嵌套统计时查询同时计入外层。
+    """
+
+    def __init__(self, track: bool = False, parent: Optional["QueryStats"] = None):
+        self.count = 0
+        self.duration = 0.0
+        self.track = track
+        self.parent = parent
+        self.slowest: Optional[str] = None
+        self.slowest_duration = 0.0
+        self.statements: "collections.Counter[str]" = collections.Counter()
+
+    def add(self, duration: float, sql: Optional[str] = None):
+        self.count += 1
+        self.duration += duration
+        if self.track and sql is not None:
+            self.statements[normalize(sql)] += 1
+            if duration >= self.slowest_duration:
+                self.slowest, self.slowest_duration = sql, duration
+        if self.parent is not None:
+            self.parent.add(duration, sql)
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """执行了至少 threshold 次的同类语句，多半是循环里的查询"""
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+# 进程内全部 ORM 查询的累计值
+total = QueryStats()
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def _wrap(method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            total.add(duration)
+            stats = _current.get()
+            if stats is not None:
+                stats.add(duration, args[0] if args and isinstance(args[0], str) else None)
+
+    wrapper.counted = True
+    return wrapper
+
+
+def install():
+    """
+    给所有已加载的数据库客户端类的 execute_* 方法加上计数，可重复调用。
+    数据库后端的类在 Tortoise.init 时才会被导入，因此应在其之后调用。
+    """
+    pending = [BaseDBAsyncClient]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        for name in QUERY_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "counted", False):
+                setattr(cls, name, _wrap(method))
+
+
+@contextmanager
+def count_queries(track: bool = False) -> Iterator[QueryStats]:
+    """统计 with 块内（包括其中创建的子任务）执行的查询"""
+    stats = QueryStats(track=track, parent=_current.get())
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+class TooManyQueries(AssertionError):
+    pass
+
+
+@contextmanager
+def max_queries(limit: int) -> Iterator[QueryStats]:
+    """
+    断言 with 块内执行的查询不超过 limit 条，超出时列出执行过的语句，用于在测试中防止查询数退化：
+
+        with max_queries(2):
+            client.get("/api/identity/...")
+    """
+    install()
+    with count_queries(track=True) as stats:
+        yield stats
+    if stats.count > limit:
+        statements = "\n".join(f"  {count} x {sql}" for sql, count in stats.statements.most_common())
+        raise TooManyQueries(f"expected at most {limit} queries, got {stats.count}:\n{statements}")
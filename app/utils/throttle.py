@@ -0,0 +1,203 @@
+import asyncio
+import ipaddress
+import logging
+import math
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from starlette.requests import Request
+
+from app.controllers import EvaException
+from app.core import config
+from app.utils.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Retry-After 的上限（秒）；per_minute 为 0 时不再补充令牌，等待时间为无穷大
+MAX_RETRY_AFTER = 86400
+
+login_throttle_rejected = Counter(
+    "eva_login_throttle_rejected_total", "Login attempts rejected before password verification", labelnames=["scope"]
+)
+
+
+class Limit(NamedTuple):
+    """令牌桶：最多积攒 burst 个令牌，每分钟补充 per_minute 个"""
+
+    burst: int
+    per_minute: float
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60
+
+    def take(self, tokens: float, updated: float, now: float) -> Tuple[bool, float, float]:
+        """返回 (是否放行, 剩余令牌数, 距离下一个令牌的秒数)"""
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return True, tokens - 1, 0.0
+        return False, tokens, (1 - tokens) / self.rate if self.rate else math.inf
+
+
+class MemoryBackend:
+    """进程内的令牌桶，只对当前 worker 生效；超过 maxsize 时淘汰最久未使用的桶"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (limit.burst, now))
+        allowed, tokens, retry_after = limit.take(tokens, updated, now)
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+    async def close(self):
+        self.buckets.clear()
+
+
+class SQLiteBackend:
+    """
+    同一台机器上的多个 worker 共享一个 SQLite 文件，每次取令牌是一个 IMMEDIATE 事务。
+    SQLite 的调用在单独的线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str, cleanup_interval: int = 1000, lock_timeout: float = 1):
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self.lock_timeout = lock_timeout
+        self.calls = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="login-throttle")
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.path, timeout=self.lock_timeout, isolation_level=None, check_same_thread=False
+            )
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+        return self.conn
+
+    def _take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        conn = self._connect()
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as err:
+            # 等待写锁超时：拒绝本次登录而不是放行，避免限流在高负载时失效
+            logger.warning("login throttle is unavailable: %s", err)
+            raise EvaException(
+                message="login is temporarily unavailable, please try again later",
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+        try:
+            row = conn.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (limit.burst, now)
+            allowed, tokens, retry_after = limit.take(tokens, updated, now)
+            conn.execute("INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            self.calls += 1
+            if self.calls % self.cleanup_interval == 0:
+                # 超过一天未访问的桶早已补满，删除它们与保留它们等价
+                conn.execute("DELETE FROM bucket WHERE updated < ?", (now - 86400,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+    async def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._take, key, limit)
+
+    async def close(self):
+        if self.conn is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=False)
+
+
+class LoginThrottle:
+    """
+    登录限流：在查询数据库和校验密码之前，按 identifier 和客户端 IP（ip_limit 为 None 时不限）分别取令牌，
+    任一令牌桶为空即拒绝，被拒绝的尝试不会产生任何 Argon2 运算。
+    只有来自 trusted_proxies 的请求才会采用 X-Forwarded-For 中的客户端地址。
+    """
+
+    def __init__(
+        self, backend, identifier_limit: Limit, ip_limit: Optional[Limit], trusted_proxies: Sequence[str] = ()
+    ):
+        self.backend = backend
+        self.identifier_limit = identifier_limit
+        self.ip_limit = ip_limit
+        self.trusted_proxies = [ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies]
+
+    def _trusted(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def client_ip(self, request: Request) -> Optional[str]:
+        """从右往左跳过 X-Forwarded-For 中的可信代理，第一个不可信的地址即客户端"""
+        host = request.client.host if request.client else None
+        if not host or not self._trusted(host):
+            return host
+        forwarded: List[str] = [
+            address.strip() for address in request.headers.get("x-forwarded-for", "").split(",") if address.strip()
+        ]
+        for address in reversed(forwarded):
+            if not self._trusted(address):
+                return address
+        return forwarded[0] if forwarded else host
+
+    async def check(self, identifier_type: str, identifier: str, ip: Optional[str]):
+        checks = [("identifier", f"identifier:{identifier_type}:{identifier.lower()}", self.identifier_limit)]
+        if ip and self.ip_limit:
+            checks.append(("ip", f"ip:{ip}", self.ip_limit))
+        for scope, key, limit in checks:
+            allowed, retry_after = await self.backend.take(key, limit)
+            if not allowed:
+                login_throttle_rejected.labels(scope=scope).inc()
+                raise EvaException(
+                    message="too many login attempts, please try again later",
+                    status_code=429,
+                    headers={"Retry-After": str(math.ceil(min(retry_after, MAX_RETRY_AFTER)))},
+                )
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_login_throttle() -> Optional[LoginThrottle]:
+    settings = config.settings
+    if not settings.login_throttle_enabled:
+        return None
+    name = settings.login_throttle_backend or ("memory" if settings.env == "test" else "sqlite")
+    if name == "sqlite":
+        backend = SQLiteBackend(settings.login_throttle_sqlite_path)
+    elif name == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"unknown login throttle backend {name}")
+    ip_limit = Limit(settings.login_throttle_ip_burst, settings.login_throttle_ip_per_minute)
+    return LoginThrottle(
+        backend,
+        identifier_limit=Limit(settings.login_throttle_identifier_burst, settings.login_throttle_identifier_per_minute),
+        ip_limit=ip_limit if settings.login_throttle_ip_enabled else None,
+        trusted_proxies=settings.login_throttle_trusted_proxies,
+    )
+
+
+async def login_throttle(request: Request) -> Optional[LoginThrottle]:
+    return request.app.state.login_throttle
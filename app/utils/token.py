@@ -1,8 +1,11 @@
+import hashlib
+import time
 import uuid
 from datetime import datetime, timedelta
 from typing import Dict, Optional, Sequence, Union
 
-from authlib.jose import JsonWebKey, jwt
+from authlib.common.encoding import to_bytes
+from authlib.jose import JsonWebToken
 from authlib.jose.errors import JoseError
 from fastapi import HTTPException
 from fastapi.security import HTTPBearer
@@ -12,18 +15,37 @@ from tortoise import timezone
 
 from app.controllers import EvaException
 from app.core.config import settings
+from app.utils.cache import TTLCache
+from app.utils.keyring import KeyRing, key_ring
+from app.utils.metrics import Histogram
+
+jwt_duration = Histogram(
+    "eva_jwt_duration_seconds",
+    "Duration of JWT signing and signature verification (verify cache hits are not observed)",
+    labelnames=["operation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+
+# 只接受 RS256，避免 alg 混淆（如使用公钥作为 HS256 密钥伪造签名）
+jwt = JsonWebToken(["RS256"])
 
 
 class AuthJWT:
     def __init__(
         self,
-        private_key=settings.jwt_private_key.get_secret_value(),
+        keys: KeyRing = key_ring,
         issuer: Optional[str] = settings.jwt_issuer,
         audience: Optional[Union[str, Sequence[str]]] = settings.jwt_audience,
     ):
-        self.private_key = private_key
+        self.keys = keys
         self.issuer = issuer
         self.audience = audience
+        # 命中率见 /metrics 中的 eva_cache_requests_total{cache="jwt_verify"}
+        self.cache = TTLCache(
+            maxsize=settings.jwt_verify_cache_size,
+            ttl=settings.jwt_verify_cache_ttl.total_seconds(),
+            name="jwt_verify",
+        )
 
     def _create_token(
         self,
@@ -49,9 +71,9 @@ class AuthJWT:
         if self.audience:
             claims["aud"] = self.audience
 
-        key = JsonWebKey.import_key(self.private_key)
-        headers = {"alg": "RS256", "kid": key.thumbprint()}
-        return jwt.encode(header=headers, payload=claims, key=key)
+        headers = {"alg": "RS256", "kid": self.keys.kid}
+        with jwt_duration.labels(operation="sign").time():
+            return jwt.encode(header=headers, payload=claims, key=self.keys.signing_key)
 
     @staticmethod
     def _get_expired_time(
@@ -106,11 +128,30 @@ class AuthJWT:
         )
 
     def verify_token(self, encoded_token: str) -> Dict[str, Union[str, int, bool]]:
+        """
+        校验通过的 token 会以其 sha256 摘要为 key 缓存到过期时间为止，重复校验时跳过 RSA 运算。
+        命中缓存时仍需确认签名所用的密钥没有被 retire。
+        """
+        cacheable = len(encoded_token) <= settings.jwt_verify_cache_max_token_size
+        digest = hashlib.sha256(to_bytes(encoded_token)).digest() if cacheable else None
+        claims = self.cache.get(digest) if cacheable else None
+        if claims is not None and claims.header.get("kid") in self.keys.verify_keys:
+            return claims
+
         try:
-            return jwt.decode(encoded_token, key=self.private_key)
+            with jwt_duration.labels(operation="verify").time():
+                claims = jwt.decode(encoded_token, key=self.keys.find_verify_key)
+            claims.validate()
         except JoseError as err:
             raise EvaException(status_code=403, message=err.error)
 
+        ttl = self.cache.ttl
+        if claims.get("exp"):
+            ttl = min(ttl, claims["exp"] - time.time())
+        if cacheable and ttl > 0:
+            self.cache.set(digest, claims, ttl=ttl)
+        return claims
+
 
 auth_jwt = AuthJWT()
 
@@ -1,15 +1,25 @@
 import asyncio
+import json
 import multiprocessing
 import os
 import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
 from typing import List, Optional
 
 import typer
 import uvicorn
-from tortoise import Tortoise, transactions
+from pydantic import ValidationError
+from tortoise import Tortoise
 
+from app import schemas
+from app.controllers import EvaException
 from app.core import config
-from app.models import Credential, Identity, Password, Role
+from app.models import Credential, Identity, Role
+from app.utils import bulk_rbac, encrypt, identity_io, keystore
+from app.utils.invalidation import invalidation_bus
 
 cmd = typer.Typer()
 
@@ -67,31 +77,200 @@ def lint():
     subprocess.call(["prospector", "app"])
 
 
+@cmd.command(help="benchmark this host and suggest argon2 parameters for the target verify latency")
+def calibrate_argon2(
+    target_ms: float = 50,
+    percentile: float = 95,
+    samples: int = 20,
+    max_memory_cost: int = config.settings.argon2_memory_cost,
+    parallelism: int = config.settings.argon2_parallelism,
+):
+    params = encrypt.calibrate(
+        target=target_ms,
+        max_memory_cost=max_memory_cost,
+        parallelism=parallelism,
+        samples=samples,
+        percentile=percentile,
+    )
+    typer.secho(f"p{percentile:g} verify latency: {params['latency']}ms", fg=typer.colors.GREEN)
+    typer.echo(f"ARGON2_TIME_COST={params['time_cost']}")
+    typer.echo(f"ARGON2_MEMORY_COST={params['memory_cost']}")
+    typer.echo(f"ARGON2_PARALLELISM={params['parallelism']}")
+
+
 @cmd.command(help="create identity")
 def create_identity(
     identifier_type: Credential.IdentifierType, identifier: str, password: str, role_codes: Optional[List[str]]
+):
+    async def do():
+        body = schemas.IdentityCreate(
+            role_codes=role_codes or None,
+            credentials=[{"identifier_type": identifier_type, "identifier": identifier, "password": password}],
+        )
+        try:
+            identity_uuid = await identity_io.create_identity(body)
+        except EvaException as err:
+            typer.secho(err.message, fg=typer.colors.RED, err=True)
+            raise typer.Exit(1)
+        typer.secho(f"identity create successfully!\nuuid: {identity_uuid}", fg=typer.colors.GREEN)
+        if role_codes:
+            typer.secho(f"roles: {', '.join(role_codes)}", fg=typer.colors.GREEN)
+
+    run_with_database(do)
+
+
+@cmd.command(help="import identities from a NDJSON or CSV file, see POST /api/identity/import for the row format")
+def import_identities(
+    path: Path = typer.Argument(..., exists=True, dir_okay=False),
+    file_format: str = typer.Option(None, "--format", help="ndjson or csv, guessed from the file suffix by default"),
+    chunk_size: int = 500,
+):
+    async def do():
+        await Tortoise.init(config=config.db_config)
+        lines = identity_io.iter_lines(identity_io.read_file(open(path, "rb")))
+        if (file_format or path.suffix.lstrip(".")) == "csv":
+            records = identity_io.parse_csv(lines)
+        else:
+            records = identity_io.parse_ndjson(lines)
+        imported = failed = 0
+        async for result in identity_io.import_identities(records, chunk_size=chunk_size):
+            if "error" in result:
+                failed += 1
+                typer.secho(f"line {result['line']}: {result['error']}", fg=typer.colors.RED, err=True)
+            else:
+                imported += 1
+        typer.secho(f"{imported} identities imported, {failed} failed", fg=typer.colors.GREEN)
+        await Tortoise.close_connections()
+
+    asyncio.get_event_loop().run_until_complete(do())
+
+
+@cmd.command(help="export identities with their roles and credentials as NDJSON")
+def export_identities(
+    output: Path = typer.Option(None, "--output", "-o", dir_okay=False, help="write to file instead of stdout"),
+    batch_size: int = 1000,
+    is_active: Optional[bool] = typer.Option(
+        None, "--active/--inactive", help="only export active/inactive identities"
+    ),
 ):
     async def do():
         await Tortoise.init(config=config.db_config)
-        async with transactions.in_transaction() as tx:
-            if await Credential.filter(identifier_type=identifier_type, identifier=identifier).exists():
-                await tx.rollback()
-                return typer.secho("provided credential already exists", fg=typer.colors.RED)
-
-            identity = Identity()
-            await identity.save()
-            credential = Credential(identity=identity, identifier_type=identifier_type, identifier=identifier)
-            await credential.save()
-            await Password.from_raw(credential=credential, raw_password=password).save()
-            typer.secho(f"identity create successfully!\nuuid: {identity.uuid}", fg=typer.colors.GREEN)
-            if role_codes:
-                roles = await Role.filter(code__in=role_codes)
-                await identity.roles.add(*roles)
-                typer.secho(f"identity roles add successfully!\nroles: {roles}", fg=typer.colors.GREEN)
+        f = open(output, "wb") if output else sys.stdout.buffer
+        try:
+            async for chunk in identity_io.export_identities(batch_size=batch_size, is_active=is_active):
+                f.write(chunk)
+        finally:
+            if output:
+                f.close()
+            await Tortoise.close_connections()
 
     asyncio.get_event_loop().run_until_complete(do())
 
 
+@cmd.command(help="run the in-process benchmark suite and print the report as JSON")
+def bench(
+    db_url: str = typer.Option("sqlite://:memory:", help="a local postgres url can be used as well"),
+    scenario: List[str] = typer.Option(
+        None, help="only run these scenarios, see app/bench/scenarios.py and hydra_login_consent"
+    ),
+    requests: int = 200,
+    concurrency: int = 10,
+    warmup: int = 10,
+    identities: int = 200,
+    hydra_latency_ms: float = typer.Option(2, help="latency injected into every fake Hydra admin call"),
+    output: Path = typer.Option(None, "--output", "-o", dir_okay=False, help="also write the report to this file"),
+    baseline: Path = typer.Option(None, exists=True, dir_okay=False, help="fail if results regress against it"),
+    tolerance: float = typer.Option(0.2, help="allowed relative change of p95 latency and requests/sec"),
+):  # pylint: disable=too-many-arguments
+    from app.bench import runner  # pylint: disable=import-outside-toplevel
+
+    report = asyncio.get_event_loop().run_until_complete(
+        runner.run(
+            db_url,
+            scenario,
+            requests=requests,
+            concurrency=concurrency,
+            warmup=warmup,
+            identities=identities,
+            hydra_latency=hydra_latency_ms / 1000,
+        )
+    )
+    text = json.dumps(report, indent=2)
+    typer.echo(text)
+    if output:
+        output.write_text(text)
+    if baseline:
+        regressions = runner.compare(report, json.loads(baseline.read_text()), tolerance)
+        for regression in regressions:
+            typer.secho(regression, fg=typer.colors.RED, err=True)
+        if regressions:
+            raise typer.Exit(1)
+
+
+def run_with_key_store(action):
+    """连接密钥存储（及数据库）执行 action，结束前把 "keys" 通知发给各 worker"""
+
+    async def do():
+        if keystore.key_manager.store is None:
+            typer.secho("jwt_private_key is configured, the key store is not used", fg=typer.colors.RED, err=True)
+            raise typer.Exit(1)
+        if isinstance(keystore.key_manager.store, keystore.DatabaseKeyStore):
+            await Tortoise.init(config=config.db_config)
+        await invalidation_bus.start()
+        try:
+            await action(keystore.key_manager)
+        finally:
+            await invalidation_bus.close()
+            await Tortoise.close_connections()
+
+    asyncio.get_event_loop().run_until_complete(do())
+
+
+@cmd.command(help="list jwt signing keys in the key store and which one signs new tokens")
+def list_jwt_keys():
+    async def action(manager: keystore.KeyManager):
+        records = await manager.store.load()
+        now = time.time()
+        signer = keystore.signer_of(records, now) if records else None
+        for record in records:
+            if record is signer:
+                status = "signing"
+            elif record.activates_at > now:
+                status = f"signing from {datetime.fromtimestamp(record.activates_at).isoformat(timespec='seconds')}"
+            else:
+                status = "verify only"
+            typer.echo(f"{record.version}\t{record.kid}\t{status}")
+
+    run_with_key_store(action)
+
+
+@cmd.command(help="generate a new jwt signing key, running workers switch to it without a restart")
+def rotate_jwt_key(
+    delay: float = typer.Option(
+        None, help="seconds before the new key signs tokens, two reload intervals by default so every worker knows it"
+    )
+):
+    async def action(manager: keystore.KeyManager):
+        record = await manager.rotate(delay)
+        activates_at = datetime.fromtimestamp(record.activates_at).isoformat(timespec="seconds")
+        typer.secho(f"new signing key: {record.kid}, signs new tokens from {activates_at}", fg=typer.colors.GREEN)
+
+    run_with_key_store(action)
+
+
+@cmd.command(help="remove a previous jwt signing key, tokens signed by it are no longer accepted")
+def retire_jwt_key(kid: str):
+    async def action(manager: keystore.KeyManager):
+        try:
+            await manager.retire(kid)
+        except ValueError as err:
+            typer.secho(str(err), fg=typer.colors.RED, err=True)
+            raise typer.Exit(1)
+        typer.secho(f"retired: {kid}", fg=typer.colors.GREEN)
+
+    run_with_key_store(action)
+
+
 @cmd.command(help="create role")
 def create_role(role_code: str, role_name: str):
     async def do():
@@ -108,6 +287,89 @@ def create_role(role_code: str, role_name: str):
     asyncio.get_event_loop().run_until_complete(do())
 
 
+def run_with_database(action):
+    """连接数据库执行 action，结束前把失效通知发给各 worker"""
+
+    async def do():
+        await Tortoise.init(config=config.db_config)
+        await invalidation_bus.start()
+        try:
+            await action()
+        finally:
+            await invalidation_bus.close()
+            await Tortoise.close_connections()
+
+    asyncio.get_event_loop().run_until_complete(do())
+
+
+def identity_selector(
+    uuids: Optional[List[str]], uuid_file: Optional[Path], is_active: Optional[bool], has_role: Optional[str]
+) -> schemas.IdentitySelector:
+    if uuid_file:
+        uuids = [*(uuids or []), *(line.strip() for line in uuid_file.read_text().splitlines() if line.strip())]
+    try:
+        return schemas.IdentitySelector(uuids=uuids or None, is_active=is_active, role_code=has_role)
+    except ValidationError as err:
+        typer.secho(str(err), fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+
+
+def bulk_command(operation, *args):
+    async def action():
+        try:
+            affected = await operation(*args)
+        except EvaException as err:
+            typer.secho(err.message, fg=typer.colors.RED, err=True)
+            raise typer.Exit(1)
+        typer.secho(f"{affected} rows affected", fg=typer.colors.GREEN)
+
+    run_with_database(action)
+
+
+UUID_OPTION = typer.Option(None, "--uuid", help="identity uuid, can be repeated")
+UUID_FILE_OPTION = typer.Option(None, "--uuid-file", exists=True, dir_okay=False, help="file of uuids, one per line")
+ACTIVE_OPTION = typer.Option(None, "--active/--inactive", help="only active/inactive identities")
+HAS_ROLE_OPTION = typer.Option(None, help="only identities having this role")
+
+
+@cmd.command(help="assign roles to every selected identity in one transaction")
+def assign_roles(
+    role_codes: List[str],
+    uuid: List[str] = UUID_OPTION,
+    uuid_file: Path = UUID_FILE_OPTION,
+    is_active: Optional[bool] = ACTIVE_OPTION,
+    has_role: Optional[str] = HAS_ROLE_OPTION,
+):
+    bulk_command(bulk_rbac.assign_roles, identity_selector(uuid, uuid_file, is_active, has_role), role_codes)
+
+
+@cmd.command(help="revoke roles from every selected identity in one transaction")
+def revoke_roles(
+    role_codes: List[str],
+    uuid: List[str] = UUID_OPTION,
+    uuid_file: Path = UUID_FILE_OPTION,
+    is_active: Optional[bool] = ACTIVE_OPTION,
+    has_role: Optional[str] = HAS_ROLE_OPTION,
+):
+    bulk_command(bulk_rbac.revoke_roles, identity_selector(uuid, uuid_file, is_active, has_role), role_codes)
+
+
+@cmd.command(help="grant every permission to every role in one transaction")
+def grant_permissions(
+    role: List[str] = typer.Option(..., help="role code, can be repeated"),
+    permission: List[str] = typer.Option(..., help="permission code, can be repeated"),
+):
+    bulk_command(bulk_rbac.grant_permissions, role, permission)
+
+
+@cmd.command(help="revoke every permission from every role in one transaction")
+def revoke_permissions(
+    role: List[str] = typer.Option(..., help="role code, can be repeated"),
+    permission: List[str] = typer.Option(..., help="permission code, can be repeated"),
+):
+    bulk_command(bulk_rbac.revoke_permissions, role, permission)
+
+
 @cmd.command(help="create role")
 def identity_add_roles(identity_id: str, role_codes: List[str]):
     async def do():
@@ -4,4 +4,6 @@ set -o errexit
 set -o nounset
 
 aerich upgrade
+# 清空上次运行的 worker 留下的指标文件，见 app.utils.metrics.WorkerSnapshots
+rm -rf "${METRICS_DIR:-/tmp/eva-metrics}"
 gunicorn --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --workers 4 --reload --access-logfile - --error-logfile - app.main:app